@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''
+Compare the throughput of the n5_multiscale downsampling methods
+on a synthetic labelled volume
+'''
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from n5_multiscale import DOWNSAMPLING_METHODS, downsample_block
+
+
+def synthetic_labels(shape, nlabels, seed=0, dtype='uint16', label_size=16):
+    '''
+    Create a volume of box-shaped labels of varying size on a zero background
+    '''
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype=dtype)
+    for label in range(1, nlabels + 1):
+        size = rng.integers(label_size // 2, label_size * 2, 3)
+        start = [rng.integers(0, max(1, d - s)) for d, s in zip(shape, size)]
+        labels[tuple([slice(st, st + s) for st, s in zip(start, size)])] = label
+    return labels
+
+
+def benchmark(volume, downsampling_factors, methods, repeats):
+    results = []
+    for name in methods:
+        method = DOWNSAMPLING_METHODS[name]
+        downsample_block(volume, downsampling_factors, method) # warm up
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            downsample_block(volume, downsampling_factors, method)
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        results.append((name, best, volume.size / best / 1e6))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the n5_multiscale downsampling methods')
+
+    parser.add_argument('-s', '--shape', dest='shape', type=str, default="256,256,256", \
+        help='Shape of the synthetic volume (default "256,256,256")')
+
+    parser.add_argument('-f', '--downsampling_factors', dest='downsampling_factors', type=str, default="2,2,2", \
+        help='Downsampling factors for each dimension (default "2,2,2")')
+
+    parser.add_argument('-n', '--labels', dest='labels', type=int, default=2000, \
+        help='Number of labels in the synthetic volume (default 2000)')
+
+    parser.add_argument('--dtype', dest='dtype', type=str, default='uint16', \
+        help='Data type of the synthetic volume (default uint16)')
+
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=3, \
+        help='Number of timed repetitions; the best one is reported (default 3)')
+
+    parser.add_argument('-m', '--methods', dest='methods', type=str, \
+        default=','.join(DOWNSAMPLING_METHODS.keys()), \
+        help='Comma-delimited list of methods to compare (default all)')
+
+    args = parser.parse_args()
+
+    shape = [int(c) for c in args.shape.split(',')]
+    downsampling_factors = [int(c) for c in args.downsampling_factors.split(',')]
+    methods = args.methods.split(',')
+
+    volume = synthetic_labels(shape, args.labels, dtype=args.dtype)
+    print(f'Volume {shape} {volume.dtype}, {args.labels} labels, factors {downsampling_factors}')
+
+    results = benchmark(volume, downsampling_factors, methods, args.repeats)
+    mean_time = dict([(name, t) for name, t, _ in results]).get('mean')
+    print(f'{"method":>8} {"seconds":>10} {"Mvoxel/s":>10} {"vs mean":>8}')
+    for name, t, throughput in results:
+        relative = f'{mean_time / t:.2f}x' if mean_time else '-'
+        print(f'{name:>8} {t:>10.3f} {throughput:>10.1f} {relative:>8}')
+
+
+if __name__ == "__main__":
+    main()
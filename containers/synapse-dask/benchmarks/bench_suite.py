@@ -0,0 +1,533 @@
+#!/usr/bin/env python
+'''
+Reproducible benchmarks of the synapse-dask conversion, pyramid and block
+read paths on synthetic ExLLSM-like volumes, at several worker counts and
+chunk sizes. Every run is done in a fresh process, which records its
+throughput, peak RSS and the files it wrote, and the results are saved to
+a JSON file. Use "bench_suite.py compare baseline.json results.json" to
+flag the regressions of a change against a saved baseline.
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import tifffile
+import zarr
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from create_n5 import get_compressor, parse_shard_chunks
+from dask_cluster import get_cpu_limit, get_memory_limit
+from n5_utils import (N5ChunkWriter, chunk_intersections, create_occupancy_index,
+                      open_n5_store, read_n5_block)
+
+# Default thresholds of the comparison: relative throughput loss, relative
+# peak RSS increase and RSS increase in MiB below which it is ignored
+THROUGHPUT_THRESHOLD = 0.1
+RSS_THRESHOLD = 0.2
+RSS_NOISE_MB = 32
+
+
+def synthetic_volume(shape, dtype='uint16', neurons=20, sparsity=0.5, seed=0,
+                     block_size=32, background=100, noise=10, intensity=1000):
+    '''
+    Create a volume resembling a masked ExLLSM neuron channel: branching
+    tubes of varying radius, dotted with bright synapse-like puncta, over a
+    noisy background. The volume is divided in blocks of block_size voxels,
+    and a random fraction sparsity of them is left empty (0), like the
+    regions outside the tissue or the neuron mask.
+    '''
+    rng = np.random.default_rng(seed)
+    shape = tuple(shape)
+    max_value = np.iinfo(dtype).max if np.issubdtype(np.dtype(dtype), np.integer) else intensity * 4
+    volume = rng.normal(background, noise, shape).clip(0, max_value).astype(dtype)
+    balls = dict([(r, _ball(r)) for r in range(1, 5)])
+
+    def stamp(center, radius, value):
+        ball = balls[radius]
+        start = [int(c) - radius for c in center]
+        region = tuple([slice(max(0, s), min(d, s + 2 * radius + 1)) for s, d in zip(start, shape)])
+        ball_region = tuple([slice(r.start - s, r.stop - s) for r, s in zip(region, start)])
+        target = volume[region]
+        np.maximum(target, (ball[ball_region] * value).astype(dtype), out=target)
+
+    steps = sum(shape) // 2
+    for _ in range(neurons):
+        # (position, direction, radius, remaining steps) of the branches left to trace
+        branches = [(rng.uniform(0, shape), _unit(rng.normal(size=3)), int(rng.integers(2, 5)), steps)]
+        while branches:
+            position, direction, radius, remaining = branches.pop()
+            for _ in range(remaining):
+                position = position + 2 * direction
+                if np.any(position < 0) or np.any(position >= shape):
+                    break
+                direction = _unit(direction + rng.normal(0, 0.3, 3))
+                stamp(position, radius, intensity * rng.uniform(0.5, 1))
+                if rng.random() < 0.05:
+                    # synapse-like punctum next to the neurite
+                    stamp(position + radius * _unit(rng.normal(size=3)), 1, intensity * 3)
+                remaining -= 1
+                if rng.random() < 0.01 and radius > 1:
+                    branches.append((position, _unit(rng.normal(size=3)), radius - 1, remaining // 2))
+
+    grid = [range(0, d, block_size) for d in shape]
+    for z in grid[0]:
+        for y in grid[1]:
+            for x in grid[2]:
+                if rng.random() < sparsity:
+                    volume[z:z + block_size, y:y + block_size, x:x + block_size] = 0
+    return volume
+
+
+def _ball(radius):
+    zz, yy, xx = np.mgrid[-radius:radius + 1, -radius:radius + 1, -radius:radius + 1]
+    return (zz * zz + yy * yy + xx * xx <= radius * radius).astype(np.float32)
+
+
+def _unit(vector):
+    return vector / max(np.linalg.norm(vector), 1e-9)
+
+
+def write_tiff_series(volume, output_dir):
+    '''
+    Write the volume as a series of 2D TIFF slices named after their Z index
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    for z in range(volume.shape[0]):
+        tifffile.imwrite(os.path.join(output_dir, f'{z}.tif'), volume[z])
+
+
+def write_n5_volume(volume, n5_path, chunk_size, compressor, shard_chunks=None):
+    '''
+    Write the volume to the "/s0" data set of an n5 (or of a sharded container)
+    through N5ChunkWriter, so that empty chunks are not stored
+    '''
+    dtype = volume.dtype.newbyteorder('<') if shard_chunks else volume.dtype
+    zarr.create(shape=volume.shape, chunks=chunk_size, dtype=dtype, compressor=compressor,
+                store=open_n5_store(n5_path, shard_chunks), path='s0', overwrite=True)
+    create_occupancy_index(n5_path, '/s0')
+    writer = N5ChunkWriter(n5_path, '/s0', autoflush=False)
+    for _, region, block_region, _ in chunk_intersections(volume.shape, chunk_size,
+                                                          (0, 0, 0), volume.shape):
+        writer[region] = volume[block_region]
+    writer.flush()
+
+
+def _set_dask_threads(workers):
+    import dask
+    dask.config.set(scheduler='threads', num_workers=workers)
+
+
+def bench_tif_to_n5_dask(inputs, output_dir, chunk_size, workers, options, timed):
+    from tif_to_n5 import tif_series_to_n5_volume
+    _set_dask_threads(workers)
+    with timed():
+        tif_series_to_n5_volume(inputs['tiff_dir'], os.path.join(output_dir, 'out.n5'), '/s0',
+                                options['compressor'], chunk_size=chunk_size, workers=workers,
+                                engine='dask', chunk_stats=False, shard_chunks=options['shard_chunks'])
+    return inputs['nbytes']
+
+
+def bench_tif_to_n5_direct(inputs, output_dir, chunk_size, workers, options, timed):
+    from tif_to_n5 import tif_series_to_n5_volume
+    with timed():
+        tif_series_to_n5_volume(inputs['tiff_dir'], os.path.join(output_dir, 'out.n5'), '/s0',
+                                options['compressor'], chunk_size=chunk_size, workers=workers,
+                                engine='direct', chunk_stats=False, shard_chunks=options['shard_chunks'])
+    return inputs['nbytes']
+
+
+def bench_ingest(inputs, output_dir, chunk_size, workers, options, timed):
+    from ingest import ingest_tif_series
+    with timed():
+        ingest_tif_series(inputs['tiff_dir'], os.path.join(output_dir, 'out.n5'), '',
+                          options['compressor'], chunk_size=chunk_size, workers=workers,
+                          chunk_stats=False, shard_chunks=options['shard_chunks'])
+    return inputs['nbytes']
+
+
+def bench_multiscale(inputs, output_dir, chunk_size, workers, options, timed):
+    from n5_multiscale import add_multiscale
+    _set_dask_threads(workers)
+    n5_path = os.path.join(output_dir, 'in.n5')
+    shutil.copytree(inputs['n5_path'], n5_path)
+    with timed():
+        add_multiscale(n5_path, '', chunk_stats=False)
+    return inputs['nbytes']
+
+
+def bench_multiscale_streaming(inputs, output_dir, chunk_size, workers, options, timed):
+    from n5_multiscale import add_multiscale_streaming
+    n5_path = os.path.join(output_dir, 'in.n5')
+    shutil.copytree(inputs['n5_path'], n5_path)
+    with timed():
+        add_multiscale_streaming(n5_path, '', workers=workers, chunk_stats=False)
+    return inputs['nbytes']
+
+
+def bench_n5_to_tif(inputs, output_dir, chunk_size, workers, options, timed):
+    from n5_to_tif import n5_volume_to_tif_slabs
+    with timed():
+        n5_volume_to_tif_slabs(inputs['n5_path'], '/s0', output_dir, workers=workers)
+    return inputs['nbytes']
+
+
+def bench_read_blocks(inputs, output_dir, chunk_size, workers, options, timed):
+    '''
+    Read blocks of 1.5 chunks, not aligned to the chunk grid, at seeded random
+    positions, until about the size of the volume is read
+    '''
+    shape = inputs['shape']
+    block_shape = [min(d, c * 3 // 2) for d, c in zip(shape, chunk_size)]
+    nblocks = max(8, int(np.prod(shape)) // int(np.prod(block_shape)))
+    rng = np.random.default_rng(options['seed'])
+    boxes = []
+    for _ in range(nblocks):
+        start = [int(rng.integers(0, d - b + 1)) for d, b in zip(shape, block_shape)]
+        # read_n5_block takes x,y,z corners
+        boxes.append((tuple(reversed(start)), tuple(reversed([s + b for s, b in zip(start, block_shape)]))))
+
+    def read_block(box):
+        return read_n5_block(inputs['n5_path'], '/s0', box[0], box[1]).nbytes
+
+    with timed(), ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(read_block, boxes))
+
+
+# Benchmarked paths. Each one prepares its run in output_dir and returns the
+# number of uncompressed bytes it processed in the part measured by timed().
+CASES = {
+    'tif_to_n5_dask': bench_tif_to_n5_dask,
+    'tif_to_n5_direct': bench_tif_to_n5_direct,
+    'ingest': bench_ingest,
+    'multiscale': bench_multiscale,
+    'multiscale_streaming': bench_multiscale_streaming,
+    'n5_to_tif': bench_n5_to_tif,
+    'read_blocks': bench_read_blocks,
+}
+
+
+def count_files(path):
+    '''
+    Returns the number of files under path and their total size
+    '''
+    nfiles, nbytes = 0, 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            nfiles += 1
+            nbytes += os.path.getsize(os.path.join(dirpath, filename))
+    return nfiles, nbytes
+
+
+def _run_case(conn, case, inputs, output_dir, chunk_size, workers, options):
+    '''
+    Runs one benchmark in a child process and sends its measurements to conn
+    '''
+    result = {}
+
+    @contextmanager
+    def timed():
+        files_before = count_files(output_dir)
+        result['start_rss_mb'] = _peak_rss_mb()
+        start = time.perf_counter()
+        yield
+        result['seconds'] = time.perf_counter() - start
+        files_after = count_files(output_dir)
+        result['files_written'] = files_after[0] - files_before[0]
+        result['bytes_written'] = files_after[1] - files_before[1]
+
+    options = dict(options, compressor=get_compressor(options['compression']))
+    try:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            nbytes = CASES[case](inputs, output_dir, chunk_size, workers, options, timed)
+        result['mb_per_s'] = nbytes / result['seconds'] / 1e6
+        result['peak_rss_mb'] = _peak_rss_mb()
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    conn.send(result)
+    conn.close()
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(case, inputs, work_dir, chunk_size, workers, options):
+    '''
+    Runs one benchmark in a fresh process, so that its peak RSS and its caches
+    are its own, and returns its measurements
+    '''
+    output_dir = tempfile.mkdtemp(dir=work_dir, prefix=f'{case}-')
+    try:
+        ctx = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=_run_case,
+                              args=(child_conn, case, inputs, output_dir, chunk_size, workers, options))
+        process.start()
+        child_conn.close()
+        try:
+            result = parent_conn.recv()
+        except EOFError:
+            result = {}
+        process.join()
+        if process.exitcode != 0:
+            result['error'] = result.get('error') or f'exit code {process.exitcode}'
+        return result
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def run_benchmarks(shape, chunk_sizes, worker_counts, cases, options, work_dir, repeats=1):
+    '''
+    Generates the synthetic data and runs every case at every chunk size and
+    worker count, keeping the fastest of the repeated runs.
+    Returns the list of results.
+    '''
+    print(f'Generating a synthetic volume of {shape} {options["dtype"]}')
+    start = time.perf_counter()
+    volume = synthetic_volume(shape, dtype=options['dtype'], neurons=options['neurons'],
+                              sparsity=options['sparsity'], seed=options['seed'])
+    tiff_dir = os.path.join(work_dir, 'tiff')
+    write_tiff_series(volume, tiff_dir)
+    inputs = {}
+    compressor = get_compressor(options['compression'])
+    for chunk_size in chunk_sizes:
+        n5_path = os.path.join(work_dir, 'input-' + '_'.join([str(c) for c in chunk_size]) + '.n5')
+        write_n5_volume(volume, n5_path, chunk_size, compressor, options['shard_chunks'])
+        inputs[tuple(chunk_size)] = {
+            'tiff_dir': tiff_dir,
+            'n5_path': n5_path,
+            'shape': tuple(shape),
+            'nbytes': volume.nbytes,
+        }
+    nonzero = np.count_nonzero(volume) / volume.size
+    print(f'Generated the TIFFs and {len(chunk_sizes)} n5 inputs in {time.perf_counter() - start:.1f}s '
+          f'({nonzero:.1%} non-zero voxels)')
+    del volume
+
+    results = []
+    print(f'{"case":>22} {"chunks":>14} {"workers":>7} {"seconds":>9} {"MB/s":>9} '
+          f'{"peak RSS MB":>11} {"files":>7}')
+    for case in cases:
+        for chunk_size in chunk_sizes:
+            for workers in worker_counts:
+                runs = [run_case(case, inputs[tuple(chunk_size)], work_dir, chunk_size, workers, options)
+                        for _ in range(repeats)]
+                successful = [r for r in runs if 'error' not in r]
+                result = min(successful, key=lambda r: r['seconds']) if successful else runs[0]
+                result = dict(case=case, chunk_size=list(chunk_size), workers=workers, **result)
+                results.append(result)
+                print(_format_result(result))
+    return results
+
+
+def _format_result(result):
+    prefix = f'{result["case"]:>22} {",".join([str(c) for c in result["chunk_size"]]):>14} {result["workers"]:>7}'
+    if 'error' in result:
+        return f'{prefix} failed: {result["error"]}'
+    return (f'{prefix} {result["seconds"]:>9.2f} {result["mb_per_s"]:>9.1f} '
+            f'{result["peak_rss_mb"]:>11.1f} {result["files_written"]:>7}')
+
+
+def _result_key(result):
+    return (result['case'], tuple(result['chunk_size']), result['workers'])
+
+
+def compare_results(baseline, results, throughput_threshold=THROUGHPUT_THRESHOLD,
+                    rss_threshold=RSS_THRESHOLD):
+    '''
+    Compare the results with the baseline results of the same case, chunk size and
+    worker count. A run regressed if its throughput dropped by more than
+    throughput_threshold, its peak RSS grew by more than rss_threshold (and by
+    more than RSS_NOISE_MB), it wrote more files, or it failed.
+    Returns a list of (result key, baseline result, result, regressions) tuples.
+    '''
+    baseline_results = dict([(_result_key(r), r) for r in baseline])
+    comparisons = []
+    for result in results:
+        key = _result_key(result)
+        base = baseline_results.get(key)
+        if base is None or 'error' in base:
+            continue
+        regressions = []
+        if 'error' in result:
+            regressions.append('failed')
+        else:
+            if result['mb_per_s'] < base['mb_per_s'] * (1 - throughput_threshold):
+                regressions.append('throughput')
+            if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + rss_threshold) and \
+                    result['peak_rss_mb'] - base['peak_rss_mb'] > RSS_NOISE_MB:
+                regressions.append('peak RSS')
+            if result['files_written'] > base['files_written']:
+                regressions.append('files written')
+        comparisons.append((key, base, result, regressions))
+    return comparisons
+
+
+def print_comparison(comparisons):
+    print(f'{"case":>22} {"chunks":>14} {"workers":>7} {"MB/s":>17} {"peak RSS MB":>17} '
+          f'{"files":>13}  regressions')
+    for (case, chunk_size, workers), base, result, regressions in comparisons:
+        prefix = f'{case:>22} {",".join([str(c) for c in chunk_size]):>14} {workers:>7}'
+        if 'error' in result:
+            print(f'{prefix} failed: {result["error"]}')
+            continue
+        throughput = f'{base["mb_per_s"]:.1f}->{result["mb_per_s"]:.1f}'
+        rss = f'{base["peak_rss_mb"]:.0f}->{result["peak_rss_mb"]:.0f}'
+        files = f'{base["files_written"]}->{result["files_written"]}'
+        print(f'{prefix} {throughput:>17} {rss:>17} {files:>13}  {", ".join(regressions) or "-"}')
+    regressed = [c for c in comparisons if c[3]]
+    print(f'{len(regressed)} of {len(comparisons)} runs regressed')
+    return regressed
+
+
+def compare_main(argv):
+    parser = argparse.ArgumentParser(description='Compare benchmark results with a baseline')
+
+    parser.add_argument('baseline', type=str,
+                        help='JSON results of the baseline')
+
+    parser.add_argument('results', type=str,
+                        help='JSON results to compare with the baseline')
+
+    parser.add_argument('--threshold', dest='threshold', type=float, default=THROUGHPUT_THRESHOLD,
+                        help=f'Relative throughput loss reported as a regression (default {THROUGHPUT_THRESHOLD})')
+
+    parser.add_argument('--rss_threshold', dest='rss_threshold', type=float, default=RSS_THRESHOLD,
+                        help=f'Relative peak RSS increase reported as a regression (default {RSS_THRESHOLD})')
+
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+    if baseline['parameters'] != results['parameters']:
+        print('Warning: the results were generated with different parameters than the baseline')
+    regressed = print_comparison(compare_results(baseline['results'], results['results'],
+                                                 args.threshold, args.rss_threshold))
+    sys.exit(1 if regressed else 0)
+
+
+def main():
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        compare_main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description='Benchmark the synapse-dask scripts on synthetic volumes. ' +
+                                     'Use "bench_suite.py compare" to compare results with a baseline.')
+
+    parser.add_argument('-s', '--shape', dest='shape', type=str, default="128,512,512",
+                        help='Shape (z,y,x) of the synthetic volume (default "128,512,512")')
+
+    parser.add_argument('-c', '--chunk_size', dest='chunk_sizes', type=str, action='append',
+                        help='Chunk size (z,y,x) to benchmark. Can be repeated. ' +
+                        'Default is 64,64,64 and 128,128,128.')
+
+    parser.add_argument('--workers', dest='workers', type=str, default="1,2,4",
+                        help='Comma-delimited worker counts to benchmark (default "1,2,4")')
+
+    parser.add_argument('--cases', dest='cases', type=str, default=','.join(CASES.keys()),
+                        help='Comma-delimited list of the benchmarks to run (default all): ' +
+                        ', '.join(CASES.keys()))
+
+    parser.add_argument('--dtype', dest='dtype', type=str, default='uint16',
+                        help='Data type of the synthetic volume (default uint16)')
+
+    parser.add_argument('--sparsity', dest='sparsity', type=float, default=0.5,
+                        help='Fraction of the synthetic volume left empty (default 0.5)')
+
+    parser.add_argument('--neurons', dest='neurons', type=int, default=20,
+                        help='Number of neurons in the synthetic volume (default 20)')
+
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='Seed of the synthetic data (default 0)')
+
+    parser.add_argument('--compression', dest='compression', type=str, default='gzip',
+                        help='Compression of the n5 inputs and outputs, e.g. raw, gzip:6, blosc:zstd:5 (default gzip)')
+
+    parser.add_argument('--shard_chunks', dest='shard_chunks', type=str,
+                        help='Write sharded containers with this number of chunks per shard along z,y,x')
+
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=1,
+                        help='Number of repetitions of each run; the fastest one is reported (default 1)')
+
+    parser.add_argument('-o', '--output', dest='output_path', type=str, default='bench_results.json',
+                        help='JSON file for the results (default bench_results.json)')
+
+    parser.add_argument('--baseline', dest='baseline', type=str,
+                        help='Compare the results with these baseline results and exit with status 1 ' +
+                        'if any run regressed')
+
+    parser.add_argument('--threshold', dest='threshold', type=float, default=THROUGHPUT_THRESHOLD,
+                        help='With --baseline, the relative throughput loss reported as a regression ' +
+                        f'(default {THROUGHPUT_THRESHOLD})')
+
+    parser.add_argument('--tmp_dir', dest='tmp_dir', type=str, default=None,
+                        help='Directory for the temporary TIFF and n5 data')
+
+    args = parser.parse_args()
+
+    shape = [int(c) for c in args.shape.split(',')]
+    chunk_sizes = [[int(c) for c in s.split(',')] for s in (args.chunk_sizes or ['64,64,64', '128,128,128'])]
+    worker_counts = [int(c) for c in args.workers.split(',')]
+    cases = args.cases.split(',')
+    for case in cases:
+        if case not in CASES:
+            parser.error(f'Unknown benchmark {case}')
+    options = {
+        'dtype': args.dtype,
+        'sparsity': args.sparsity,
+        'neurons': args.neurons,
+        'seed': args.seed,
+        'compression': args.compression,
+        'shard_chunks': parse_shard_chunks(args.shard_chunks),
+    }
+
+    work_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        results = run_benchmarks(shape, chunk_sizes, worker_counts, cases, options, work_dir,
+                                 repeats=args.repeats)
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {
+        'parameters': dict(options, shape=shape, shard_chunks=args.shard_chunks),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': get_cpu_limit(),
+            'memory_mb': get_memory_limit() / (1 << 20),
+            'numpy': np.__version__,
+            'zarr': zarr.__version__,
+        },
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    with open(args.output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Saved the results to', args.output_path)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['parameters'] != report['parameters']:
+            print('Warning: the results were generated with different parameters than the baseline')
+        regressed = print_comparison(compare_results(baseline['results'], results, args.threshold))
+        sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+'''
+Compare the tif_to_n5 conversion engines on a synthetic TIFF series
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numcodecs as codecs
+import numpy as np
+import tifffile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from tif_to_n5 import tif_series_to_n5_volume
+
+
+def write_synthetic_series(output_dir, shape, dtype='uint16', compression=None, seed=0):
+    '''
+    Write a series of noisy 2D TIFF slices with some bright structures
+    '''
+    rng = np.random.default_rng(seed)
+    for z in range(shape[0]):
+        frame = rng.normal(100, 10, shape[1:]).clip(0, None).astype(dtype)
+        frame[rng.random(shape[1:]) > 0.99] = 1000
+        tifffile.imwrite(os.path.join(output_dir, f'{z}.tif'), frame, compression=compression)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the tif_to_n5 conversion engines')
+
+    parser.add_argument('-s', '--shape', dest='shape', type=str, default="256,1024,1024",
+                        help='Shape (z,y,x) of the synthetic volume (default "256,1024,1024")')
+
+    parser.add_argument('-c', '--chunk_size', dest='chunk_size', type=str, default="128,128,128",
+                        help='Chunk size (default "128,128,128")')
+
+    parser.add_argument('--compression', dest='compression', type=str, default='gzip',
+                        help='N5 compression (default gzip)')
+
+    parser.add_argument('--tiff_compression', dest='tiff_compression', type=str, default=None,
+                        help='Compression of the synthetic TIFFs (default uncompressed)')
+
+    parser.add_argument('--workers', dest='workers', type=int, default=8,
+                        help='Number of threads used by the direct engine (default 8)')
+
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=1,
+                        help='Number of timed repetitions; the best one is reported (default 1)')
+
+    parser.add_argument('--tmp_dir', dest='tmp_dir', type=str, default=None,
+                        help='Directory for the temporary TIFF and n5 data')
+
+    args = parser.parse_args()
+
+    shape = [int(c) for c in args.shape.split(',')]
+    chunk_size = [int(c) for c in args.chunk_size.split(',')]
+    compressor = None if args.compression == 'raw' else codecs.get_codec(dict(id=args.compression))
+
+    work_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        tiff_dir = os.path.join(work_dir, 'tiff')
+        os.makedirs(tiff_dir)
+        write_synthetic_series(tiff_dir, shape, compression=args.tiff_compression)
+        nbytes = np.prod(shape) * 2
+
+        results = []
+        for engine in ['dask', 'direct']:
+            timings = []
+            for _ in range(args.repeats):
+                n5_path = os.path.join(work_dir, f'{engine}.n5')
+                start = time.perf_counter()
+                tif_series_to_n5_volume(tiff_dir, n5_path, '/s0', compressor,
+                                        chunk_size=chunk_size,
+                                        workers=args.workers,
+                                        engine=engine)
+                timings.append(time.perf_counter() - start)
+                shutil.rmtree(n5_path)
+            results.append((engine, min(timings)))
+
+        print(f'Volume {shape} uint16, chunks {chunk_size}, compression {args.compression}')
+        print(f'{"engine":>8} {"seconds":>10} {"MB/s":>10}')
+        for engine, t in results:
+            print(f'{engine:>8} {t:>10.2f} {nbytes / t / 1e6:>10.1f}')
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,128 @@
 #!/usr/bin/env python
 
 import argparse
+import sys
+import time
+import numpy as np
+import telemetry
 import zarr
 import numcodecs as codecs
+from concurrent.futures import ThreadPoolExecutor
 
+from n5_utils import (create_occupancy_index, open_n5_store, remove_chunk_stats,
+                      sample_stored_chunks)
+
+# Codecs of the N5 specification, which every N5 reader supports
+N5_CODEC_IDS = ['gzip', 'bz2', 'lzma', 'blosc']
+
+# Codecs considered by --compression auto
+AUTO_CODECS = [
+    'raw',
+    'gzip:1', 'gzip:6',
+    'bz2:1', 'bz2:9',
+    'xz:1',
+    'blosc:lz4:5', 'blosc:zstd:5',
+]
+
+# Codecs compared by the benchmark, including codecs that other N5 readers may not support
+BENCHMARK_CODECS = AUTO_CODECS + [
+    'lz4',
+    'zstd:1', 'zstd:5',
+]
+
+
+def get_compressor(compression):
+    '''
+    Returns the numcodecs compressor for a codec id with optional settings
+    separated by colons, e.g. "raw", "bz2", "gzip:6", "xz:6", "blosc:zstd:5"
+    '''
+    settings = compression.split(':')
+    codec_id = settings[0]
+    if codec_id == 'raw':
+        return None
+    if codec_id == 'xz':
+        # the N5 xz compression is the xz format of the numcodecs lzma codec
+        config = dict(id='lzma')
+        if len(settings) > 1:
+            config['preset'] = int(settings[1])
+        return codecs.get_codec(config)
+    config = dict(id=codec_id)
+    if codec_id == 'blosc':
+        if len(settings) > 1:
+            config['cname'] = settings[1]
+        if len(settings) > 2:
+            config['clevel'] = int(settings[2])
+    elif codec_id == 'lz4':
+        if len(settings) > 1:
+            config['acceleration'] = int(settings[1])
+    elif len(settings) > 1:
+        config['level'] = int(settings[1])
+    return codecs.get_codec(config)
+
+
+def is_n5_codec(compression):
+    '''
+    Returns True if the compression is part of the N5 specification
+    '''
+    compressor = get_compressor(compression)
+    return compressor is None or compressor.codec_id in N5_CODEC_IDS
+
+
+def parse_shard_chunks(shard_chunks):
+    '''
+    Returns the number of chunks per shard from a comma-delimited string, or None
+    '''
+    if not shard_chunks:
+        return None
+    return tuple([int(c) for c in shard_chunks.split(',')])
+
+
+def parse_value_range(value_range):
+    '''
+    Returns the (min, max) value range from a comma-delimited string, or None
+    '''
+    if not value_range:
+        return None
+    return tuple([float(c) for c in value_range.split(',')])
+
+
+@telemetry.stage('create_n5')
 def create_dataset(output_n5, template_n5, compression='same',
                    dtype='same', template_data_set='/s0',
-                   target_data_set='/s0', overwrite=True):
-
-    template = zarr.open(store=zarr.N5Store(template_n5), mode='r')[template_data_set]
-    out = zarr.open(store=zarr.N5Store(output_n5), mode='a')
-        
-    if compression == 'raw':
-        compressor = None
-    elif compression == 'same':
+                   target_data_set='/s0', overwrite=True,
+                   target_ratio=2.0, track_occupancy=False,
+                   shard_chunks=None):
+    '''
+    Create an empty data set with the shape and chunking of the template data set.
+    If shard_chunks is set, the output is a sharded zarr v3 container instead of
+    an n5, with shard_chunks (z,y,x) chunks per shard file, see ShardedStore.
+    '''
+    template = zarr.open(store=open_n5_store(template_n5), mode='r')[template_data_set]
+    out = zarr.open(store=open_n5_store(output_n5, shard_chunks), mode='a')
+
+    if compression == 'auto':
+        chunk_samples = sample_stored_chunks(template)
+        if chunk_samples:
+            compressor = get_compressor(select_codec(chunk_samples, target_ratio))
+        else:
+            print('The template has no stored chunks to select the compression from, ' +
+                  'using the compression of the template')
+            compression = 'same'
+    if compression == 'same':
         compressor = template.compressor
-    else:
-        compressor = codecs.get_codec(dict(id=compression))
+        if shard_chunks and compressor is not None and compressor.codec_id == 'n5_wrapper':
+            # the codec wrapped by the n5 chunk header
+            config = compressor.get_config()['compressor_config']
+            compressor = codecs.get_codec(config) if config else None
+    elif compression != 'auto':
+        compressor = get_compressor(compression)
 
     if dtype=='same':
         dtype = template.dtype
-        
+    if shard_chunks:
+        # shards hold little endian chunks, unlike the big endian n5 chunks
+        dtype = np.dtype(dtype).newbyteorder('<')
+
     print("Using compressor:", compressor or 'raw')
 
     print("Creating n5 data set with:")
@@ -28,6 +130,8 @@ def create_dataset(output_n5, template_n5, compression='same',
     print(f"  shape:      {template.shape}")
     print(f"  chunking:   {template.chunks}")
     print(f"  dtype:      {dtype}")
+    if shard_chunks:
+        print(f"  shards:     {shard_chunks} chunks")
     print(f"  to path:    {output_n5}{target_data_set}")
 
     out.create_dataset(target_data_set,
@@ -36,11 +140,121 @@ def create_dataset(output_n5, template_n5, compression='same',
         dtype=dtype,
         compressor=compressor,
         overwrite=overwrite)
+    remove_chunk_stats(output_n5, target_data_set)
+
+    if track_occupancy:
+        create_occupancy_index(output_n5, target_data_set)
+
+
+def benchmark_codecs(chunks, compressions=BENCHMARK_CODECS, threads=4):
+    '''
+    Measure the compression ratio and the encoding and decoding throughput (in MB/s)
+    of each codec on the given chunks, using the given number of threads.
+    Returns a list of dictionaries, one per codec.
+    '''
+    chunks = [np.ascontiguousarray(c) for c in chunks]
+    raw_bytes = sum([c.nbytes for c in chunks])
+    results = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for compression in compressions:
+            compressor = get_compressor(compression)
+            if compressor is None:
+                results.append(dict(compression=compression, ratio=1.0,
+                                    encode_mbps=float('inf'), decode_mbps=float('inf')))
+                continue
+            start = time.perf_counter()
+            encoded = list(executor.map(compressor.encode, chunks))
+            encode_time = time.perf_counter() - start
+            start = time.perf_counter()
+            list(executor.map(compressor.decode, encoded))
+            decode_time = time.perf_counter() - start
+            encoded_bytes = sum([len(e) for e in encoded])
+            results.append(dict(compression=compression,
+                                ratio=raw_bytes / max(encoded_bytes, 1),
+                                encode_mbps=raw_bytes / 1e6 / max(encode_time, 1e-9),
+                                decode_mbps=raw_bytes / 1e6 / max(decode_time, 1e-9)))
+    return results
+
+
+def select_codec(chunks, target_ratio, compressions=AUTO_CODECS, threads=4):
+    '''
+    Returns the fastest codec (by combined encode and decode time) that reaches
+    the target compression ratio on the given chunks. If no codec reaches it,
+    the codec with the best ratio is returned.
+    '''
+    results = benchmark_codecs(chunks, compressions=compressions, threads=threads)
+    print_benchmark(results)
+    candidates = [r for r in results if r['ratio'] >= target_ratio]
+    if candidates:
+        best = min(candidates, key=lambda r: 1 / r['encode_mbps'] + 1 / r['decode_mbps'])
+    else:
+        best = max(results, key=lambda r: r['ratio'])
+    print(f"Selected compression {best['compression']} for target ratio {target_ratio}")
+    return best['compression']
+
+
+def print_benchmark(results):
+    print(f'{"compression":>14} {"ratio":>8} {"encode MB/s":>12} {"decode MB/s":>12}  n5')
+    for r in results:
+        # codecs outside of the N5 specification are only readable by zarr
+        n5 = 'yes' if is_n5_codec(r['compression']) else 'no (zarr only)'
+        print(f'{r["compression"]:>14} {r["ratio"]:>8.2f} '
+              f'{r["encode_mbps"]:>12.1f} {r["decode_mbps"]:>12.1f}  {n5}')
+
+
+def benchmark_main(argv):
+
+    parser = argparse.ArgumentParser(prog='create_n5 benchmark',
+        description='Benchmark compression codecs on chunks sampled from an n5 data set')
+
+    parser.add_argument('-i', '--input', dest='input_path',
+        type=str, required=True,
+        help='Path to an existing n5')
+
+    parser.add_argument('-d', '--data_set', dest='data_set',
+        type=str, default='/s0',
+        help='Data set to sample chunks from')
+
+    parser.add_argument('--samples', dest='samples',
+        type=int, default=8,
+        help='Number of stored chunks to sample. Default is 8.')
+
+    parser.add_argument('--threads', dest='threads',
+        type=int, default=4,
+        help='Number of threads used for encoding and decoding. Default is 4.')
+
+    parser.add_argument('--codecs', dest='codecs',
+        type=str, default=','.join(BENCHMARK_CODECS),
+        help='Comma-delimited list of codecs, with optional colon separated settings, e.g. gzip:6,blosc:zstd:5. ' + \
+             'Default is all the codecs considered by --compression auto, and lz4 and zstd, which are not ' + \
+             'part of the N5 specification.')
+
+    parser.add_argument('--target_ratio', dest='target_ratio',
+        type=float, default=None,
+        help='Also report the fastest codec that reaches this compression ratio')
+
+    args = parser.parse_args(argv)
+
+    array = zarr.open(store=open_n5_store(args.input_path), mode='r')[args.data_set]
+    chunks = sample_stored_chunks(array, samples=args.samples)
+    if not chunks:
+        parser.error(f'{args.input_path}{args.data_set} has no stored chunks to benchmark')
+    print(f"Sampled {len(chunks)} chunks of {array.chunks} {array.dtype} from {args.input_path}{args.data_set}")
+    compressions = args.codecs.split(',')
+    if args.target_ratio:
+        select_codec(chunks, args.target_ratio, compressions=compressions, threads=args.threads)
+    else:
+        print_benchmark(benchmark_codecs(chunks, compressions=compressions, threads=args.threads))
 
 
 def main():
 
-    parser = argparse.ArgumentParser(description='Create an empty n5 data set')
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark_main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description='Create an empty n5 data set. ' + \
+        'Use "create_n5 benchmark" to compare compression codecs on an existing data set.')
 
     parser.add_argument('-o', '--output', dest='output_path',
         type=str, required=True,
@@ -65,15 +279,39 @@ def main():
     parser.add_argument('--compression', dest='compression',
         type=str, default='same',
         help='Set the compression. Valid values any codec id supported by numcodecs including: '+ \
-             'raw, lz4, gzip, bz2, blosc. Default is the same compression as the template.')
+             'raw, lz4, gzip, bz2, xz, blosc, optionally followed by settings, e.g. gzip:6 or blosc:zstd:5. '+ \
+             'Use "auto" to select the fastest N5 codec (raw, gzip, bz2, xz or blosc) reaching --target_ratio '+ \
+             'on the template chunks. '+ \
+             'Default is the same compression as the template.')
+
+    parser.add_argument('--target_ratio', dest='target_ratio',
+        type=float, default=2.0,
+        help='Compression ratio required from the codec selected by --compression auto. Default is 2.')
+
+    parser.add_argument('--track_occupancy', dest='track_occupancy', action='store_true',
+        help='Create an occupancy index for the new data set. Only use it if the data set ' + \
+             'is written with the synapse-dask scripts, which keep the index up to date.')
+    parser.set_defaults(track_occupancy=False)
+
+    parser.add_argument('--shard_chunks', dest='shard_chunks',
+        type=str,
+        help='Create a sharded zarr v3 container instead of an n5, with this comma-delimited ' + \
+             'number of chunks per shard file along z,y,x, e.g. 4,4,4. Default is no sharding.')
+
+    telemetry.add_telemetry_arguments(parser)
 
     args = parser.parse_args()
-    
+
+    telemetry.setup_telemetry('create_n5', args.telemetry, args.profile)
+
     create_dataset(args.output_path, args.template_path,
                   compression=args.compression,
                   dtype=args.dtype,
                   template_data_set=args.template_data_set,
-                  target_data_set=args.target_data_set)
+                  target_data_set=args.target_data_set,
+                  target_ratio=args.target_ratio,
+                  track_occupancy=args.track_occupancy,
+                  shard_chunks=parse_shard_chunks(args.shard_chunks))
 
 
 if __name__ == "__main__":
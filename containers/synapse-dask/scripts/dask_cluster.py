@@ -0,0 +1,242 @@
+"""
+Sizing of the dask workers from the CPU and memory limits of the container.
+
+Nextflow runs the scripts with a fixed number of CPUs and amount of memory,
+enforced through cgroups. plan_cluster divides these resources into dask
+worker processes and threads so that the chunks processed concurrently fit
+in memory, and start_client starts a local cluster with that layout.
+"""
+import os
+
+import dask
+import n5_utils
+import telemetry
+
+from n5_rechunk import parse_size
+
+# Memory of an idle worker process (interpreter, numpy, dask, zarr)
+PROCESS_OVERHEAD = 256 << 20
+
+# Chunk-sized buffers held by a running task: the source data, the data
+# rearranged into the chunk, the encoded chunk and a partial copy
+CHUNK_COPIES = 4
+
+# Fraction of the memory limit left to the workers; the rest is headroom
+# for the client process and the page cache of the TIFF and n5 files
+MEMORY_FRACTION = 0.9
+
+# Fractions of its memory limit at which a worker starts spilling task results
+# to disk, pauses running new tasks and gets restarted
+MEMORY_THRESHOLDS = {
+    'target': 0.6,
+    'spill': 0.7,
+    'pause': 0.85,
+    'terminate': 0.95,
+}
+
+# Limits above this value mean that the cgroup has no limit
+_UNLIMITED = 1 << 60
+
+
+def add_cluster_arguments(parser):
+    """
+    Adds the options overriding the worker layout to an argparse parser.
+    The scripts define --workers themselves.
+    """
+    parser.add_argument('--threads_per_worker', dest='threads_per_worker', type=int,
+                        help='Threads per dask worker process. By default the layout is chosen ' +
+                        'from the CPU and memory limits of the container.')
+
+    parser.add_argument('--memory_limit', dest='memory_limit', type=str,
+                        help='Memory available to the workers, e.g. 30G. ' +
+                        'Default is the memory limit of the container.')
+
+
+def _read_limit(path):
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except (OSError, ValueError):
+        return None
+
+
+def _cgroup_files(controller, filename):
+    """
+    Returns the candidate paths of a cgroup v1 controller file, or of a v2 file
+    if controller is None, for the cgroup of this process and for the root
+    of the cgroup namespace
+    """
+    paths = []
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                _, controllers, cgroup = line.strip().split(':', 2)
+                if (controller is None and controllers == '') or \
+                        (controller is not None and controller in controllers.split(',')):
+                    paths.append(cgroup)
+    except OSError:
+        pass
+    if controller is None:
+        root = '/sys/fs/cgroup'
+    else:
+        root = f'/sys/fs/cgroup/{controller}'
+    return [os.path.join(root, p.lstrip('/'), filename) for p in paths] + [os.path.join(root, filename)]
+
+
+def get_cpu_limit():
+    """
+    Returns the number of CPUs this process can use, taking into account
+    the CPU affinity and the cgroup (v1 or v2) CPU quota
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    for path in _cgroup_files(None, 'cpu.max'):
+        limit = _read_limit(path)
+        if limit and limit[0] != 'max':
+            return max(1, min(cpus, int(int(limit[0]) / int(limit[1]))))
+        if limit:
+            return cpus
+    for quota_path in _cgroup_files('cpu', 'cpu.cfs_quota_us'):
+        quota = _read_limit(quota_path)
+        period = _read_limit(os.path.join(os.path.dirname(quota_path), 'cpu.cfs_period_us'))
+        if quota and period and int(quota[0]) > 0:
+            return max(1, min(cpus, int(int(quota[0]) / int(period[0]))))
+    return cpus
+
+
+def get_memory_limit():
+    """
+    Returns the memory in bytes this process can use: the cgroup (v1 or v2)
+    memory limit, or the physical memory if there is no limit
+    """
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for path in _cgroup_files(None, 'memory.max') + _cgroup_files('memory', 'memory.limit_in_bytes'):
+        limit = _read_limit(path)
+        if limit and limit[0] != 'max' and int(limit[0]) < _UNLIMITED:
+            return min(memory, int(limit[0]))
+    return memory
+
+
+def plan_cluster(cpus, memory, chunk_bytes, workers=None, threads_per_worker=None, processes=True):
+    """
+    Choose the number of worker processes and threads per process for the given
+    number of CPUs and bytes of memory, when a task processes about one chunk of
+    chunk_bytes. The codecs release the GIL, so by default the CPUs are divided
+    into processes of 2 threads, or 4 on larger machines, rather than
+    single-threaded processes that each pay the process overhead.
+    The number of threads is reduced until the chunks in flight, CHUNK_COPIES
+    buffers per thread, fit in the memory of the workers.
+    workers, threads_per_worker: requested layout (with processes=False the
+                                 tasks run as threads of a single process)
+    Returns a dictionary with the layout.
+    """
+    if not processes:
+        threads = (workers or cpus) * (threads_per_worker or 1)
+        workers, threads_per_worker = 1, threads
+    elif workers is None and threads_per_worker is None:
+        threads_per_worker = 1 if cpus == 1 else 2 if cpus <= 8 else 4
+        workers = max(1, cpus // threads_per_worker)
+    elif workers is None:
+        workers = max(1, cpus // threads_per_worker)
+    elif threads_per_worker is None:
+        threads_per_worker = 1
+
+    budget = int(memory * MEMORY_FRACTION) - PROCESS_OVERHEAD
+    task_bytes = max(1, chunk_bytes * CHUNK_COPIES)
+    slots = max(1, (budget - (workers if processes else 0) * PROCESS_OVERHEAD) // task_bytes)
+    requested_threads = workers * threads_per_worker
+    if requested_threads > slots:
+        threads_per_worker = max(1, slots // workers)
+        if workers * threads_per_worker > slots:
+            workers = slots
+    threads = workers * threads_per_worker
+    return {
+        'cpus': cpus,
+        'memory': memory,
+        'chunk_bytes': chunk_bytes,
+        'processes': processes,
+        'workers': workers,
+        'threads_per_worker': threads_per_worker,
+        'threads': threads,
+        'memory_per_worker': max(budget // workers, PROCESS_OVERHEAD + task_bytes * threads_per_worker),
+        'max_inflight_chunks': threads,
+        'limited_by_memory': threads < requested_threads,
+    }
+
+
+def _format_size(nbytes):
+    for unit in ['B', 'KiB', 'MiB']:
+        if nbytes < 1024:
+            return f'{nbytes:.1f} {unit}'
+        nbytes /= 1024
+    return f'{nbytes:.1f} GiB'
+
+
+def format_layout(layout):
+    """
+    Returns a one line description of a layout returned by plan_cluster
+    """
+    if layout['processes']:
+        description = (f"{layout['workers']} workers x {layout['threads_per_worker']} threads, "
+                       f"{_format_size(layout['memory_per_worker'])} per worker "
+                       f"(spill at {MEMORY_THRESHOLDS['spill']:.0%}, pause at {MEMORY_THRESHOLDS['pause']:.0%})")
+    else:
+        description = f"{layout['threads']} threads"
+    description += (f", at most {layout['max_inflight_chunks']} chunks of "
+                    f"{_format_size(layout['chunk_bytes'])} in flight "
+                    f"({layout['cpus']} CPUs, {_format_size(layout['memory'])} available)")
+    if layout['limited_by_memory']:
+        description += ', reduced to fit in memory'
+    return description
+
+
+def start_client(layout, dashboard_address=None):
+    """
+    Starts a local cluster of worker processes with the given layout and returns
+    its client. The workers spill to the dask temporary directory (TMPDIR).
+    """
+    from dask.distributed import Client, LocalCluster
+
+    dask.config.set(dict([(f'distributed.worker.memory.{k}', v)
+                          for k, v in MEMORY_THRESHOLDS.items()]))
+    cluster = LocalCluster(n_workers=layout['workers'],
+                           threads_per_worker=layout['threads_per_worker'],
+                           memory_limit=layout['memory_per_worker'],
+                           processes=True,
+                           dashboard_address=dashboard_address)
+    return Client(cluster)
+
+
+def configure_dask(chunk_bytes, distributed=False, workers=None, threads_per_worker=None,
+                   memory_limit=None, dashboard_address=None):
+    """
+    Plans the layout from the container limits (or the given overrides) and either
+    starts a local cluster, if distributed is set, or sets the number of threads
+    of the default dask scheduler. The layout is printed and recorded in the
+    telemetry. Returns the layout and the client, which is None unless distributed.
+    memory_limit: memory in bytes or as a size string such as "30G"
+    """
+    memory = parse_size(memory_limit) if memory_limit else get_memory_limit()
+    layout = plan_cluster(get_cpu_limit(), memory, chunk_bytes, workers=workers,
+                          threads_per_worker=threads_per_worker, processes=distributed)
+    print('Dask layout:', format_layout(layout))
+    telemetry.write_record('cluster', **layout)
+    client = None
+    if distributed:
+        client = start_client(layout, dashboard_address)
+    else:
+        dask.config.set(num_workers=layout['threads'])
+    return layout, client
+
+
+def flush_chunk_stats():
+    """
+    Writes the chunk statistics buffered by this process and, if a local
+    cluster is running, by its workers, see n5_utils.flush_chunk_stats
+    """
+    n5_utils.flush_chunk_stats()
+    try:
+        from dask.distributed import default_client
+        client = default_client()
+    except (ImportError, ValueError):
+        return
+    client.run(n5_utils.flush_chunk_stats)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+'''
+Convert a TIFF series into an n5 volume with its multiscale pyramid and metadata
+in a single pass. The pyramid levels are computed from the s0 slabs while they
+are in memory, so the full resolution data is read once from the TIFFs and is
+never read back from the n5.
+'''
+
+import argparse
+import itertools
+import math
+import numpy as np
+import telemetry
+import zarr
+from concurrent.futures import ThreadPoolExecutor
+
+from create_n5 import get_compressor, parse_shard_chunks, parse_value_range, select_codec
+from dask_cluster import (CHUNK_COPIES, MEMORY_FRACTION, PROCESS_OVERHEAD, add_cluster_arguments,
+                          configure_dask)
+from n5_multiscale import (DOWNSAMPLING_METHODS, PyramidBuilder, add_metadata, add_multiscale,
+                           get_multiscale_shapes, get_s0_manifest, get_slab_shape,
+                           record_multiscale_manifest)
+from n5_utils import (N5ChunkWriter, chunk_intersections, create_chunk_stats,
+                      create_occupancy_index, get_chunk_cache_stats, open_n5_store,
+                      remove_chunk_stats, set_chunk_cache_size)
+from tif_to_n5 import (get_tiff_frame_info, get_tiff_frames, read_tiff_slab,
+                       sample_tiff_chunks, sample_tiff_value_range, tif_series_to_n5_volume)
+
+
+def get_ingest_memory(slab_shape, chunk_size, dtype, workers, prefetch=True,
+                      downsampling_factors=(2, 2, 2), nlevels=0, frame_shape=None):
+    '''
+    Returns an estimate of the bytes used by ingest_tif_series: the current slab
+    and, with prefetch, the next one, the downsampled blocks of a slab at each of
+    the nlevels levels and the float64 reduction of the largest one, the chunks of
+    each level accumulated by the PyramidBuilder (the level region of a slab
+    rounded out to whole chunks, since the slabs are added so that they complete
+    the chunks of the coarser levels first), the CHUNK_COPIES buffers of the chunk
+    being compressed by each worker and, if the slabs are narrower than the
+    (y,x) frame_shape, a whole frame decoded by each worker.
+    The chunk cache is disabled during the ingestion, so it is not counted.
+    '''
+    itemsize = np.dtype(dtype).itemsize
+    voxels = int(np.prod(slab_shape)) * (2 if prefetch else 1)
+    reduction_bytes = 0
+    for idx in range(1, nlevels + 1):
+        level_shape = [-(-s // int(math.pow(f, idx))) for s, f in zip(slab_shape, downsampling_factors)]
+        voxels += int(np.prod(level_shape))
+        voxels += int(np.prod([max(1, -(-s // c)) * c for s, c in zip(level_shape, chunk_size)]))
+        reduction_bytes = max(reduction_bytes, int(np.prod(level_shape)) * 8)
+    voxels += int(np.prod(chunk_size)) * CHUNK_COPIES * workers
+    if frame_shape is not None and any([s < f for s, f in zip(slab_shape[1:], frame_shape)]):
+        voxels += int(np.prod(frame_shape)) * workers
+    return voxels * itemsize + reduction_bytes
+
+
+@telemetry.stage('ingest')
+def ingest_tif_series(input_path, output_path, data_set, compressor,
+                      chunk_size=(512, 512, 512),
+                      dtype='same',
+                      img_fname_pattern='*.tif',
+                      downsampling_factors=(2, 2, 2),
+                      downsampling_method=np.mean,
+                      thumbnail_size_yx=None,
+                      workers=1,
+                      chunk_stats=True,
+                      stats_bins=256,
+                      stats_range=None,
+                      shard_chunks=None,
+                      slab_size=None,
+                      prefetch=True,
+                      memory_limit=None):
+    '''
+    Convert TIFF slices into the "s0" data set of the data_set group and generate
+    the downsampled levels s1, s2, etc. from the same slabs. The TIFFs are read one
+    slab at a time, and with prefetch the next slab is read while the current one
+    is compressed and written, so about two slabs plus the partially accumulated
+    chunks of the downsampled levels are kept in memory.
+    If shard_chunks is set, all the levels are written to a sharded zarr v3 container
+    with shard_chunks (z,y,x) chunks per shard file, see n5_utils.ShardedStore.
+    slab_size: (z,y,x) size of the slabs, rounded up to the chunks and the downsampling
+               windows (see get_slab_shape). By default the slabs span whole frames
+               and one chunk in depth. Smaller y,x tiles bound the memory of large
+               frames, but every frame is then decoded once per tile.
+    memory_limit: bytes available to the ingestion; a ValueError is raised if the
+                  slabs do not fit, see get_ingest_memory
+    '''
+    frames = get_tiff_frames(input_path + '/' + img_fname_pattern)
+    frame_shape, frame_dtype = get_tiff_frame_info(frames[0])
+    volume_shape = (len(frames),) + frame_shape
+    dtype = np.dtype(frame_dtype if dtype == 'same' else dtype)
+    if shard_chunks:
+        # shards hold little endian chunks, unlike the big endian n5 chunks
+        dtype = dtype.newbyteorder('<')
+    chunk_size = tuple(chunk_size)
+    shapes = get_multiscale_shapes(volume_shape, downsampling_factors,
+                                   thumbnail_size_yx or chunk_size)
+    nlevels = len(shapes) - 1
+    # By default the slabs span whole frames, with a depth aligned to the chunks
+    # and the cumulated downsampling factors
+    slab_shape = get_slab_shape(chunk_size, downsampling_factors, nlevels,
+                                slab_size or (chunk_size[0],) + frame_shape)
+    # no larger than the volume
+    max_shape = get_slab_shape(chunk_size, downsampling_factors, nlevels, volume_shape)
+    slab_shape = tuple([min(s, m) for s, m in zip(slab_shape, max_shape)])
+    memory = get_ingest_memory(slab_shape, chunk_size, dtype, workers, prefetch,
+                               downsampling_factors=downsampling_factors, nlevels=nlevels,
+                               frame_shape=frame_shape)
+    if memory_limit and memory > memory_limit:
+        raise ValueError(f'Slabs of {slab_shape} need about {memory / 2**20:.1f} MiB, more than the '
+                         f'{memory_limit / 2**20:.1f} MiB available: use a smaller slab size '
+                         'or disable the prefetch')
+    fullscale = f'{data_set}/s0'
+
+    print("Ingesting volume")
+    print(f"  compressor: {compressor}")
+    print(f"  shape:      {volume_shape}")
+    print(f"  chunking:   {chunk_size}")
+    print(f"  dtype:      {dtype}")
+    print(f"  levels:     {nlevels + 1}")
+    print(f"  slabs:      {slab_shape} (about {memory / 2**20:.1f} MiB in memory)")
+    if shard_chunks:
+        print(f"  shards:     {shard_chunks} chunks")
+    print(f"  to path:    {output_path}{fullscale}")
+
+    zarr.create(shape=volume_shape, chunks=chunk_size, dtype=dtype, compressor=compressor,
+                store=open_n5_store(output_path, shard_chunks), path=fullscale, overwrite=True)
+    create_occupancy_index(output_path, fullscale)
+    if chunk_stats:
+        if stats_range is None:
+            stats_range = sample_tiff_value_range(input_path + '/' + img_fname_pattern, dtype,
+                                                  workers=workers)
+        print(f"Chunk statistics histograms: {stats_bins} bins over {stats_range}")
+        create_chunk_stats(output_path, fullscale, bins=stats_bins, value_range=stats_range)
+    else:
+        remove_chunk_stats(output_path, fullscale)
+    s0_writer = N5ChunkWriter(output_path, fullscale, autoflush=False)
+    builder = None
+    if nlevels > 0:
+        builder = PyramidBuilder(output_path, data_set, shapes, chunk_size, dtype, slab_shape,
+                                 downsampling_factors=downsampling_factors,
+                                 downsampling_method=downsampling_method,
+                                 compressor=compressor,
+                                 chunk_stats=chunk_stats,
+                                 shard_chunks=shard_chunks)
+
+    def read_slab(origin):
+        regions = tuple([slice(o, min(o + s, d)) for o, s, d in zip(origin, slab_shape, volume_shape)])
+        slab = read_tiff_slab(frames, regions, workers)
+        return slab if slab.dtype == dtype else slab.astype(dtype)
+
+    def write_chunk(region, data):
+        s0_writer[region] = data
+
+    # the chunks are never read back, so the chunk cache is not needed, see get_ingest_memory
+    cache_size = get_chunk_cache_stats()['max_bytes']
+    set_chunk_cache_size(0)
+    if builder:
+        origins = builder.slab_origins()
+    else:
+        origins = list(itertools.product(*[range(0, d, s) for d, s in zip(volume_shape, slab_shape)]))
+    with ThreadPoolExecutor(max_workers=1) as reader, \
+            ThreadPoolExecutor(max_workers=workers) as writer:
+        next_slab = reader.submit(read_slab, origins[0]) if prefetch else None
+        for i, origin in enumerate(origins):
+            slab = next_slab.result() if prefetch else read_slab(origin)
+            if prefetch:
+                next_slab = reader.submit(read_slab, origins[i + 1]) if i + 1 < len(origins) else None
+            end = [o + s for o, s in zip(origin, slab.shape)]
+            print("Saving slab", tuple(origin), tuple(end))
+            with telemetry.stage('slab', start=list(origin), end=end):
+                writes = [writer.submit(write_chunk, region, slab[block_region])
+                          for _, region, block_region, _ in chunk_intersections(
+                              volume_shape, chunk_size, origin, end)]
+                if builder:
+                    builder.add_slab(origin, slab, writer)
+                for w in writes:
+                    w.result()
+                s0_writer.flush()
+            del slab
+    set_chunk_cache_size(cache_size)
+
+    if builder:
+        record_multiscale_manifest(output_path, data_set, get_s0_manifest(output_path, data_set))
+    print(f'Ingested {volume_shape} into {nlevels + 1} levels of {output_path}{data_set}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert a TIFF series to an n5 volume with its multiscale pyramid and metadata')
+
+    parser.add_argument('-i', '--input', dest='input_path', type=str, required=True,
+                        help='Path to the directory containing the TIFF series')
+
+    parser.add_argument('--input_name_pattern', dest='input_name_pattern',
+                        type=str, default='*.tif',
+                        help='Input file name pattern')
+
+    parser.add_argument('-o', '--output', dest='output_path', type=str, required=True,
+                        help='Path to the n5 directory')
+
+    parser.add_argument('-d', '--data_set', dest='data_set', type=str, default='',
+                        help='Path to the group of the pyramid data sets ' +
+                        '(default empty, so the levels are /s0, /s1, etc.)')
+
+    parser.add_argument('-c', '--chunk_size', dest='chunk_size', type=str, default="512,512,512",
+                        help='Comma-delimited list describing the chunk size. Default is 512,512,512.')
+
+    parser.add_argument('--dtype', dest='dtype', type=str, default='same',
+                        help='Set the output dtype. Default is the same dtype as the TIFFs.')
+
+    parser.add_argument('--compression', dest='compression', type=str, default='bz2',
+                        help='Set the compression, e.g. raw, lz4, gzip:6, bz2, blosc:zstd:5, or "auto" ' +
+                        'to select the fastest N5 codec (raw, gzip, bz2, xz or blosc) reaching --target_ratio. Default is bz2.')
+
+    parser.add_argument('--target_ratio', dest='target_ratio', type=float, default=2.0,
+                        help='Compression ratio required from the codec selected by --compression auto. Default is 2.')
+
+    parser.add_argument('-f', '--downsampling_factors', dest='downsampling_factors', type=str, default="2,2,2",
+                        help='Downsampling factors for each dimension (default "2,2,2")')
+
+    parser.add_argument('-m', '--method', dest='method', type=str, default='mean',
+                        choices=list(DOWNSAMPLING_METHODS.keys()),
+                        help='Downsampling method (default "mean"). Use "mode", "max", "min" or "any" ' +
+                        'for label or mask volumes')
+
+    parser.add_argument('-p', '--pixel_res', dest='pixel_res', type=str,
+                        help='Pixel resolution for each dimension "2.0,2.0,2.0" (default None) - required for Neuroglancer')
+
+    parser.add_argument('-u', '--pixel_res_units', dest='pixel_res_units', type=str, default="nm",
+                        help='Measurement unit for --pixel_res (default "nm") - required for Neuroglancer')
+
+    parser.add_argument('--workers', dest='workers', type=int,
+                        help='Number of threads reading frames and writing chunks, or of dask workers ' +
+                        'with --separate_steps --distributed. By default it is chosen from the CPU ' +
+                        'and memory limits of the container.')
+
+    parser.add_argument('--no_chunk_stats', dest='chunk_stats', action='store_false',
+                        help='Do not record the per-chunk statistics (min, max, histogram) while writing')
+    parser.set_defaults(chunk_stats=True)
+
+    parser.add_argument('--stats_bins', dest='stats_bins', type=int, default=256,
+                        help='Number of bins of the per-chunk histograms (default 256)')
+
+    parser.add_argument('--stats_range', dest='stats_range', type=str, metavar='min,max',
+                        help='Value range of the per-chunk histograms. By default it is the range ' +
+                        'of the values of a few frames spread through the stack.')
+
+    parser.add_argument('--shard_chunks', dest='shard_chunks', type=str,
+                        help='Write a sharded zarr v3 container with OME-Zarr metadata instead of an n5, ' +
+                        'with this comma-delimited number of chunks per shard file along z,y,x, e.g. 4,4,4. ' +
+                        'Default is no sharding.')
+
+    parser.add_argument('--slab_size', dest='slab_size', type=str, metavar='z,y,x',
+                        help='Size of the slabs read from the TIFFs, rounded up to the chunks. ' +
+                        'Default is one chunk in depth and whole frames. Smaller y,x tiles bound ' +
+                        'the memory used for large frames, but each frame is decoded once per tile.')
+
+    parser.add_argument('--no_prefetch', dest='prefetch', action='store_false',
+                        help='Do not read the next slab while the current one is written, ' +
+                        'which keeps a single slab in memory')
+    parser.set_defaults(prefetch=True)
+
+    parser.add_argument('--separate_steps', dest='separate_steps', action='store_true',
+                        help='Run tif_to_n5, n5_multiscale and the metadata update one after the other, ' +
+                        'reading s0 back from the n5 to generate the pyramid')
+    parser.set_defaults(separate_steps=False)
+
+    parser.add_argument('--engine', dest='engine', type=str, default='dask', choices=['dask', 'direct'],
+                        help='With --separate_steps, the tif_to_n5 conversion engine (default dask)')
+
+    parser.add_argument('--pipelined', dest='pipelined', action='store_true',
+                        help='With --separate_steps, read the next slice range while the current one is written')
+    parser.set_defaults(pipelined=False)
+
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='With --separate_steps, skip the slice ranges completed by a previous, ' +
+                        'interrupted conversion')
+    parser.set_defaults(resume=False)
+
+    parser.add_argument('--distributed', dest='distributed', action='store_true',
+                        help='With --separate_steps and --engine dask, run the dask steps with the ' +
+                        'distributed scheduler')
+    parser.set_defaults(distributed=False)
+
+    parser.add_argument('--dashboard', dest='dashboard', action='store_true',
+                        help='With --distributed, run a web-based dashboard on port 8787')
+    parser.set_defaults(dashboard=False)
+
+    add_cluster_arguments(parser)
+
+    telemetry.add_telemetry_arguments(parser)
+
+    args = parser.parse_args()
+
+    telemetry.setup_telemetry('ingest', args.telemetry, args.profile)
+
+    if args.resume and not args.separate_steps:
+        parser.error('--resume requires --separate_steps')
+    if args.distributed and not args.separate_steps:
+        parser.error('--distributed requires --separate_steps')
+    if args.distributed and args.engine == 'direct':
+        parser.error('--distributed is not supported with --engine direct')
+    if args.slab_size and args.separate_steps:
+        parser.error('--slab_size is not supported with --separate_steps')
+    if not args.prefetch and args.separate_steps:
+        parser.error('--no_prefetch is not supported with --separate_steps, see --pipelined')
+
+    chunk_size = [int(c) for c in args.chunk_size.split(',')]
+    downsampling_factors = [int(c) for c in args.downsampling_factors.split(',')]
+    downsampling_method = DOWNSAMPLING_METHODS[args.method]
+    shard_chunks = parse_shard_chunks(args.shard_chunks)
+    slab_size = None
+    if args.slab_size:
+        slab_size = [int(c) for c in args.slab_size.split(',')]
+        if len(slab_size) != 3 or min(slab_size) < 1:
+            parser.error(f'--slab_size must be three positive sizes z,y,x, got {args.slab_size}')
+    stats_range = parse_value_range(args.stats_range)
+    pixel_res = None
+    if args.pixel_res:
+        pixel_res = [float(c) for c in args.pixel_res.split(',')]
+    tiff_pattern = args.input_path + '/' + args.input_name_pattern
+    if args.dtype == 'same':
+        itemsize = get_tiff_frame_info(get_tiff_frames(tiff_pattern)[0])[1].itemsize
+    else:
+        itemsize = np.dtype(args.dtype).itemsize
+
+    distributed = args.distributed
+    dashboard_address = None
+    if distributed and args.dashboard:
+        dashboard_address = ":8787"
+        print(f"Starting dashboard on {dashboard_address}")
+
+    layout, client = configure_dask(int(np.prod(chunk_size)) * itemsize,
+                                    distributed=distributed,
+                                    workers=args.workers,
+                                    threads_per_worker=args.threads_per_worker,
+                                    memory_limit=args.memory_limit,
+                                    dashboard_address=dashboard_address)
+    if not distributed:
+        from dask.diagnostics import ProgressBar
+        pbar = ProgressBar()
+        pbar.register()
+
+    if args.compression == 'auto':
+        with telemetry.stage('select_codec'):
+            chunk_samples = sample_tiff_chunks(tiff_pattern, chunk_size, workers=layout['threads'])
+            compressor = get_compressor(select_codec(chunk_samples, args.target_ratio))
+    else:
+        compressor = get_compressor(args.compression)
+
+    if args.separate_steps:
+        tif_series_to_n5_volume(args.input_path, args.output_path, f'{args.data_set}/s0',
+                                compressor,
+                                chunk_size=chunk_size,
+                                dtype=args.dtype,
+                                img_fname_pattern=args.input_name_pattern,
+                                pipelined=args.pipelined,
+                                resume=args.resume,
+                                workers=layout['threads'],
+                                engine=args.engine,
+                                chunk_stats=args.chunk_stats,
+                                stats_bins=args.stats_bins,
+                                stats_range=stats_range,
+                                shard_chunks=shard_chunks)
+        add_multiscale(args.output_path, args.data_set,
+                       downsampling_factors=downsampling_factors,
+                       downsampling_method=downsampling_method,
+                       chunk_stats=args.chunk_stats)
+    else:
+        ingest_tif_series(args.input_path, args.output_path, args.data_set, compressor,
+                          chunk_size=chunk_size,
+                          dtype=args.dtype,
+                          img_fname_pattern=args.input_name_pattern,
+                          downsampling_factors=downsampling_factors,
+                          downsampling_method=downsampling_method,
+                          workers=layout['threads'],
+                          chunk_stats=args.chunk_stats,
+                          stats_bins=args.stats_bins,
+                          stats_range=stats_range,
+                          shard_chunks=shard_chunks,
+                          slab_size=slab_size,
+                          prefetch=args.prefetch,
+                          memory_limit=int(layout['memory'] * MEMORY_FRACTION) - PROCESS_OVERHEAD)
+
+    add_metadata(args.output_path, downsampling_factors=downsampling_factors,
+                 pixel_res=pixel_res, pixel_res_units=args.pixel_res_units)
+
+
+if __name__ == "__main__":
+    main()
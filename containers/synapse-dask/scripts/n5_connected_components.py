@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+'''
+Blockwise connected components labeling of an n5 data set. Each block is labeled
+independently, the labels touching across block boundaries are merged with a global
+union-find, and the components smaller than the minimum size are removed.
+'''
+
+import argparse
+import csv
+import itertools
+import os
+import numpy as np
+import telemetry
+import zarr
+from concurrent.futures import ProcessPoolExecutor
+from scipy import ndimage
+
+from n5_utils import (close_n5_arrays, create_occupancy_index, get_block_boxes,
+                      get_n5_path, is_n5_region_empty, read_n5_block, remove_chunk_stats,
+                      write_n5_block)
+
+# Neighborhood shapes accepted for --shape, mapped to the connectivity rank
+# used by ndimage.generate_binary_structure
+CONNECTIVITY = {
+    '6': 1, 'diamond': 1,
+    '18': 2,
+    '26': 3, 'box': 3,
+}
+
+
+def get_structure(shape):
+    '''
+    Returns the 3D structuring element for the given neighborhood shape:
+    6, 18 or 26 connectivity ("diamond" and "box" are aliases for 6 and 26)
+    '''
+    if str(shape) not in CONNECTIVITY:
+        raise ValueError(f'Invalid neighborhood shape: {shape}')
+    return ndimage.generate_binary_structure(3, CONNECTIVITY[str(shape)])
+
+
+def label_block(n5_path, data_set, output_path, output_data_set, box, threshold, structure):
+    '''
+    Labels the voxels greater than the threshold in the given x,y,z box and writes the
+    block local labels to the output. Returns the number of labels and, for every label,
+    its voxel count and x,y,z bounding box (start inclusive, end exclusive).
+    '''
+    start, end = box
+    if is_n5_region_empty(n5_path, data_set, start, end) and threshold >= 0:
+        return 0, np.zeros(0, dtype=np.int64), np.zeros((0, 3), dtype=np.int64), \
+            np.zeros((0, 3), dtype=np.int64)
+    block = read_n5_block(n5_path, data_set, start, end)
+    labels, nlabels = ndimage.label(block > threshold, structure=structure)
+    counts = np.bincount(labels.ravel(), minlength=nlabels + 1)[1:]
+    bbox_start = np.zeros((nlabels, 3), dtype=np.int64)
+    bbox_end = np.zeros((nlabels, 3), dtype=np.int64)
+    for idx, slices in enumerate(ndimage.find_objects(labels)):
+        bbox_start[idx] = [s.start + o for s, o in zip(slices, start)]
+        bbox_end[idx] = [s.stop + o for s, o in zip(slices, start)]
+    write_n5_block(output_path, output_data_set, start, end, labels)
+    return nlabels, counts, bbox_start, bbox_end
+
+
+def find_block_merges(output_path, output_data_set, box, block_size, shape, offsets, structure):
+    '''
+    Returns the pairs of global labels that are connected across the boundaries
+    of the given x,y,z box. Global labels are the block local labels shifted
+    by the offset of their block.
+    '''
+    start, end = box
+    ext_start = [s - 1 for s in start]
+    ext_end = [e + 1 for e in end]
+    read_start = [max(s, 0) for s in ext_start]
+    read_end = [min(e, d) for e, d in zip(ext_end, shape)]
+    local = read_n5_block(output_path, output_data_set, read_start, read_end)
+
+    # labels of the box extended by one voxel on every side, zero padded outside the volume
+    ext = np.zeros([e - s for s, e in zip(ext_start, ext_end)], dtype=np.int64)
+    for block_index in itertools.product(*[range(s // b, (e - 1) // b + 1)
+                                           for s, e, b in zip(read_start, read_end, block_size)]):
+        if block_index not in offsets:
+            continue
+        region_start = [max(i * b, s) for i, b, s in zip(block_index, block_size, read_start)]
+        region_end = [min((i + 1) * b, e) for i, b, e in zip(block_index, block_size, read_end)]
+        block_labels = local[tuple([slice(rs - s, re - s)
+                                    for rs, re, s in zip(region_start, region_end, read_start)])]
+        ext[tuple([slice(rs - s, re - s) for rs, re, s in zip(region_start, region_end, ext_start)])] = \
+            np.where(block_labels > 0, block_labels.astype(np.int64) + offsets[block_index], 0)
+
+    core_shape = [e - s for s, e in zip(start, end)]
+    pairs = []
+    for d in zip(*np.nonzero(structure)):
+        d = [int(c) - 1 for c in d]
+        for a in [a for a in range(3) if d[a] != 0]:
+            # the boundary plane of the core whose neighbors along d are outside the core
+            core = [slice(1, n + 1) for n in core_shape]
+            core[a] = slice(1, 2) if d[a] < 0 else slice(core_shape[a], core_shape[a] + 1)
+            neighbor = [slice(c.start + o, c.stop + o) for c, o in zip(core, d)]
+            labels = ext[tuple(core)].ravel()
+            neighbor_labels = ext[tuple(neighbor)].ravel()
+            connected = (labels > 0) & (neighbor_labels > 0)
+            pairs.append(np.stack([labels[connected], neighbor_labels[connected]], axis=1))
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def relabel_block(output_path, output_data_set, box, lookup):
+    '''
+    Replaces the block local labels of the given x,y,z box by their final labels
+    '''
+    start, end = box
+    local = read_n5_block(output_path, output_data_set, start, end)
+    write_n5_block(output_path, output_data_set, start, end, lookup[local])
+
+
+def union_find(nlabels, pairs):
+    '''
+    Returns the root of every label in 0..nlabels after merging the given pairs
+    of labels. The roots are the smallest label of each set, so label 0 stays 0.
+    The sets are merged with vectorized hooking and pointer jumping.
+    '''
+    parent = np.arange(nlabels + 1, dtype=np.int64)
+    if len(pairs) == 0:
+        return parent
+    a, b = pairs[:, 0], pairs[:, 1]
+    while True:
+        # compress the paths to the roots
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        root_a, root_b = parent[a], parent[b]
+        different = root_a != root_b
+        if not different.any():
+            return parent
+        # hook the larger root under the smaller one
+        low = np.minimum(root_a[different], root_b[different])
+        high = np.maximum(root_a[different], root_b[different])
+        np.minimum.at(parent, high, low)
+
+
+@telemetry.stage('connected_components')
+def connected_components(n5_path, data_set, output_path, output_data_set,
+                         block_size=None, threshold=0, shape='box',
+                         min_size=0, dtype='uint64', table_path=None, workers=4):
+    '''
+    Label the connected components of the voxels greater than the threshold and write
+    the labels to the output data set. Components with less than min_size voxels are
+    removed and the remaining ones are numbered from 1 in the order of their first block.
+    A CSV table with the voxel count and the bounding box of every label is written
+    to table_path. Returns the number of labels.
+    block_size: x,y,z size of the blocks labeled independently, rounded up to whole
+                chunks (default is the chunk size)
+    '''
+    source = zarr.open(store=zarr.N5Store(n5_path), mode='r')[data_set]
+    structure = get_structure(shape)
+    # zarr uses zyx order
+    volume_shape = tuple(reversed(source.shape))
+    # the blocks are rounded up to whole chunks, so that no two workers write the same chunk
+    block_size = tuple([-(-b // c) * c for b, c in
+                        zip(block_size or reversed(source.chunks), reversed(source.chunks))])
+    boxes = [core_box for core_box, _ in get_block_boxes(volume_shape, block_size)]
+    table_path = table_path or os.path.join(get_n5_path(output_path, output_data_set), 'labels.csv')
+
+    print("Labeling connected components:")
+    print(f"  from:       {n5_path}{data_set}")
+    print(f"  threshold:  {threshold}")
+    print(f"  shape:      {shape}")
+    print(f"  min size:   {min_size}")
+    print(f"  blocks:     {len(boxes)} of {block_size}")
+    print(f"  to path:    {output_path}{output_data_set}")
+
+    out = zarr.open(store=zarr.N5Store(output_path), mode='a')
+    out.create_dataset(output_data_set,
+        shape=source.shape,
+        chunks=source.chunks,
+        dtype=dtype,
+        compressor=source.compressor,
+        overwrite=True)
+    create_occupancy_index(output_path, output_data_set)
+    remove_chunk_stats(output_path, output_data_set)
+
+    # Every pass starts new worker processes without any open arrays, so that
+    # they see the chunks and the occupancy written by the previous pass.
+    # The workers record their own telemetry counters.
+    with telemetry.stage('label_blocks'), \
+            ProcessPoolExecutor(max_workers=workers, initializer=close_n5_arrays) as executor:
+        # 1. label every block independently
+        results = list(executor.map(label_block,
+                                    itertools.repeat(n5_path), itertools.repeat(data_set),
+                                    itertools.repeat(output_path), itertools.repeat(output_data_set),
+                                    boxes, itertools.repeat(threshold), itertools.repeat(structure)))
+        block_counts = [r[0] for r in results]
+        block_offsets = np.concatenate([[0], np.cumsum(block_counts)])
+        nlabels = int(block_offsets[-1])
+        offsets = dict([(tuple([s // b for s, b in zip(box[0], block_size)]), int(offset))
+                        for box, offset, count in zip(boxes, block_offsets, block_counts)
+                        if count > 0])
+    print(f'Found {nlabels} block local labels')
+
+    with telemetry.stage('merge_blocks'), \
+            ProcessPoolExecutor(max_workers=workers, initializer=close_n5_arrays) as executor:
+        # 2. merge the labels connected across block boundaries
+        merges = [m for m in executor.map(find_block_merges,
+                                          itertools.repeat(output_path),
+                                          itertools.repeat(output_data_set),
+                                          [b for b, c in zip(boxes, block_counts) if c > 0],
+                                          itertools.repeat(block_size),
+                                          itertools.repeat(volume_shape),
+                                          itertools.repeat(offsets),
+                                          itertools.repeat(structure))]
+    pairs = np.concatenate(merges) if merges else np.zeros((0, 2), dtype=np.int64)
+    roots = union_find(nlabels, pairs)
+
+    # 3. filter the components by size and number them consecutively
+    counts = np.concatenate([np.zeros(1, dtype=np.int64)] + [r[1] for r in results])
+    component_counts = np.bincount(roots, weights=counts, minlength=nlabels + 1)
+    kept = np.flatnonzero(component_counts >= max(min_size, 1))
+    kept = kept[kept > 0]
+    if len(kept) > np.iinfo(dtype).max:
+        raise ValueError(f'{len(kept)} labels do not fit in {dtype}')
+    final = np.zeros(nlabels + 1, dtype=dtype)
+    final[kept] = np.arange(1, len(kept) + 1, dtype=dtype)
+    lookup = final[roots]
+    print(f'Merged into {len(np.unique(roots)) - 1} components, kept {len(kept)} '
+          f'with at least {min_size} voxels')
+
+    write_label_table(table_path, lookup, counts, results)
+
+    with telemetry.stage('relabel_blocks'), \
+            ProcessPoolExecutor(max_workers=workers, initializer=close_n5_arrays) as executor:
+        relabels = [executor.submit(relabel_block, output_path, output_data_set, box,
+                                    np.concatenate([final[:1], lookup[offset + 1:offset + count + 1]]))
+                    for box, offset, count in zip(boxes, block_offsets, block_counts)
+                    if count > 0]
+        for r in relabels:
+            r.result()
+
+    print(f'Wrote {len(kept)} labels to {output_path}{output_data_set} and {table_path}')
+    return len(kept)
+
+
+def write_label_table(table_path, lookup, counts, block_results):
+    '''
+    Write the voxel count and the x,y,z bounding box (end exclusive) of every final label
+    '''
+    lookup = lookup.astype(np.int64)
+    nlabels = int(lookup.max()) if len(lookup) else 0
+    label_counts = np.bincount(lookup, weights=counts, minlength=nlabels + 1).astype(np.int64)
+    bbox_start = np.full((nlabels + 1, 3), np.iinfo(np.int64).max, dtype=np.int64)
+    bbox_end = np.zeros((nlabels + 1, 3), dtype=np.int64)
+    local_start = np.concatenate([np.zeros((1, 3), dtype=np.int64)] + [r[2] for r in block_results])
+    local_end = np.concatenate([np.zeros((1, 3), dtype=np.int64)] + [r[3] for r in block_results])
+    np.minimum.at(bbox_start, lookup, local_start)
+    np.maximum.at(bbox_end, lookup, local_end)
+    with open(table_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['label', 'voxels', 'x1', 'y1', 'z1', 'x2', 'y2', 'z2'])
+        for label in range(1, nlabels + 1):
+            writer.writerow([label, label_counts[label]] +
+                            list(bbox_start[label]) + list(bbox_end[label]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Blockwise connected components labeling of an n5 data set')
+
+    parser.add_argument('-i', '--input', dest='input_path', type=str, required=True, \
+        help='Path to the directory containing the n5 volume')
+
+    parser.add_argument('-d', '--data_set', dest='data_set', type=str, default='/s0', \
+        help='Path to the input data set (default "/s0")')
+
+    parser.add_argument('-o', '--output', dest='output_path', type=str, \
+        help='Path to the output n5 (default is the input n5)')
+
+    parser.add_argument('--output_data_set', dest='output_data_set', type=str, required=True, \
+        help='Path to the output label data set')
+
+    parser.add_argument('-t', '--threshold', dest='threshold', type=float, default=0, \
+        help='Voxels greater than the threshold are foreground (default 0)')
+
+    parser.add_argument('-s', '--shape', dest='shape', type=str, default='box', \
+        help='Neighborhood shape: 6, 18 or 26 connectivity, or "diamond" (6) or "box" (26). Default is box.')
+
+    parser.add_argument('-m', '--min_size', dest='min_size', type=int, default=0, \
+        help='Minimum number of voxels in a connected component to be kept (default 0)')
+
+    parser.add_argument('-b', '--block_size', dest='block_size', type=str, \
+        help='Comma-delimited x,y,z size of the labeled blocks, rounded up to a multiple of the ' + \
+             'chunk size (default is the chunk size)')
+
+    parser.add_argument('--dtype', dest='dtype', type=str, default='uint64', \
+        help='Label data type, uint32 or uint64 (default uint64)')
+
+    parser.add_argument('--table', dest='table_path', type=str, \
+        help='Path of the CSV table of label sizes and bounding boxes ' + \
+             '(default is labels.csv in the output data set directory)')
+
+    parser.add_argument('--workers', dest='workers', type=int, default=4, \
+        help='Number of worker processes (default 4)')
+
+    telemetry.add_telemetry_arguments(parser)
+
+    args = parser.parse_args()
+
+    telemetry.setup_telemetry('n5_connected_components', args.telemetry, args.profile)
+
+    if args.dtype not in ['uint32', 'uint64']:
+        parser.error('The label data type must be uint32 or uint64')
+    if args.shape not in CONNECTIVITY:
+        parser.error(f'Invalid neighborhood shape: {args.shape}')
+
+    block_size = None
+    if args.block_size:
+        block_size = [int(c) for c in args.block_size.split(',')]
+
+    connected_components(args.input_path, args.data_set,
+                         args.output_path or args.input_path, args.output_data_set,
+                         block_size=block_size,
+                         threshold=args.threshold,
+                         shape=args.shape,
+                         min_size=args.min_size,
+                         dtype=args.dtype,
+                         table_path=args.table_path,
+                         workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
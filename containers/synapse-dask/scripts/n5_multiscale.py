@@ -4,15 +4,76 @@ Add multiscale imagery to n5 volume
 '''
 
 import argparse
+import base64
+import itertools
 import math
+import os
+import zlib
 import numpy as np
 import dask.array as da
+import telemetry
 import zarr
+from concurrent.futures import ThreadPoolExecutor
 from zarr.errors import PathNotFoundError
 from xarray_multiscale import multiscale
 
+from dask_cluster import add_cluster_arguments, configure_dask, flush_chunk_stats
+from n5_utils import (N5ChunkWriter, ShardedStore, chunk_intersections, create_chunk_stats,
+                      create_occupancy_index, downsample_block, get_chunk_region,
+                      get_chunk_stats, get_n5_path, get_shard_chunks, is_sharded, open_n5_store,
+                      relative_region, remove_chunk_stats, sample_value_range)
+
+def windowed_mode(windows, axis=None):
+    '''
+    Reduce the windows along the given axes to their most frequent value.
+    Ties are resolved to the smallest value.
+    '''
+    axis = tuple(range(windows.ndim)) if axis is None else tuple(axis)
+    outer_ndim = windows.ndim - len(axis)
+    moved = np.moveaxis(windows, axis, tuple(range(outer_ndim, windows.ndim)))
+    # explicit window size, since -1 cannot be inferred when an outer dimension is 0
+    window_size = int(np.prod([windows.shape[a] for a in axis]))
+    values = np.sort(moved.reshape(moved.shape[0:outer_ndim] + (window_size,)), axis=-1)
+    if values.size == 0:
+        return np.zeros(values.shape[0:outer_ndim], dtype=windows.dtype)
+    # position within the run of equal values, for each position of the sorted windows
+    positions = np.arange(values.shape[-1])
+    run_starts = np.ones(values.shape, dtype=bool)
+    run_starts[..., 1:] = values[..., 1:] != values[..., :-1]
+    run_offsets = positions - np.maximum.accumulate(np.where(run_starts, positions, 0), axis=-1)
+    longest = np.argmax(run_offsets, axis=-1)
+    return np.take_along_axis(values, longest[..., np.newaxis], axis=-1)[..., 0]
+
+
+def windowed_any(windows, axis=None):
+    '''
+    Reduce the windows along the given axes to 1 if any value is non-zero, otherwise to 0
+    '''
+    return np.any(windows != 0, axis=axis).astype(windows.dtype)
+
+
+# Reducers that can be used for downsampling. Mode, max, min and any preserve label values,
+# so they are suitable for segmentation and mask volumes.
+DOWNSAMPLING_METHODS = {
+    'mean': np.mean,
+    'mode': windowed_mode,
+    'max': np.max,
+    'min': np.min,
+    'any': windowed_any,
+}
+
+
+# OME-Zarr names of the usual --pixel_res_units
+OME_UNITS = {
+    'nm': 'nanometer',
+    'um': 'micrometer',
+    'µm': 'micrometer',
+    'mm': 'millimeter',
+}
+
+
 def add_metadata(n5_path, downsampling_factors=(2,2,2), axes=("x","y","z"), pixel_res=None, pixel_res_units="nm"):
-    store = zarr.N5Store(n5_path)
+    store = open_n5_store(n5_path)
     scales = []
 
     for idx in range(20):
@@ -37,22 +98,70 @@ def add_metadata(n5_path, downsampling_factors=(2,2,2), axes=("x","y","z"), pixe
             "dimensions": pixel_res,
             "unit": pixel_res_units
         }
+    if is_sharded(n5_path):
+        z.attrs["ome"] = get_ome_metadata(scales, axes, pixel_res, pixel_res_units)
     print("Added multiscale metadata to", n5_path)
 
 
+def get_ome_metadata(scales, axes=("x","y","z"), pixel_res=None, pixel_res_units="nm"):
+    '''
+    Returns the OME-Zarr 0.5 multiscales metadata of the levels s0, s1, etc.
+    with the given x,y,z downsampling factors. OME-Zarr lists the axes and
+    the scales in array order, i.e. z,y,x.
+    '''
+    ome_axes = []
+    for axis in reversed(axes):
+        ome_axis = {"name": axis, "type": "space"}
+        if pixel_res:
+            ome_axis["unit"] = OME_UNITS.get(pixel_res_units, pixel_res_units)
+        ome_axes.append(ome_axis)
+    resolution = pixel_res or [1.0] * len(axes)
+    datasets = [{
+        "path": f"s{idx}",
+        "coordinateTransformations": [{
+            "type": "scale",
+            "scale": [float(r * f) for r, f in zip(reversed(resolution), reversed(factors))],
+        }],
+    } for idx, factors in enumerate(scales)]
+    return {
+        "version": "0.5",
+        "multiscales": [{"axes": ome_axes, "datasets": datasets}],
+    }
+
+
+def create_level_stats(n5_path, data_set, component):
+    '''
+    Starts collecting the chunk statistics of a new pyramid level, with the
+    histogram bins and value range of the statistics of s0: the downsampled
+    values stay within the values of s0. Without s0 statistics, the range
+    is sampled from the s0 chunks.
+    '''
+    s0_stats = get_chunk_stats(n5_path, f'{data_set}/s0')
+    if s0_stats.exists():
+        create_chunk_stats(n5_path, component, bins=s0_stats.bins, value_range=s0_stats.value_range)
+    else:
+        create_chunk_stats(n5_path, component,
+                           value_range=sample_value_range(n5_path, f'{data_set}/s0'))
+
+
+@telemetry.stage('multiscale')
 def add_multiscale(n5_path, data_set, downsampling_factors=(2,2,2), \
-        downsampling_method=np.mean, thumbnail_size_yx=None):
+        downsampling_method=np.mean, thumbnail_size_yx=None, chunk_stats=True, shard_chunks=None):
     '''
     Given an n5 with "s0", generate downsampled versions s1, s2, etc., up to the point where
     the smallest version is larger than thumbnail_size_yx (which defaults to the chunk size).
+    Unless chunk_stats is False, the statistics of every chunk of the new levels are recorded.
+    In a sharded container the levels have the shards of s0, unless shard_chunks is set.
     '''
     print('Generating multiscale for', n5_path)
-    store = zarr.N5Store(n5_path)
+    fullscale = f'{data_set}/s0'
+    shard_chunks = get_level_shard_chunks(n5_path, fullscale, shard_chunks)
+    store = open_n5_store(n5_path, shard_chunks)
 
     # Find out what compression is used for s0, so we can use the same for the multiscale
-    fullscale = f'{data_set}/s0'
     r = zarr.open(store=store, mode='r')
     compressor = r[fullscale].compressor
+    s0_manifest = get_s0_manifest(n5_path, data_set)
 
     volume = da.from_zarr(store, component=fullscale)
     chunk_size = volume.chunksize
@@ -67,17 +176,478 @@ def add_multiscale(n5_path, data_set, downsampling_factors=(2,2,2), \
         print(f'Saving level {idx}')
         component = f'{data_set}/s{idx}'
 
-        m.data.to_zarr(store, 
-                       component=component, 
-                       overwrite=True, 
-                       compressor=compressor)
+        z = zarr.create(shape=m.shape, chunks=chunk_size, dtype=m.data.dtype,
+                        compressor=compressor, store=store, path=component,
+                        overwrite=True)
+        create_occupancy_index(n5_path, component)
+        if chunk_stats:
+            create_level_stats(n5_path, data_set, component)
+        else:
+            remove_chunk_stats(n5_path, component)
+        # empty chunks are not written, see N5ChunkWriter
+        data = m.data
+        if shard_chunks:
+            # one task per shard, so a shard is written at once
+            data = data.rechunk([c * n for c, n in zip(chunk_size, shard_chunks)])
+        with telemetry.stage('level', level=idx):
+            data.store(N5ChunkWriter(n5_path, component), lock=False)
+            # the statistics buffered by the threads and the workers
+            flush_chunk_stats()
 
-        z = zarr.open(store, path=component, mode='a')
         z.attrs["downsamplingFactors"] = tuple([int(math.pow(f,idx)) for f in downsampling_factors])
 
+    if len(multi_to_save) > 1:
+        record_multiscale_manifest(n5_path, data_set, s0_manifest)
+
+    print("Added multiscale imagery to", n5_path)
+
+
+def get_level_shard_chunks(n5_path, fullscale, shard_chunks=None):
+    '''
+    Returns the number of chunks per shard of the new levels: shard_chunks or, by
+    default, the number of chunks per shard of s0, which is None if s0 is not sharded
+    '''
+    if shard_chunks is None:
+        return get_shard_chunks(n5_path, fullscale)
+    if not is_sharded(n5_path):
+        raise ValueError(f'{n5_path} is not a sharded container, the levels cannot be sharded')
+    return tuple(shard_chunks)
+
+
+def get_multiscale_shapes(shape, downsampling_factors, thumbnail_size_yx):
+    '''
+    Returns the shapes of all pyramid levels, starting with s0, up to the first level
+    that is not larger than thumbnail_size_yx
+    '''
+    shapes = [tuple(shape)]
+    while not np.less_equal(shapes[-1], thumbnail_size_yx).all():
+        next_shape = tuple([s // f for s, f in zip(shapes[-1], downsampling_factors)])
+        if min(next_shape) < 1:
+            break
+        shapes.append(next_shape)
+    return shapes
+
+
+def get_slab_shape(chunk_size, downsampling_factors, nlevels, slab_size=None):
+    '''
+    Returns the shape (in array order) of the s0 slabs used to compute nlevels
+    downsampled levels: slab_size, which defaults to the chunk size, rounded up so
+    that the slabs start on s0 chunk boundaries and on every downsampling window boundary
+    '''
+    alignment = [np.lcm(c, int(math.pow(f, nlevels)))
+                 for c, f in zip(chunk_size, downsampling_factors)]
+    slab_size = slab_size or alignment
+    return tuple([int(math.ceil(s / a) * a) for s, a in zip(slab_size, alignment)])
+
+
+class PyramidBuilder:
+    '''
+    Computes the downsampled levels s1, s2, etc. of a data set from the s0 slabs passed
+    to add_slab. Every level is computed in memory from the previous level of the same
+    slab. Each output chunk is accumulated until all the slabs covering it were added,
+    and then written once, so memory is bounded by about one slab plus the partially
+    accumulated chunks. The slabs are the blocks of s0 at the origins of a grid of
+    slab_shape (see get_slab_shape), and can be added in any order.
+    '''
+
+    def __init__(self, n5_path, data_set, shapes, chunk_size, dtype, slab_shape,
+                 downsampling_factors=(2,2,2), downsampling_method=np.mean,
+                 compressor=None, chunk_stats=True, create=True, shard_chunks=None):
+        '''
+        shapes: shapes of all the levels, starting with s0 (see get_multiscale_shapes)
+        create: create the levels, otherwise open the existing ones, see resume_after
+        chunk_stats: record the statistics of every chunk of the new levels
+        shard_chunks: number of chunks per shard of the levels of a sharded container
+        '''
+        self.shapes = shapes
+        self.nlevels = len(shapes) - 1
+        self.chunk_size = tuple(chunk_size)
+        self.dtype = np.dtype(dtype)
+        self.slab_shape = tuple(slab_shape)
+        self.downsampling_factors = downsampling_factors
+        self.downsampling_method = downsampling_method
+        self.level_factors = [tuple([int(math.pow(f, idx)) for f in downsampling_factors])
+                              for idx in range(self.nlevels + 1)]
+        store = open_n5_store(n5_path, shard_chunks)
+        self.levels = [None]
+        for idx in range(1, self.nlevels + 1):
+            component = f'{data_set}/s{idx}'
+            if create:
+                level = zarr.create(shape=shapes[idx], chunks=chunk_size, dtype=dtype,
+                                    compressor=compressor, store=store, path=component,
+                                    overwrite=True)
+                level.attrs['downsamplingFactors'] = self.level_factors[idx]
+                create_occupancy_index(n5_path, component)
+                if chunk_stats:
+                    create_level_stats(n5_path, data_set, component)
+                else:
+                    remove_chunk_stats(n5_path, component)
+            else:
+                level = zarr.open(store, path=component, mode='a')
+            self.levels.append(level)
+        self.writers = [None] + [N5ChunkWriter(n5_path, f'{data_set}/s{idx}', autoflush=False)
+                                 for idx in range(1, self.nlevels + 1)]
+        # slabs already added to partially accumulated chunks of a previous run
+        self.processed = [{} for _ in self.levels]
+        # chunks being accumulated: chunk index -> [data, number of missing slabs]
+        self.pending = [{} for _ in self.levels]
+
+    def slab_origins(self):
+        '''
+        Returns the origins of all the slabs, ordered so that the slabs contributing
+        to the same output chunk are processed together, from the coarsest level to
+        the finest. This order completes the output chunks as early as possible.
+        '''
+        slab_grid = [range(0, d, s) for d, s in zip(self.shapes[0], self.slab_shape)]
+
+        def slab_order(origin):
+            return tuple([tuple([o // (c * f) for o, c, f in
+                                 zip(origin, self.chunk_size, self.level_factors[idx])])
+                          for idx in range(self.nlevels, 0, -1)]) + (origin,)
+
+        return sorted(itertools.product(*slab_grid), key=slab_order)
+
+    def resume_after(self, origins):
+        '''
+        Count what the slabs at the given origins contributed in an interrupted run,
+        so that the partially accumulated chunks are reloaded from their checkpoint
+        '''
+        for origin in origins:
+            for idx in range(1, self.nlevels + 1):
+                start, end = self.level_region(idx, origin)
+                for chunk_index, _, _, _ in chunk_intersections(self.shapes[idx], self.chunk_size,
+                                                                start, end):
+                    self.processed[idx][chunk_index] = self.processed[idx].get(chunk_index, 0) + 1
+
+    def level_region(self, idx, origin):
+        '''
+        Returns the [start, end) region of level idx computed from the slab at origin
+        '''
+        start = [o // f for o, f in zip(origin, self.level_factors[idx])]
+        end = [min((o + s) // f, d) for o, s, f, d in
+               zip(origin, self.slab_shape, self.level_factors[idx], self.shapes[idx])]
+        return start, end
+
+    def contributing_slabs(self, idx, chunk_index):
+        '''
+        Returns the number of slabs that contribute to the given chunk of level idx
+        '''
+        count = 1
+        for r, f, s in zip(get_chunk_region(self.shapes[idx], self.chunk_size, chunk_index),
+                           self.level_factors[idx], self.slab_shape):
+            count *= int(math.ceil(r.stop * f / s)) - (r.start * f) // s
+        return count
+
+    def _accumulator(self, idx, chunk_index):
+        if chunk_index not in self.pending[idx]:
+            chunk_region = get_chunk_region(self.shapes[idx], self.chunk_size, chunk_index)
+            done = self.processed[idx].pop(chunk_index, 0)
+            if done:
+                data = self.levels[idx][chunk_region]
+            else:
+                data = np.zeros([r.stop - r.start for r in chunk_region], dtype=self.dtype)
+            self.pending[idx][chunk_index] = [data, self.contributing_slabs(idx, chunk_index) - done]
+        return self.pending[idx][chunk_index]
+
+    def _write_chunk(self, idx, chunk_index, data):
+        self.writers[idx][get_chunk_region(self.shapes[idx], self.chunk_size, chunk_index)] = data
+
+    def add_slab(self, origin, block, executor):
+        '''
+        Downsample the s0 block at the given slab origin into all the levels and write
+        the output chunks it completes with the executor threads
+        '''
+        writes = []
+        for idx in range(1, self.nlevels + 1):
+            start, end = self.level_region(idx, origin)
+            if any([e <= s for s, e in zip(start, end)]):
+                # a thin edge slab does not reach this level and the coarser ones
+                break
+            with telemetry.timed('blocks_downsampled', 'downsample_seconds'):
+                block = downsample_block(block, self.downsampling_factors, self.downsampling_method)
+            for chunk_index, region, block_region, _ in chunk_intersections(
+                    self.shapes[idx], self.chunk_size, start, end):
+                acc = self._accumulator(idx, chunk_index)
+                chunk_region = get_chunk_region(self.shapes[idx], self.chunk_size, chunk_index)
+                acc[0][relative_region(region, chunk_region)] = block[block_region]
+                acc[1] -= 1
+                if acc[1] == 0:
+                    del self.pending[idx][chunk_index]
+                    writes.append(executor.submit(self._write_chunk, idx, chunk_index, acc[0]))
+        for w in writes:
+            w.result()
+        self.flush()
+
+    def checkpoint(self, executor):
+        '''
+        Write the partially accumulated chunks, so that an interrupted run can
+        be resumed after the slabs added so far
+        '''
+        writes = [executor.submit(self._write_chunk, idx, chunk_index, acc[0])
+                  for idx in range(1, self.nlevels + 1)
+                  for chunk_index, acc in self.pending[idx].items()]
+        for w in writes:
+            w.result()
+        self.flush()
+
+    def flush(self):
+        for writer in self.writers[1:]:
+            writer.flush()
+
+
+@telemetry.stage('multiscale_streaming')
+def add_multiscale_streaming(n5_path, data_set, downsampling_factors=(2,2,2), \
+        downsampling_method=np.mean, thumbnail_size_yx=None, slab_size=None, \
+        workers=1, resume=False, checkpoint_interval=10, chunk_stats=True, shard_chunks=None):
+    '''
+    Generate the downsampled levels s1, s2, etc. from "s0" in a single pass over s0.
+    s0 is read in chunk-aligned slabs that are passed to a PyramidBuilder, which keeps
+    memory bounded by about one slab plus one chunk per level.
+
+    slab_size: slab shape (in array order); it is rounded up so that it is aligned
+               with the chunk grid and divisible by the cumulated downsampling factors
+    workers: number of threads used for decoding and encoding chunks
+    resume: continue from the last checkpoint of an interrupted run
+    checkpoint_interval: number of slabs between progress checkpoints
+    chunk_stats: record the statistics of every chunk of the new levels
+    shard_chunks: number of chunks per shard of the levels of a sharded container
+                  (default is the sharding of s0)
+    '''
+    print('Generating multiscale for', n5_path)
+    fullscale = f'{data_set}/s0'
+    shard_chunks = get_level_shard_chunks(n5_path, fullscale, shard_chunks)
+    store = open_n5_store(n5_path, shard_chunks)
+
+    # Find out what compression is used for s0, so we can use the same for the multiscale
+    s0 = zarr.open(store=store, mode='r')[fullscale]
+    chunk_size = s0.chunks
+    s0_manifest = get_s0_manifest(n5_path, data_set)
+    thumbnail_size_yx = thumbnail_size_yx or chunk_size
+    shapes = get_multiscale_shapes(s0.shape, downsampling_factors, thumbnail_size_yx)
+    nlevels = len(shapes) - 1
+    if nlevels == 0:
+        print('No multiscale levels are needed for', n5_path)
+        return
+
+    slab_shape = get_slab_shape(chunk_size, downsampling_factors, nlevels, slab_size)
+    progress = {
+        'slabShape': list(slab_shape),
+        'levels': nlevels,
+        'downsamplingFactors': list(downsampling_factors),
+        'completedSlabs': 0,
+    }
+
+    first_component = f'{data_set}/s1'
+    completed_slabs = 0
+    resumed = False
+    if resume:
+        try:
+            saved_progress = zarr.open(store, path=first_component, mode='r').attrs.get('multiscaleProgress')
+        except PathNotFoundError:
+            saved_progress = None
+        if saved_progress and all([saved_progress[k] == v for k, v in progress.items() if k != 'completedSlabs']):
+            completed_slabs = saved_progress['completedSlabs']
+            resumed = True
+            print(f'Resuming after {completed_slabs} slabs')
+        elif saved_progress:
+            print('Saved progress does not match the current parameters - starting over')
+
+    builder = PyramidBuilder(n5_path, data_set, shapes, chunk_size, s0.dtype, slab_shape,
+                             downsampling_factors=downsampling_factors,
+                             downsampling_method=downsampling_method,
+                             compressor=s0.compressor,
+                             chunk_stats=chunk_stats,
+                             create=not resumed,
+                             shard_chunks=shard_chunks)
+    slabs = builder.slab_origins()
+    builder.resume_after(slabs[0:completed_slabs])
+    print(f'Processing {len(slabs)} slabs of {slab_shape} into {nlevels} levels')
+
+    def read_chunk(region):
+        with telemetry.timed('chunks_decoded'):
+            return region, s0[region]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for slab_idx in range(completed_slabs, len(slabs)):
+            origin = slabs[slab_idx]
+            slab_end = [min(o + s, d) for o, s, d in zip(origin, slab_shape, s0.shape)]
+            block = np.empty([e - o for o, e in zip(origin, slab_end)], dtype=s0.dtype)
+            regions = [r for _, r, _, _ in chunk_intersections(s0.shape, chunk_size, origin, slab_end)]
+            for region, data in executor.map(read_chunk, regions):
+                block[relative_region(region, [slice(o, None) for o in origin])] = data
+            builder.add_slab(origin, block, executor)
+
+            completed_slabs = slab_idx + 1
+            if completed_slabs % checkpoint_interval == 0 and completed_slabs < len(slabs):
+                # save the partially accumulated chunks before recording the progress
+                builder.checkpoint(executor)
+                progress['completedSlabs'] = completed_slabs
+                builder.levels[1].attrs['multiscaleProgress'] = progress
+                print(f'Completed {completed_slabs} of {len(slabs)} slabs')
+
+    if 'multiscaleProgress' in builder.levels[1].attrs:
+        del builder.levels[1].attrs['multiscaleProgress']
+    record_multiscale_manifest(n5_path, data_set, s0_manifest)
+
     print("Added multiscale imagery to", n5_path)
 
 
+@telemetry.stage('update_multiscale')
+def update_multiscale(n5_path, data_set, dirty_boxes=None, \
+        downsampling_method=np.mean, workers=1):
+    '''
+    Update an existing pyramid after parts of "s0" were rewritten. Only the chunks
+    of s1, s2, etc. that cover the modified regions are recomputed, each level
+    from the previous one.
+
+    dirty_boxes: list of (start, end) x,y,z corners of the modified s0 regions.
+                 If not set, the modified regions are the s0 chunks written or
+                 deleted after the last pyramid update, according to the manifest
+                 recorded in the s1 attributes.
+    '''
+    print('Updating multiscale for', n5_path)
+    store = open_n5_store(n5_path)
+    levels = []
+    for idx in itertools.count():
+        try:
+            zarr.open(store, path=f'{data_set}/s{idx}', mode='r')
+        except PathNotFoundError:
+            break
+        levels.append(zarr.open(store, path=f'{data_set}/s{idx}', mode='r' if idx == 0 else 'a'))
+    if len(levels) < 2:
+        raise ValueError(f'No multiscale pyramid found in {n5_path}{data_set}')
+
+    downsampling_factors = levels[1].attrs['downsamplingFactors']
+    s0_manifest = get_s0_manifest(n5_path, data_set)
+
+    if dirty_boxes is None:
+        manifest = levels[1].attrs.get('multiscaleManifest')
+        if manifest is None:
+            print('No multiscale manifest found - updating all levels')
+            dirty_boxes = [((0, 0, 0), tuple(reversed(levels[0].shape)))]
+        else:
+            dirty_boxes = [tuple(zip(*[(r.start, r.stop) for r in reversed(region)]))
+                           for region in get_chunks_modified_since(n5_path, data_set, manifest,
+                                                                   s0_manifest)]
+        print(f'Found {len(dirty_boxes)} modified s0 regions')
+
+    # dirty regions of the previous level in array order
+    dirty = [(tuple(reversed(start)), tuple(reversed(end))) for start, end in dirty_boxes]
+
+    def update_chunk(idx, chunk_index):
+        level = levels[idx]
+        region = get_chunk_region(level.shape, level.chunks, chunk_index)
+        source_region = tuple([slice(r.start * f, r.stop * f)
+                               for r, f in zip(region, downsampling_factors)])
+        N5ChunkWriter(n5_path, f'{data_set}/s{idx}')[region] = downsample_block(
+            levels[idx - 1][source_region], downsampling_factors, downsampling_method)
+        return region
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for idx in range(1, len(levels)):
+            level = levels[idx]
+            chunks = set()
+            for start, end in dirty:
+                level_start = [s // f for s, f in zip(start, downsampling_factors)]
+                level_end = [int(math.ceil(e / f)) for e, f in zip(end, downsampling_factors)]
+                for chunk_index, _, _, _ in chunk_intersections(level.shape, level.chunks,
+                                                                level_start, level_end):
+                    chunks.add(chunk_index)
+            print(f'Updating {len(chunks)} chunks of level {idx}')
+            regions = executor.map(lambda chunk_index: update_chunk(idx, chunk_index), sorted(chunks))
+            dirty = [([r.start for r in region], [r.stop for r in region]) for region in regions]
+
+    record_multiscale_manifest(n5_path, data_set, s0_manifest)
+    print("Updated multiscale imagery in", n5_path)
+
+
+def _iter_chunk_files(n5_path, data_set):
+    '''
+    Iterates over the chunk files of "s0" and yields (chunk index, mtime) tuples,
+    with the chunk index in array order. The chunks of a sharded s0 have the
+    mtime of their shard file.
+    '''
+    s0_dir = get_n5_path(n5_path, f'{data_set}/s0')
+    if is_sharded(s0_dir):
+        for shard_path, chunk_indexes in ShardedStore(s0_dir).iter_shards():
+            mtime = os.stat(shard_path).st_mtime
+            for chunk_index in chunk_indexes:
+                yield chunk_index, mtime
+        return
+    for dirpath, _, filenames in os.walk(s0_dir):
+        for filename in filenames:
+            relpath = os.path.relpath(os.path.join(dirpath, filename), s0_dir)
+            try:
+                # n5 chunk paths are in x/y/z order
+                n5_chunk_index = [int(p) for p in relpath.split(os.sep)]
+            except ValueError:
+                continue
+            yield tuple(reversed(n5_chunk_index)), os.stat(os.path.join(dirpath, filename)).st_mtime
+
+
+def get_s0_manifest(n5_path, data_set):
+    '''
+    Returns the state of the "s0" chunks: the latest modification time of the
+    chunk files and the bitmap of the stored chunks, in the C order of the chunk
+    grid, packed, compressed and base64 encoded
+    '''
+    s0 = zarr.open(open_n5_store(n5_path), path=f'{data_set}/s0', mode='r')
+    grid = tuple([-(-s // c) for s, c in zip(s0.shape, s0.chunks)])
+    stored = np.zeros(grid, dtype=bool)
+    s0_mtime = 0
+    for chunk_index, chunk_mtime in _iter_chunk_files(n5_path, data_set):
+        if all([i < g for i, g in zip(chunk_index, grid)]):
+            stored[chunk_index] = True
+        s0_mtime = max(s0_mtime, chunk_mtime)
+    return {
+        's0ChunkMtime': s0_mtime,
+        's0Chunks': base64.b64encode(zlib.compress(np.packbits(stored).tobytes())).decode('ascii'),
+    }
+
+
+def _stored_chunks(manifest, grid):
+    '''
+    Returns the bitmap of the stored "s0" chunks recorded in the manifest,
+    or None if the manifest has no bitmap for this chunk grid
+    '''
+    if 's0Chunks' not in manifest:
+        return None
+    packed = np.frombuffer(zlib.decompress(base64.b64decode(manifest['s0Chunks'])), dtype=np.uint8)
+    if len(packed) != -(-int(np.prod(grid)) // 8):
+        return None
+    return np.unpackbits(packed, count=int(np.prod(grid))).astype(bool).reshape(grid)
+
+
+def get_chunks_modified_since(n5_path, data_set, manifest, current_manifest):
+    '''
+    Returns the regions, in array order, of the "s0" chunks written after the
+    manifest was recorded, and of the chunks that were deleted or added since,
+    according to the bitmaps of the stored chunks of both manifests.
+    Deleted chunks, e.g. chunks elided because they only hold the fill value,
+    leave no file with a newer modification time behind.
+    '''
+    s0 = zarr.open(open_n5_store(n5_path), path=f'{data_set}/s0', mode='r')
+    grid = tuple([-(-s // c) for s, c in zip(s0.shape, s0.chunks)])
+    modified = set([chunk_index for chunk_index, chunk_mtime in _iter_chunk_files(n5_path, data_set)
+                    if chunk_mtime > manifest['s0ChunkMtime']])
+    stored = _stored_chunks(manifest, grid)
+    if stored is not None:
+        changed = stored != _stored_chunks(current_manifest, grid)
+        modified.update([tuple([int(i) for i in chunk_index]) for chunk_index in zip(*np.nonzero(changed))])
+    return [get_chunk_region(s0.shape, s0.chunks, chunk_index)
+            for chunk_index in sorted(modified)
+            if all([i < g for i, g in zip(chunk_index, grid)])]
+
+
+def record_multiscale_manifest(n5_path, data_set, manifest):
+    '''
+    Record in the s1 attributes the state of s0 from which the pyramid was generated
+    (see get_s0_manifest), so that later updates only need to recompute what changed since
+    '''
+    z = zarr.open(open_n5_store(n5_path), path=f'{data_set}/s1', mode='a')
+    z.attrs['multiscaleManifest'] = manifest
+
+
 def main():
     parser = argparse.ArgumentParser(description='Add multiscale levels to an existing n5')
 
@@ -90,6 +660,11 @@ def main():
     parser.add_argument('-f', '--downsampling_factors', dest='downsampling_factors', type=str, default="2,2,2", \
         help='Downsampling factors for each dimension (default "2,2,2")')
 
+    parser.add_argument('-m', '--method', dest='method', type=str, default='mean', \
+        choices=list(DOWNSAMPLING_METHODS.keys()), \
+        help='Downsampling method (default "mean"). Use "mode", "max", "min" or "any" ' + \
+             'for label or mask volumes')
+
     parser.add_argument('-p', '--pixel_res', dest='pixel_res', type=str, \
         help='Pixel resolution for each dimension "2.0,2.0,2.0" (default None) - required for Neuroglancer')
 
@@ -100,8 +675,10 @@ def main():
         help='Run with distributed scheduler (default)')
     parser.set_defaults(distributed=False)
 
-    parser.add_argument('--workers', dest='workers', type=int, default=20, \
-        help='If --distributed is set, this specifies the number of workers (default 20)')
+    parser.add_argument('--workers', dest='workers', type=int, \
+        help='If --distributed is set, this specifies the number of workers. ' + \
+             'If --streaming or --update is set, this specifies the number of threads. ' + \
+             'By default it is chosen from the CPU and memory limits of the container.')
 
     parser.add_argument('--dashboard', dest='dashboard', action='store_true', \
         help='If --distributed is set, this runs a web-based dashboard on port 8787')
@@ -111,31 +688,100 @@ def main():
         help='Only fix metadata on an existing multiscale pyramid')
     parser.set_defaults(metadata_only=False)
 
-    args = parser.parse_args()
+    parser.add_argument('--update', dest='update', action='store_true', \
+        help='Only recompute the parts of an existing pyramid that cover modified s0 regions')
+    parser.set_defaults(update=False)
 
-    if args.distributed:
-        dashboard_address = None
-        if args.dashboard: 
-            dashboard_address = ":8787"
-            print(f"Starting dashboard on {dashboard_address}")
+    parser.add_argument('--dirty_box', dest='dirty_boxes', type=str, action='append', metavar='x1,y1,z1,x2,y2,z2', \
+        help='If --update is set, this specifies a modified s0 region. Can be repeated. ' + \
+             'If not set, the modified regions are found from the chunk modification times')
 
-        from dask.distributed import Client
-        client = Client(processes=True, n_workers=args.workers, \
-            threads_per_worker=1, dashboard_address=dashboard_address)
-        
-    else:
+    parser.add_argument('--streaming', dest='streaming', action='store_true', \
+        help='Generate all levels in a single pass over s0, one slab at a time')
+    parser.set_defaults(streaming=False)
+
+    parser.add_argument('--slab_size', dest='slab_size', type=str, \
+        help='If --streaming is set, this specifies the slab size (default is the chunk size)')
+
+    parser.add_argument('--resume', dest='resume', action='store_true', \
+        help='If --streaming is set, this resumes an interrupted run from its last checkpoint')
+    parser.set_defaults(resume=False)
+
+    parser.add_argument('--checkpoint_interval', dest='checkpoint_interval', type=int, default=10, \
+        help='If --streaming is set, this specifies the number of slabs between checkpoints (default 10)')
+
+    parser.add_argument('--no_chunk_stats', dest='chunk_stats', action='store_false', \
+        help='Do not record the per-chunk statistics (min, max, histogram) of the new levels')
+    parser.set_defaults(chunk_stats=True)
+
+    parser.add_argument('--shard_chunks', dest='shard_chunks', type=str, \
+        help='Comma-delimited number of chunks per shard file along z,y,x of the new levels ' + \
+             'of a sharded container (default is the sharding of s0)')
+
+    add_cluster_arguments(parser)
+
+    telemetry.add_telemetry_arguments(parser)
+
+    args = parser.parse_args()
+
+    telemetry.setup_telemetry('n5_multiscale', args.telemetry, args.profile)
+
+    s0 = zarr.open(store=open_n5_store(args.input_path), mode='r')[f'{args.data_set}/s0']
+    distributed = args.distributed and not (args.streaming or args.update)
+    dashboard_address = None
+    if distributed and args.dashboard:
+        dashboard_address = ":8787"
+        print(f"Starting dashboard on {dashboard_address}")
+
+    layout, client = configure_dask(int(np.prod(s0.chunks)) * s0.dtype.itemsize,
+                                    distributed=distributed,
+                                    workers=args.workers,
+                                    threads_per_worker=args.threads_per_worker,
+                                    memory_limit=args.memory_limit,
+                                    dashboard_address=dashboard_address)
+    if not distributed:
         from dask.diagnostics import ProgressBar
         pbar = ProgressBar()
         pbar.register()
 
     downsampling_factors = [int(c) for c in args.downsampling_factors.split(',')]
+    downsampling_method = DOWNSAMPLING_METHODS[args.method]
 
     pixel_res = None
     if args.pixel_res:
         pixel_res = [float(c) for c in args.pixel_res.split(',')]
-
-    if not args.metadata_only:
-        add_multiscale(args.input_path, args.data_set, downsampling_factors=downsampling_factors)
+    shard_chunks = None
+    if args.shard_chunks:
+        shard_chunks = [int(c) for c in args.shard_chunks.split(',')]
+
+    if args.metadata_only:
+        pass
+    elif args.update:
+        dirty_boxes = None
+        if args.dirty_boxes:
+            coords = [[int(c) for c in b.split(',')] for b in args.dirty_boxes]
+            dirty_boxes = [(tuple(c[0:3]), tuple(c[3:6])) for c in coords]
+        update_multiscale(args.input_path, args.data_set,
+                          dirty_boxes=dirty_boxes,
+                          downsampling_method=downsampling_method,
+                          workers=layout['threads'])
+    elif args.streaming:
+        slab_size = None
+        if args.slab_size:
+            slab_size = [int(c) for c in args.slab_size.split(',')]
+        add_multiscale_streaming(args.input_path, args.data_set,
+                                 downsampling_factors=downsampling_factors,
+                                 downsampling_method=downsampling_method,
+                                 slab_size=slab_size,
+                                 workers=layout['threads'],
+                                 resume=args.resume,
+                                 checkpoint_interval=args.checkpoint_interval,
+                                 chunk_stats=args.chunk_stats,
+                                 shard_chunks=shard_chunks)
+    else:
+        add_multiscale(args.input_path, args.data_set, downsampling_factors=downsampling_factors,
+                       downsampling_method=downsampling_method, chunk_stats=args.chunk_stats,
+                       shard_chunks=shard_chunks)
 
     add_metadata(args.input_path, downsampling_factors=downsampling_factors, pixel_res=pixel_res, pixel_res_units=args.pixel_res_units)
 
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+'''
+Build and query the occupancy index of an n5 data set, which records
+for every chunk whether it contains anything other than the fill value
+'''
+
+import argparse
+import telemetry
+
+from n5_utils import (build_occupancy_index, get_block_boxes, get_n5_shape,
+                      is_n5_region_empty)
+
+
+def find_occupied_subvolumes(n5_path, data_set, partition_size, start=None, end=None):
+    '''
+    Partition the [start, end) region of the data set like the workflows partition
+    volumes and return the (start, end) x,y,z corners of the subvolumes that may
+    contain data. All subvolumes are returned if the data set has no index.
+    '''
+    boxes = get_block_boxes(get_n5_shape(n5_path, data_set), partition_size,
+                            start=start, end=end)
+    return [core_box for core_box, _ in boxes
+            if not is_n5_region_empty(n5_path, data_set, core_box[0], core_box[1])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query the occupancy index of an n5 data set')
+
+    parser.add_argument('-i', '--input', dest='input_path', type=str, required=True, \
+        help='Path to the directory containing the n5 volume')
+
+    parser.add_argument('-d', '--data_set', dest='data_set', type=str, default='/s0', \
+        help='Path to the data set (default "/s0")')
+
+    parser.add_argument('--build', dest='build', action='store_true', \
+        help='(Re)build the index by decoding all chunks of the data set')
+    parser.set_defaults(build=False)
+
+    parser.add_argument('--delete_empty', dest='delete_empty', action='store_true', \
+        help='When building the index, remove the chunk files that only contain the fill value')
+    parser.set_defaults(delete_empty=False)
+
+    parser.add_argument('--workers', dest='workers', type=int, default=4, \
+        help='Number of threads used to build the index (default 4)')
+
+    parser.add_argument('--start', dest='start', type=str, \
+        help='Starting x,y,z corner of the queried region (default is the volume origin)')
+
+    parser.add_argument('--end', dest='end', type=str, \
+        help='Ending x,y,z corner of the queried region (default is the volume shape)')
+
+    parser.add_argument('--partition_size', dest='partition_size', type=str, \
+        help='Partition the queried region into subvolumes of this x,y,z size and print ' + \
+             'the "x1,y1,z1 x2,y2,z2" corners of the subvolumes that are not empty')
+
+    telemetry.add_telemetry_arguments(parser)
+
+    args = parser.parse_args()
+
+    telemetry.setup_telemetry('n5_occupancy', args.telemetry, args.profile)
+
+    if args.build:
+        build_occupancy_index(args.input_path, args.data_set,
+                              workers=args.workers, delete_empty=args.delete_empty)
+
+    start = [int(c) for c in args.start.split(',')] if args.start else None
+    end = [int(c) for c in args.end.split(',')] if args.end else None
+
+    if args.partition_size:
+        partition_size = [int(c) for c in args.partition_size.split(',')]
+        for box_start, box_end in find_occupied_subvolumes(args.input_path, args.data_set,
+                                                           partition_size, start, end):
+            print(','.join([str(c) for c in box_start]), ','.join([str(c) for c in box_end]))
+    elif args.start or args.end or not args.build:
+        empty = is_n5_region_empty(args.input_path, args.data_set, start, end)
+        print('unknown' if empty is None else 'empty' if empty else 'occupied')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+'''
+Plan the partitioning of an n5 data set into subvolumes processed by parallel
+tasks, e.g. the per-GPU classifier tasks. The subvolumes are aligned to the chunk
+grid, so that no two tasks write the same chunk, fit in the memory budget of a
+task together with their halo, and are balanced by the number of occupied voxels
+when the data set has chunk statistics or an occupancy index.
+'''
+
+import argparse
+import json
+import numpy as np
+import telemetry
+
+from n5_rechunk import parse_size
+from n5_utils import (CHUNK_STATS_FIELDS, get_chunk_stats, get_occupancy_index,
+                      is_n5_region_empty, open_n5_array)
+
+
+def get_chunk_weights(path, data_set):
+    '''
+    Returns the number of occupied voxels of every chunk of the data set, as an
+    x,y,z indexed array, and where it comes from: the nonzero counts of the chunk
+    statistics ('chunk_stats') or, without statistics, all the voxels of the chunks
+    marked in the occupancy index ('occupancy'). Returns (None, None) if the data set
+    has neither.
+    '''
+    img = open_n5_array(path, data_set)
+    stats = get_chunk_stats(path, data_set)
+    if stats.exists():
+        summary = stats.summary[...]
+        nonzero = summary[..., CHUNK_STATS_FIELDS.index('nonzero')]
+        return nonzero.transpose(2, 1, 0), 'chunk_stats'
+    occupancy = get_occupancy_index(path, data_set)
+    if occupancy.exists():
+        voxels = _chunk_voxels(tuple(reversed(img.shape)), tuple(reversed(img.chunks)))
+        return occupancy.bits.transpose(2, 1, 0) * voxels, 'occupancy'
+    return None, None
+
+
+def _chunk_voxels(shape, chunk_size):
+    '''
+    Returns the number of voxels of every chunk, smaller at the far borders
+    '''
+    extents = [np.diff(np.minimum(np.arange(0, d + c, c), d)) for d, c in zip(shape, chunk_size)]
+    return np.einsum('i,j,k->ijk', *extents).astype(np.float64)
+
+
+def _overlap_fractions(lo, hi, chunk, dim):
+    '''
+    Returns the first chunk index along an axis and the fraction of each chunk
+    from that index on that lies in [lo, hi)
+    '''
+    first, last = lo // chunk, -(-hi // chunk)
+    chunk_starts = np.arange(first, last) * chunk
+    chunk_ends = np.minimum(chunk_starts + chunk, dim)
+    overlap = np.minimum(chunk_ends, hi) - np.maximum(chunk_starts, lo)
+    return first, overlap / (chunk_ends - chunk_starts)
+
+
+class _Partitioner:
+
+    def __init__(self, shape, chunk_size, halo, max_size, memory_limit, voxel_bytes, weights):
+        self.shape = tuple(shape)
+        self.chunk_size = tuple(chunk_size)
+        self.halo = tuple(halo)
+        self.max_size = tuple(max_size) if max_size else None
+        self.memory_limit = memory_limit
+        self.voxel_bytes = voxel_bytes
+        self.weights = weights
+
+    def halo_box(self, box):
+        start, end = box
+        return (tuple([max(s - h, 0) for s, h in zip(start, self.halo)]),
+                tuple([min(e + h, d) for e, h, d in zip(end, self.halo, self.shape)]))
+
+    def memory(self, box):
+        halo_start, halo_end = self.halo_box(box)
+        return int(np.prod([e - s for s, e in zip(halo_start, halo_end)]) * self.voxel_bytes)
+
+    def fits(self, box):
+        size = [e - s for s, e in zip(*box)]
+        if self.max_size and any([s > m for s, m in zip(size, self.max_size)]):
+            return False
+        return not self.memory_limit or self.memory(box) <= self.memory_limit
+
+    def profile(self, box, axis):
+        '''
+        Returns the first chunk index along the axis and the weight of each
+        chunk plane of the box across that axis
+        '''
+        fractions = [_overlap_fractions(s, e, c, d)
+                     for s, e, c, d in zip(box[0], box[1], self.chunk_size, self.shape)]
+        region = tuple([slice(first, first + len(f)) for first, f in fractions])
+        weighted = self.weights[region] * np.einsum('i,j,k->ijk', *[f for _, f in fractions])
+        other_axes = tuple([a for a in range(3) if a != axis])
+        return fractions[axis][0], weighted.sum(axis=other_axes)
+
+    def weight(self, box):
+        return float(self.profile(box, 0)[1].sum())
+
+    def split(self, box, aligned_only=False):
+        '''
+        Splits the box in two across the chunk boundary that best balances the
+        weight of the halves, along the axis that exceeds the maximum size or
+        else the longest axis. A box within a single chunk is split at the middle
+        of its longest axis, unless aligned_only is set. Returns None if the box
+        cannot be split.
+        '''
+        start, end = box
+        size = [e - s for s, e in zip(start, end)]
+        axes = sorted(range(3), key=lambda a: (not (self.max_size and size[a] > self.max_size[a]),
+                                               -size[a]))
+        for axis in axes:
+            c = self.chunk_size[axis]
+            cuts = list(range((start[axis] // c + 1) * c, end[axis], c))
+            if cuts:
+                first, planes = self.profile(box, axis)
+                left = np.cumsum(planes)[[cut // c - first - 1 for cut in cuts]]
+                middle = start[axis] + size[axis] / 2
+                cut = min(zip(np.abs(2 * left - planes.sum()), [abs(cut - middle) for cut in cuts], cuts))[2]
+                break
+        else:
+            axis = axes[0] if size[axes[0]] > 1 else max(range(3), key=lambda a: size[a])
+            if aligned_only or size[axis] < 2:
+                return None
+            cut = start[axis] + size[axis] // 2
+        left_end, right_start = list(end), list(start)
+        left_end[axis] = right_start[axis] = cut
+        return [(tuple(start), tuple(left_end)), (tuple(right_start), tuple(end))]
+
+    def is_aligned(self, box):
+        '''
+        Returns True if the box only contains whole chunks, so that it can be
+        written without sharing a chunk with another box
+        '''
+        return all([(s % c == 0 or s == 0) and (e % c == 0 or e == d)
+                    for s, e, c, d in zip(box[0], box[1], self.chunk_size, self.shape)])
+
+
+def plan_partitions(shape, chunk_size, halo=0, start=None, end=None, max_size=None,
+                    memory_limit=None, voxel_bytes=1, min_partitions=1, weights=None,
+                    skip_empty=True, is_empty=None):
+    '''
+    Partitions the [start, end) region of a volume into subvolumes aligned to the
+    chunk grid. The region is bisected across chunk boundaries, at the boundary that
+    best balances the weights of the halves, until every subvolume is smaller than
+    max_size and needs at most memory_limit bytes with its halo. The heaviest
+    subvolumes are then split further until there are at least min_partitions.
+    Only if a single chunk does not fit the budget, it is split into subvolumes that
+    share chunks; these are marked with 'lock' and must be written with the advisory
+    chunk locks (see n5_utils.write_n5_block).
+    shape: x,y,z shape of the volume
+    chunk_size: x,y,z chunk size of the data set written by the tasks
+    halo: x,y,z halo read around every subvolume (or a single int)
+    start, end: x,y,z corners of the region (default is the whole volume)
+    max_size: x,y,z maximum size of a subvolume
+    memory_limit: memory in bytes available to a task
+    voxel_bytes: memory used by a task per voxel of its subvolume with the halo
+    weights: x,y,z indexed array with the occupied voxels of each chunk, e.g. from
+             get_chunk_weights. By default all voxels weigh the same.
+    skip_empty: leave out the subvolumes without occupied voxels (only with weights)
+    is_empty: function checking a subvolume without occupied voxels before it is left
+              out, e.g. against the storage, since the weights miss the chunks written
+              by tools that do not maintain them. It returns True if the ((x,y,z) start,
+              (x,y,z) end) box is empty, or False or None (unknown) to keep the subvolume,
+              which then weighs all its voxels.
+    Returns a list of dictionaries describing the subvolumes in z,y,x order.
+    '''
+    shape = tuple(shape)
+    halo = (halo,) * 3 if isinstance(halo, int) else tuple(halo)
+    start = tuple(start or (0, 0, 0))
+    end = tuple([min(e, d) for e, d in zip(end or shape, shape)])
+    weighted = weights is not None
+    if not weighted:
+        weights = _chunk_voxels(shape, chunk_size)
+    partitioner = _Partitioner(shape, chunk_size, halo, max_size, memory_limit,
+                               voxel_bytes, np.asarray(weights, dtype=np.float64))
+
+    pending = [(start, end)]
+    boxes = []
+    while pending:
+        box = pending.pop()
+        if partitioner.fits(box):
+            boxes.append(box)
+            continue
+        halves = partitioner.split(box)
+        if halves is None:
+            raise ValueError(f'A single voxel with its halo {halo} needs {partitioner.memory(box)} bytes, ' +
+                             f'more than the limit of {memory_limit} bytes')
+        pending.extend(halves)
+
+    box_weights = dict([(box, partitioner.weight(box)) for box in boxes])
+    while True:
+        if weighted and skip_empty:
+            for box in [box for box, w in box_weights.items() if w == 0]:
+                if is_empty is None or is_empty(box):
+                    del box_weights[box]
+                else:
+                    box_weights[box] = float(np.prod([e - s for s, e in zip(*box)]))
+        if len(box_weights) >= min_partitions:
+            break
+        halves = None
+        for box in sorted(box_weights, key=box_weights.get, reverse=True):
+            halves = partitioner.split(box, aligned_only=True)
+            if halves:
+                del box_weights[box]
+                box_weights.update([(half, partitioner.weight(half)) for half in halves])
+                break
+        if not halves:
+            break
+
+    partitions = []
+    for box in sorted(box_weights, key=lambda b: tuple(reversed(b[0]))):
+        halo_start, halo_end = partitioner.halo_box(box)
+        partition = {
+            'start': list(box[0]),
+            'end': list(box[1]),
+            'start_subvolume': ','.join([str(s) for s in box[0]]),
+            'end_subvolume': ','.join([str(e) for e in box[1]]),
+            'halo_start': list(halo_start),
+            'halo_end': list(halo_end),
+            'voxels': int(np.prod([e - s for s, e in zip(*box)])),
+            'memory_bytes': partitioner.memory(box),
+            'lock': not partitioner.is_aligned(box),
+        }
+        if weighted:
+            partition['occupied_voxels'] = int(round(box_weights[box]))
+        partitions.append(partition)
+    return partitions
+
+
+def get_imbalance(partitions, key='voxels'):
+    '''
+    Returns the ratio between the largest and the mean value of the given key
+    over the partitions (1 is perfectly balanced)
+    '''
+    values = [p[key] for p in partitions]
+    mean = np.mean(values) if values else 0
+    return float(max(values) / mean) if mean else 1.0
+
+
+@telemetry.stage('plan_partitions')
+def plan_n5_partitions(path, data_set, chunk_size=None, halo=0, start=None, end=None,
+                       max_size=None, memory_limit=None, voxel_bytes=None, min_partitions=1,
+                       balance=True, skip_empty=True):
+    '''
+    Plans the partitions of the given n5 data set (see plan_partitions) and returns
+    the plan as a dictionary that can be saved as JSON. The partitions are aligned
+    to chunk_size, by default the chunk size of the data set. Unless balance is False,
+    they are balanced by the occupied voxels of the data set, if it has chunk
+    statistics or an occupancy index and chunk_size is its chunk size. A partition
+    without occupied voxels is only left out if the storage has none of its chunks,
+    see n5_utils.is_n5_region_empty.
+    voxel_bytes defaults to the item size of the data set.
+    '''
+    img = open_n5_array(path, data_set)
+    shape = tuple(reversed(img.shape))
+    data_set_chunks = tuple(reversed(img.chunks))
+    chunk_size = tuple(chunk_size or data_set_chunks)
+    weights, balanced_by = None, None
+    if balance and chunk_size == data_set_chunks:
+        weights, balanced_by = get_chunk_weights(path, data_set)
+    partitions = plan_partitions(shape, chunk_size, halo=halo, start=start, end=end,
+                                 max_size=max_size, memory_limit=memory_limit,
+                                 voxel_bytes=voxel_bytes or img.dtype.itemsize,
+                                 min_partitions=min_partitions, weights=weights,
+                                 skip_empty=skip_empty,
+                                 is_empty=lambda box: is_n5_region_empty(path, data_set, *box))
+    plan = {
+        'n5': path,
+        'data_set': data_set,
+        'shape': list(shape),
+        'chunk_size': list(chunk_size),
+        'halo': [halo] * 3 if isinstance(halo, int) else list(halo),
+        'balanced_by': balanced_by,
+        'imbalance': get_imbalance(partitions, 'occupied_voxels' if balanced_by else 'voxels'),
+        'partitions': partitions,
+    }
+    return plan
+
+
+def _parse_xyz(value):
+    if value is None:
+        return None
+    values = [int(c) for c in value.split(',')]
+    return values * 3 if len(values) == 1 else values
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plan chunk-aligned partitions of an n5 data set')
+
+    parser.add_argument('-i', '--input', dest='input_path', type=str, required=True, \
+        help='Path to the directory containing the n5 volume')
+
+    parser.add_argument('-d', '--data_set', dest='data_set', type=str, default='/s0', \
+        help='Path to the data set (default "/s0")')
+
+    parser.add_argument('-o', '--output', dest='output_path', type=str, \
+        help='Write the plan as JSON to this file (default is the standard output)')
+
+    parser.add_argument('-c', '--chunk_size', dest='chunk_size', type=str, \
+        help='x,y,z chunk size of the data set written by the tasks, which the partitions ' + \
+             'are aligned to (default is the chunk size of the input data set)')
+
+    parser.add_argument('--halo', dest='halo', type=str, default='0', \
+        help='Halo read around every partition, one value or x,y,z (default 0)')
+
+    parser.add_argument('--start', dest='start', type=str, \
+        help='Starting x,y,z corner of the partitioned region (default is the volume origin)')
+
+    parser.add_argument('--end', dest='end', type=str, \
+        help='Ending x,y,z corner of the partitioned region (default is the volume shape)')
+
+    parser.add_argument('--partition_size', dest='partition_size', type=str, \
+        help='Maximum x,y,z size of a partition')
+
+    parser.add_argument('--memory_limit', dest='memory_limit', type=str, \
+        help='Memory available to a task (host or GPU), e.g. 16G')
+
+    parser.add_argument('--voxel_bytes', dest='voxel_bytes', type=float, \
+        help='Memory used by a task per voxel of its partition with the halo, counting its ' + \
+             'input, output and intermediate arrays (default is the item size of the data set)')
+
+    parser.add_argument('--partitions', dest='min_partitions', type=int, default=1, \
+        help='Minimum number of partitions, e.g. the number of GPUs (default 1)')
+
+    parser.add_argument('--no_balance', dest='balance', action='store_false', \
+        help='Balance the partitions by their number of voxels, ignoring the occupancy')
+    parser.set_defaults(balance=True)
+
+    parser.add_argument('--keep_empty', dest='skip_empty', action='store_false', \
+        help='Keep the partitions that have no occupied voxels')
+    parser.set_defaults(skip_empty=True)
+
+    telemetry.add_telemetry_arguments(parser)
+
+    args = parser.parse_args()
+
+    telemetry.setup_telemetry('n5_partition', args.telemetry, args.profile)
+
+    plan = plan_n5_partitions(args.input_path, args.data_set,
+                              chunk_size=_parse_xyz(args.chunk_size),
+                              halo=_parse_xyz(args.halo),
+                              start=_parse_xyz(args.start),
+                              end=_parse_xyz(args.end),
+                              max_size=_parse_xyz(args.partition_size),
+                              memory_limit=parse_size(args.memory_limit) if args.memory_limit else None,
+                              voxel_bytes=args.voxel_bytes,
+                              min_partitions=args.min_partitions,
+                              balance=args.balance,
+                              skip_empty=args.skip_empty)
+    if args.output_path:
+        with open(args.output_path, 'w') as f:
+            json.dump(plan, f, indent=2)
+        partitions = plan['partitions']
+        print(f'Wrote {len(partitions)} partitions to {args.output_path}, ' +
+              f'{sum([p["lock"] for p in partitions])} sharing chunks, ' +
+              f'imbalance {plan["imbalance"]:.2f}')
+    else:
+        print(json.dumps(plan, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+'''
+Rechunk and/or recompress an existing n5 data set out of core
+'''
+
+import argparse
+import itertools
+import math
+import os
+import shutil
+import numpy as np
+import telemetry
+import zarr
+from concurrent.futures import ThreadPoolExecutor
+
+from create_n5 import get_compressor
+from n5_utils import (N5ChunkWriter, create_occupancy_index, get_n5_path, open_n5_store,
+                      remove_chunk_stats)
+
+PROGRESS_FILENAME = 'rechunk_progress.log'
+
+
+def parse_size(size):
+    '''
+    Parse a memory size such as "512M" or "4G" into bytes
+    '''
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    size = str(size).strip().lower().rstrip('b')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def read_amplification(block_shape, source_chunks):
+    '''
+    Returns the worst case ratio between the voxels decoded from the source
+    chunks overlapping a block and the voxels of the block
+    '''
+    ratio = 1.0
+    for b, c in zip(block_shape, source_chunks):
+        # a block spans at most ceil((b - 1) / c) + 1 source chunks along each axis
+        ratio *= (int(math.ceil((b - 1) / c)) + 1) * c / b if b % c else 1
+    return ratio
+
+
+def plan_blocks(shape, itemsize, source_chunks, target_chunks, max_mem):
+    '''
+    Choose the shape of the blocks copied from a source chunking to a target chunking.
+    Blocks are always whole target chunks, so every output chunk is written exactly once.
+    Along each axis the blocks grow by target chunks towards the smallest shape that
+    is also aligned with the source chunks, while a block fits in max_mem bytes
+    (accounting for the decoded and encoded copies).
+    '''
+    block = list(target_chunks)
+
+    def block_bytes(b):
+        return 2 * np.prod(b, dtype=np.int64) * itemsize
+
+    aligned = [min(np.lcm(s, t), d if d % t == 0 else int(math.ceil(d / t)) * t)
+               for s, t, d in zip(source_chunks, target_chunks, shape)]
+    # grow the axes with the largest read waste first
+    axes = sorted(range(len(shape)),
+                  key=lambda a: -read_amplification([block[a]], [source_chunks[a]]))
+    for a in axes:
+        while block[a] < aligned[a]:
+            candidate = list(block)
+            candidate[a] += target_chunks[a]
+            if block_bytes(candidate) > max_mem:
+                break
+            block = candidate
+            if block[a] >= shape[a]:
+                break
+    return tuple(block)
+
+
+def plan_rechunk(shape, itemsize, source_chunks, target_chunks, max_mem, max_amplification=2.0):
+    '''
+    Plan the conversion from the source to the target chunking with at most max_mem
+    bytes per block. Returns the list of stages as (source chunks, target chunks,
+    block shape) tuples. When the direct copy would decode each source voxel more
+    than max_amplification times, the copy goes through an intermediate chunking
+    that is aligned with both the source and the target chunks, provided its chunks
+    are not too small.
+    '''
+    direct_block = plan_blocks(shape, itemsize, source_chunks, target_chunks, max_mem)
+    direct = [(tuple(source_chunks), tuple(target_chunks), direct_block)]
+    if read_amplification(direct_block, source_chunks) <= max_amplification:
+        return direct
+
+    intermediate_chunks = tuple([math.gcd(s, t) for s, t in zip(source_chunks, target_chunks)])
+    min_chunk_voxels = min(np.prod(source_chunks), np.prod(target_chunks)) // 64
+    if np.prod(intermediate_chunks) < min_chunk_voxels or \
+            intermediate_chunks in [tuple(source_chunks), tuple(target_chunks)]:
+        # an intermediate chunking equal to an endpoint would only add an identity copy
+        return direct
+    stage_blocks = [plan_blocks(shape, itemsize, source_chunks, intermediate_chunks, max_mem),
+                    plan_blocks(shape, itemsize, intermediate_chunks, target_chunks, max_mem)]
+    return [(tuple(source_chunks), intermediate_chunks, stage_blocks[0]),
+            (intermediate_chunks, tuple(target_chunks), stage_blocks[1])]
+
+
+def copy_blocks(source, target, block_shape, workers, progress_path=None):
+    '''
+    Copy the source array into the target array or N5ChunkWriter one block at a time,
+    using the given number of threads. Completed blocks are appended to the progress file, and blocks
+    already listed there are skipped.
+    '''
+    done = set()
+    if progress_path and os.path.exists(progress_path):
+        with open(progress_path) as f:
+            done = set([line.strip() for line in f if line.strip()])
+
+    origins = list(itertools.product(*[range(0, d, b) for d, b in zip(source.shape, block_shape)]))
+    todo = [o for o in origins if ','.join([str(c) for c in o]) not in done]
+    print(f'Copying {len(todo)} of {len(origins)} blocks of {block_shape}')
+
+    def copy_block(origin):
+        region = tuple([slice(o, min(o + b, d)) for o, b, d in zip(origin, block_shape, source.shape)])
+        target[region] = source[region]
+        return origin
+
+    progress = open(progress_path, 'a') if progress_path else None
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for n, origin in enumerate(executor.map(copy_block, todo)):
+                if progress:
+                    progress.write(','.join([str(c) for c in origin]) + '\n')
+                    progress.flush()
+                if (n + 1) % 100 == 0:
+                    print(f'Copied {n + 1} of {len(todo)} blocks')
+    finally:
+        if progress:
+            progress.close()
+
+
+@telemetry.stage('rechunk')
+def rechunk_dataset(n5_path, data_set, output_path, output_data_set, chunk_size=None,
+                    compression='same', max_mem=1 << 30, workers=4,
+                    in_place=False, resume=False):
+    '''
+    Convert an n5 data set to a new chunk size and/or compression, without loading it
+    all in memory. The memory budget is shared by the worker threads. With resume=True
+    an interrupted conversion continues with the blocks that were not completed.
+    If in_place is set, the output replaces the input data set once it is complete.
+    '''
+    source = zarr.open(store=open_n5_store(n5_path), mode='r')[data_set]
+    if in_place:
+        output_path = n5_path
+        final_data_set = data_set
+        output_data_set = data_set.rstrip('/') + '-rechunked'
+    compressor = source.compressor if compression == 'same' else get_compressor(compression)
+    chunk_size = tuple(chunk_size or source.chunks)
+    stages = plan_rechunk(source.shape, source.dtype.itemsize, source.chunks, chunk_size,
+                          max_mem // workers)
+
+    print("Rechunking n5 data set:")
+    print(f"  from:       {n5_path}{data_set}")
+    print(f"  compressor: {source.compressor} -> {compressor}")
+    print(f"  chunking:   {source.chunks} -> {chunk_size}")
+    print(f"  memory:     {max_mem} bytes, {workers} workers")
+    print(f"  to path:    {output_path}{output_data_set}")
+    for idx, (stage_source, stage_target, block_shape) in enumerate(stages):
+        print(f"  stage {idx}:    {stage_source} -> {stage_target} in blocks of {block_shape}")
+
+    out = zarr.open(store=zarr.N5Store(output_path), mode='a')
+    stage_data_sets = [output_data_set.rstrip('/') + f'-stage{idx}' for idx in range(len(stages) - 1)]
+    stage_data_sets.append(output_data_set)
+    progress_paths = [os.path.join(get_n5_path(output_path, d), PROGRESS_FILENAME) for d in stage_data_sets]
+
+    first_stage = 0
+    if resume:
+        started = [idx for idx, p in enumerate(progress_paths) if os.path.exists(p)]
+        first_stage = started[-1] if started else 0
+
+    stage_source = source if first_stage == 0 else out[stage_data_sets[first_stage - 1]]
+    for idx in range(first_stage, len(stages)):
+        stage_chunks, block_shape = stages[idx][1:]
+        last_stage = idx == len(stages) - 1
+        if resume and os.path.exists(progress_paths[idx]):
+            stage_target = out[stage_data_sets[idx]]
+        else:
+            stage_target = out.create_dataset(stage_data_sets[idx],
+                shape=source.shape,
+                chunks=stage_chunks,
+                dtype=source.dtype,
+                # the intermediate chunks are only read once
+                compressor=compressor if last_stage else None,
+                overwrite=True)
+            create_occupancy_index(output_path, stage_data_sets[idx])
+            remove_chunk_stats(output_path, stage_data_sets[idx])
+        # empty chunks are not written, see N5ChunkWriter
+        copy_blocks(stage_source, N5ChunkWriter(output_path, stage_data_sets[idx]), block_shape,
+                    workers, progress_path=progress_paths[idx])
+        stage_source = stage_target
+
+    os.remove(progress_paths[-1])
+    for intermediate_data_set in stage_data_sets[0:-1]:
+        shutil.rmtree(get_n5_path(output_path, intermediate_data_set))
+
+    if in_place:
+        final_dir = get_n5_path(n5_path, final_data_set)
+        replaced_dir = final_dir + '-replaced'
+        os.rename(final_dir, replaced_dir)
+        os.rename(get_n5_path(n5_path, output_data_set), final_dir)
+        shutil.rmtree(replaced_dir)
+        remove_chunk_stats(n5_path, final_data_set)
+        output_data_set = final_data_set
+
+    print(f'Rechunked {n5_path}{data_set} to {output_path}{output_data_set}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rechunk and/or recompress an existing n5 data set')
+
+    parser.add_argument('-i', '--input', dest='input_path', type=str, required=True, \
+        help='Path to the directory containing the n5 volume')
+
+    parser.add_argument('-d', '--data_set', dest='data_set', type=str, default='/s0', \
+        help='Path to the input data set (default "/s0")')
+
+    parser.add_argument('-o', '--output', dest='output_path', type=str, \
+        help='Path to the output n5 (default is the input n5)')
+
+    parser.add_argument('--output_data_set', dest='output_data_set', type=str, \
+        help='Path to the output data set (default is the input data set)')
+
+    parser.add_argument('-c', '--chunk_size', dest='chunk_size', type=str, \
+        help='Comma-delimited list describing the new chunk size (default is the input chunk size)')
+
+    parser.add_argument('--compression', dest='compression', type=str, default='same', \
+        help='Set the compression, e.g. raw, gzip:6, bz2, blosc:zstd:5 (default is the input compression)')
+
+    parser.add_argument('--max_mem', dest='max_mem', type=str, default='4G', \
+        help='Memory budget shared by all workers, e.g. 512M or 8G (default 4G)')
+
+    parser.add_argument('--workers', dest='workers', type=int, default=4, \
+        help='Number of worker threads (default 4)')
+
+    parser.add_argument('--in_place', dest='in_place', action='store_true', \
+        help='Replace the input data set with the rechunked data set')
+    parser.set_defaults(in_place=False)
+
+    parser.add_argument('--resume', dest='resume', action='store_true', \
+        help='Continue an interrupted conversion')
+    parser.set_defaults(resume=False)
+
+    telemetry.add_telemetry_arguments(parser)
+
+    args = parser.parse_args()
+
+    telemetry.setup_telemetry('n5_rechunk', args.telemetry, args.profile)
+
+    output_path = args.output_path or args.input_path
+    output_data_set = args.output_data_set or args.data_set
+    if not args.in_place and output_path == args.input_path and output_data_set == args.data_set:
+        parser.error('The output data set must be different from the input data set unless --in_place is set')
+
+    chunk_size = None
+    if args.chunk_size:
+        chunk_size = [int(c) for c in args.chunk_size.split(',')]
+
+    rechunk_dataset(args.input_path, args.data_set, output_path, output_data_set,
+                    chunk_size=chunk_size,
+                    compression=args.compression,
+                    max_mem=parse_size(args.max_mem),
+                    workers=args.workers,
+                    in_place=args.in_place,
+                    resume=args.resume)
+
+
+if __name__ == "__main__":
+    main()
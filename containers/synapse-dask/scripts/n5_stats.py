@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''
+Build and query the per-chunk statistics (min, max, sum, nonzero count and
+histogram) of an n5 data set
+'''
+
+import argparse
+import json
+import telemetry
+
+from n5_utils import build_chunk_stats, get_n5_percentiles, get_n5_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query the chunk statistics of an n5 data set')
+
+    parser.add_argument('-i', '--input', dest='input_path', type=str, required=True, \
+        help='Path to the directory containing the n5 volume')
+
+    parser.add_argument('-d', '--data_set', dest='data_set', type=str, default='/s0', \
+        help='Path to the data set (default "/s0")')
+
+    parser.add_argument('--build', dest='build', action='store_true', \
+        help='(Re)build the statistics by decoding all chunks of the data set')
+    parser.set_defaults(build=False)
+
+    parser.add_argument('--bins', dest='bins', type=int, default=256, \
+        help='Number of histogram bins used by --build (default 256)')
+
+    parser.add_argument('--range', dest='value_range', type=str, metavar='min,max', \
+        help='Value range of the histogram used by --build ' + \
+             '(default is the range of the values of a few randomly sampled chunks)')
+
+    parser.add_argument('--workers', dest='workers', type=int, default=4, \
+        help='Number of threads used to build the statistics (default 4)')
+
+    parser.add_argument('--start', dest='start', type=str, \
+        help='Starting x,y,z corner of the queried region (default is the volume origin)')
+
+    parser.add_argument('--end', dest='end', type=str, \
+        help='Ending x,y,z corner of the queried region (default is the volume shape)')
+
+    parser.add_argument('-p', '--percentiles', dest='percentiles', type=str, \
+        help='Comma-delimited list of percentiles to estimate, e.g. 0.5,50,99.5')
+
+    parser.add_argument('--ignore_zeros', dest='ignore_zeros', action='store_true', \
+        help='Ignore the zero voxels when estimating the percentiles')
+    parser.set_defaults(ignore_zeros=False)
+
+    telemetry.add_telemetry_arguments(parser)
+
+    args = parser.parse_args()
+
+    telemetry.setup_telemetry('n5_stats', args.telemetry, args.profile)
+
+    if args.build:
+        value_range = None
+        if args.value_range:
+            value_range = [float(c) for c in args.value_range.split(',')]
+        build_chunk_stats(args.input_path, args.data_set, bins=args.bins,
+                          value_range=value_range, workers=args.workers)
+
+    start = [int(c) for c in args.start.split(',')] if args.start else None
+    end = [int(c) for c in args.end.split(',')] if args.end else None
+
+    stats = get_n5_stats(args.input_path, args.data_set, start, end)
+    if stats is None:
+        parser.error(f'{args.input_path}{args.data_set} has no chunk statistics, use --build')
+    result = dict([(k, v) for k, v in stats.items() if k not in ['histogram', 'bin_edges']])
+    if args.percentiles:
+        percentiles = [float(p) for p in args.percentiles.split(',')]
+        values = get_n5_percentiles(args.input_path, args.data_set, percentiles, start, end,
+                                    ignore_zeros=args.ignore_zeros)
+        result['percentiles'] = dict(zip(args.percentiles.split(','), values))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
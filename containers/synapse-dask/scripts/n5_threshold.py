@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+'''
+Threshold an n5 data set and/or generate its maximum intensity projections
+in a single pass over the data
+'''
+
+import argparse
+import os
+import dask
+import dask.array as da
+import numpy as np
+import telemetry
+import tifffile
+import zarr
+
+from dask_cluster import add_cluster_arguments, configure_dask
+from n5_utils import (N5ChunkWriter, create_occupancy_index, get_n5_path, open_n5_store,
+                      remove_chunk_stats)
+
+# Projection axis (in zyx order) of each MIP
+MIP_AXES = {'xy': 0, 'xz': 1, 'yz': 2}
+
+
+def threshold_volume(volume, threshold, mask_value=None):
+    '''
+    Returns the dask array with the voxels below the threshold set to 0. If a mask_value
+    is given, the voxels at or above the threshold are set to it, producing a binary mask.
+    '''
+    foreground = volume >= threshold
+    if mask_value is None:
+        return da.where(foreground, volume, 0).astype(volume.dtype)
+    return da.where(foreground, mask_value, 0).astype(volume.dtype)
+
+
+@telemetry.stage('threshold_and_mips')
+def threshold_and_mips(n5_path, data_set, output_path=None, output_data_set=None,
+                       threshold=None, mask_value=None, mips_output_dir=None,
+                       mips_prefix='MIP_', mips_of_input=False):
+    '''
+    Read the n5 data set once and, in the same dask computation, write the thresholded
+    data set and the XY, XZ and YZ maximum intensity projections as TIFF files.
+    The projections are tree reductions over the chunks, so only partial projections
+    are kept in memory. The projections are computed from the thresholded data unless
+    mips_of_input is set or there is no threshold.
+    Returns a dictionary with the projections.
+    '''
+    store = open_n5_store(n5_path)
+    source = zarr.open(store=store, mode='r')[data_set]
+    volume = da.from_zarr(store, component=data_set)
+    tasks = []
+
+    print("Processing n5 data set:")
+    print(f"  from:       {n5_path}{data_set}")
+    print(f"  shape:      {source.shape}")
+    print(f"  chunking:   {source.chunks}")
+
+    projected = volume
+    if threshold is not None:
+        print(f"  threshold:  {threshold}")
+        print(f"  to path:    {output_path}{output_data_set}")
+        thresholded = threshold_volume(volume, threshold, mask_value)
+        zarr.create(shape=source.shape,
+                    chunks=source.chunks,
+                    dtype=source.dtype,
+                    compressor=source.compressor,
+                    store=zarr.N5Store(output_path),
+                    path=output_data_set,
+                    overwrite=True)
+        create_occupancy_index(output_path, output_data_set)
+        remove_chunk_stats(output_path, output_data_set)
+        # empty chunks are not written, see N5ChunkWriter
+        tasks.append(thresholded.store(N5ChunkWriter(output_path, output_data_set),
+                                       lock=False, compute=False))
+        if not mips_of_input:
+            projected = thresholded
+
+    mip_names = []
+    if mips_output_dir:
+        print(f"  MIPs to:    {mips_output_dir}")
+        for name, axis in MIP_AXES.items():
+            mip_names.append(name)
+            tasks.append(projected.max(axis=axis))
+
+    # one computation, so every chunk is read once for all outputs
+    results = dask.compute(*tasks)
+    mips = dict(zip(mip_names, results[len(results) - len(mip_names):]))
+
+    if mips_output_dir:
+        os.makedirs(mips_output_dir, exist_ok=True)
+        for name, mip in mips.items():
+            mip_path = os.path.join(mips_output_dir, f'{mips_prefix}{name.upper()}.tif')
+            print(f'Saving {name} MIP {mip.shape} to {mip_path}')
+            with telemetry.timed('tiff_files_written', 'tiff_write_seconds'):
+                tifffile.imwrite(mip_path, mip)
+            telemetry.add(tiff_bytes_written=mip.nbytes)
+
+    return mips
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Threshold an n5 data set and/or generate its MIPs in a single pass')
+
+    parser.add_argument('-i', '--input', dest='input_path', type=str, required=True,
+                        help='Path to the directory containing the n5 volume')
+
+    parser.add_argument('-d', '--data_set', dest='data_set', type=str, default='/s0',
+                        help='Path to the input data set (default is /s0)')
+
+    parser.add_argument('-o', '--output', dest='output_path', type=str,
+                        help='Path to the output n5 (default is the input n5)')
+
+    parser.add_argument('--output_data_set', dest='output_data_set', type=str,
+                        help='Path to the thresholded data set (required with --threshold)')
+
+    parser.add_argument('-t', '--threshold', dest='threshold', type=float,
+                        help='Intensity threshold. Voxels below the threshold are set to 0.')
+
+    parser.add_argument('--mask_value', dest='mask_value', type=int,
+                        help='If set, the voxels at or above the threshold are set to this value')
+
+    parser.add_argument('--mips_output_dir', dest='mips_output_dir', type=str,
+                        help='Directory where the XY, XZ and YZ MIPs will be saved')
+
+    parser.add_argument('--mips_prefix', dest='mips_prefix', type=str, default='MIP_',
+                        help='File name prefix of the MIPs (default is MIP_)')
+
+    parser.add_argument('--mips_of_input', dest='mips_of_input', action='store_true',
+                        help='Project the input instead of the thresholded data set')
+    parser.set_defaults(mips_of_input=False)
+
+    parser.add_argument('--distributed', dest='distributed', action='store_true',
+                        help='Run with distributed scheduler')
+    parser.set_defaults(distributed=False)
+
+    parser.add_argument('--workers', dest='workers', type=int,
+                        help='Number of workers (default is chosen from the CPU and memory ' +
+                        'limits of the container)')
+
+    parser.add_argument('--dashboard', dest='dashboard', action='store_true',
+                        help='Run a web-based dashboard on port 8787')
+    parser.set_defaults(dashboard=False)
+
+    add_cluster_arguments(parser)
+
+    telemetry.add_telemetry_arguments(parser)
+
+    args = parser.parse_args()
+
+    telemetry.setup_telemetry('n5_threshold', args.telemetry, args.profile)
+
+    if args.threshold is not None and not args.output_data_set:
+        parser.error('--output_data_set is required with --threshold')
+    if args.threshold is None and not args.mips_output_dir:
+        parser.error('Nothing to do: set --threshold and/or --mips_output_dir')
+    output_path = args.output_path or args.input_path
+    if args.threshold is not None and (os.path.realpath(get_n5_path(output_path, args.output_data_set)) ==
+                                       os.path.realpath(get_n5_path(args.input_path, args.data_set))):
+        parser.error('The output data set must be different from the input data set')
+
+    source = zarr.open(store=zarr.N5Store(args.input_path), mode='r')[args.data_set]
+    dashboard_address = None
+    if args.distributed and args.dashboard:
+        dashboard_address = ":8787"
+        print(f"Starting dashboard on {dashboard_address}")
+
+    layout, client = configure_dask(int(np.prod(source.chunks)) * source.dtype.itemsize,
+                                    distributed=args.distributed,
+                                    workers=args.workers,
+                                    threads_per_worker=args.threads_per_worker,
+                                    memory_limit=args.memory_limit,
+                                    dashboard_address=dashboard_address)
+    if not args.distributed:
+        from dask.diagnostics import ProgressBar
+        pbar = ProgressBar()
+        pbar.register()
+
+    threshold_and_mips(args.input_path, args.data_set,
+                       output_path=output_path,
+                       output_data_set=args.output_data_set,
+                       threshold=args.threshold,
+                       mask_value=args.mask_value,
+                       mips_output_dir=args.mips_output_dir,
+                       mips_prefix=args.mips_prefix,
+                       mips_of_input=args.mips_of_input)
+
+
+if __name__ == "__main__":
+    main()
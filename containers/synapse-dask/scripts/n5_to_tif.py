@@ -1,47 +1,235 @@
 #!/usr/bin/env python
 
+import csv
+import json
+import re
 import warnings
 import argparse
+import numpy as np
+import tifffile
 import zarr
 import skimage.io
 import dask.array as da
+import telemetry
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from n5_utils import (chunk_intersections, get_chunk_region, get_n5_percentiles,
+                      open_n5_store, read_n5_block, relative_region, select_n5_level)
 
 
 def save_tif(filename, img):
     '''
     Save the given image to a TIFF file
     '''
-    with warnings.catch_warnings():
+    with warnings.catch_warnings(), telemetry.timed('tiff_files_written', 'tiff_write_seconds'):
         # Ignore "low contrast image" warnings
         warnings.simplefilter("ignore")
         skimage.io.imsave(filename, img)
+    telemetry.add(tiff_bytes_written=img.nbytes)
 
 
-def n5_block_to_tif(n5_path, data_set, output_file, start, end, dtype_override=None):
+def convert_dtype(img, dtype_override, contrast_range=None):
     '''
-    Write a block from the given n5 data set to a TIFF file
+    Convert the image to the given dtype. If a (low, high) contrast range is given,
+    the values are linearly rescaled so that low and high map to the limits of the
+    dtype, otherwise the conversion must be safe.
     '''
-    store = zarr.N5Store(n5_path+data_set)
-    volume = da.from_zarr(store)
-    block = volume[start[2]:end[2],start[1]:end[1],start[0]:end[0]]
-    if dtype_override and dtype_override != 'same':
-        block = block.astype(dtype_override, casting='safe')
+    if not dtype_override or dtype_override == 'same':
+        return img
+    if contrast_range is None:
+        return img.astype(dtype_override, casting='safe')
+    low, high = contrast_range
+    if np.issubdtype(np.dtype(dtype_override), np.integer):
+        info = np.iinfo(dtype_override)
+        out_min, out_max = float(info.min), float(info.max)
+    else:
+        out_min, out_max = 0.0, 1.0
+    scale = (out_max - out_min) / max(high - low, 1e-12)
+    rescaled = (img.astype(np.float32) - low) * scale + out_min
+    return rescaled.clip(out_min, out_max).astype(dtype_override)
+
+
+@telemetry.stage('n5_block_to_tif')
+def n5_block_to_tif(n5_path, data_set, output_file, start, end, dtype_override=None,
+                    contrast_range=None, downsampling_factors=None, voxel_size=None):
+    '''
+    Write a block from the given n5 data set to a TIFF file.
+    If downsampling factors or a voxel size are given, the block is read from
+    the best pyramid level, see n5_utils.read_n5_block.
+    '''
+    if downsampling_factors is not None or voxel_size is not None:
+        block = read_n5_block(n5_path, data_set, start, end,
+                              downsampling_factors=downsampling_factors,
+                              voxel_size=voxel_size).transpose(2, 1, 0)
+    else:
+        store = open_n5_store(n5_path+data_set)
+        volume = da.from_zarr(store)
+        block = volume[start[2]:end[2],start[1]:end[1],start[0]:end[0]]
+    block = convert_dtype(block, dtype_override, contrast_range)
     save_tif(output_file, block)
 
 
-def n5_volume_to_2d_tif_series(n5_path, data_set, output_dir, dtype_override=None, prefix=''):
+def read_boxes(boxes_file):
+    '''
+    Read the list of blocks to export from a JSON or CSV file.
+    JSON files contain a list of objects with "output", "start" and "end" (x,y,z) fields
+    and optional "scale" and "dtype" fields. CSV files contain the same fields as columns:
+    output,x1,y1,z1,x2,y2,z2[,scale][,dtype]
+    '''
+    if boxes_file.endswith('.json'):
+        with open(boxes_file) as f:
+            return [dict(output=b['output'],
+                         start=tuple(b['start']),
+                         end=tuple(b['end']),
+                         scale=b.get('scale'),
+                         dtype=b.get('dtype'))
+                    for b in json.load(f)]
+    boxes = []
+    with open(boxes_file) as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith('#') or row[0] == 'output':
+                continue
+            boxes.append(dict(output=row[0],
+                              start=tuple([int(c) for c in row[1:4]]),
+                              end=tuple([int(c) for c in row[4:7]]),
+                              scale=int(row[7]) if len(row) > 7 and row[7] else None,
+                              dtype=row[8] if len(row) > 8 and row[8] else None))
+    return boxes
+
+
+@telemetry.stage('n5_blocks_to_tifs')
+def n5_blocks_to_tifs(n5_path, data_set, boxes, dtype_override=None, workers=8,
+                      contrast_range=None, downsampling_factors=None, voxel_size=None):
+    '''
+    Write several blocks from the given n5 to TIFF files. Each chunk needed by any of
+    the blocks is decoded exactly once, in parallel, and copied into every block
+    that contains it. The chunks are decoded block after block, with at most two
+    chunks per worker in flight, and the buffer of a block is allocated when its
+    first chunk is copied and saved as soon as all its chunks were copied, so only
+    the blocks sharing chunks with the current one are in memory together.
+    boxes: list of dictionaries with the output file, the start and end (x,y,z)
+           coordinates, and optionally the scale level used instead of the level
+           of data_set and the output dtype. The boxes are clamped to the volume,
+           a box that does not intersect it raises a ValueError before any is written
+    downsampling_factors, voxel_size: read the boxes, given in data_set coordinates,
+           at this resolution (see n5_utils.read_n5_block)
+    '''
+    if downsampling_factors is not None or voxel_size is not None:
+        level, level_factors, remaining = select_n5_level(n5_path, data_set,
+                                                          downsampling_factors=downsampling_factors,
+                                                          voxel_size=voxel_size)
+        if any([r != 1 for r in remaining]):
+            # the remaining factors are applied to each block
+            def save_block(box):
+                block = read_n5_block(n5_path, data_set, box['start'], box['end'],
+                                      downsampling_factors=downsampling_factors,
+                                      voxel_size=voxel_size)
+                _save_block(box, block.transpose(2, 1, 0), dtype_override, contrast_range)
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(save_block, boxes))
+            return
+        # map the boxes to the coordinates of the level
+        boxes = [dict(box, scale=None,
+                      start=tuple([s // f for s, f in zip(box['start'], level_factors)]),
+                      end=tuple([-(-e // f) for e, f in zip(box['end'], level_factors)]))
+                 for box in boxes]
+        data_set = level
+
+    by_data_set = {}
+    for box in boxes:
+        box_data_set = data_set
+        if box.get('scale') is not None:
+            if not re.search(r's\d+/?$', data_set):
+                raise ValueError(f'{box["output"]}: a scale can only be given for a data set ' +
+                                 f'ending with its scale level, e.g. /s0, not {data_set!r}')
+            box_data_set = re.sub(r's\d+/?$', f's{box["scale"]}', data_set)
+        by_data_set.setdefault(box_data_set, []).append(box)
+
+    # validate all the boxes before exporting any of them
+    volumes = {}
+    # data set -> list of the clamped (z,y,x) start and end of its boxes
+    regions = {}
+    for box_data_set, data_set_boxes in by_data_set.items():
+        volume = zarr.open(store=open_n5_store(n5_path+box_data_set), mode='r')
+        volumes[box_data_set] = volume
+        regions[box_data_set] = []
+        for box in data_set_boxes:
+            start = [max(s, 0) for s in (box['start'][2], box['start'][1], box['start'][0])]
+            end = [min(e, d) for e, d in zip((box['end'][2], box['end'][1], box['end'][0]), volume.shape)]
+            if any([e <= s for s, e in zip(start, end)]):
+                raise ValueError(f'{box["output"]}: box {box["start"]}-{box["end"]} does not ' +
+                                 f'intersect {n5_path}{box_data_set} of shape {volume.shape[::-1]}')
+            regions[box_data_set].append((start, end))
+
+    for box_data_set, data_set_boxes in by_data_set.items():
+        volume = volumes[box_data_set]
+        # [buffer allocated on the first chunk, number of missing chunks] of every block
+        blocks = []
+        # chunk index -> list of (block index, region), ordered by the first block using it
+        chunk_users = {}
+        for block_idx, box in enumerate(data_set_boxes):
+            start, end = regions[box_data_set][block_idx]
+            blocks.append([None, 0])
+            for chunk_index, region, block_region, _ in chunk_intersections(
+                    volume.shape, volume.chunks, start, end):
+                chunk_users.setdefault(chunk_index, []).append((block_idx, region, block_region))
+                blocks[block_idx][1] += 1
+
+        print(f'Exporting {len(data_set_boxes)} blocks from {n5_path}{box_data_set} ' +
+              f'using {len(chunk_users)} chunks')
+
+        def read_chunk(chunk_index):
+            with telemetry.timed('chunks_decoded'):
+                return chunk_index, volume[get_chunk_region(volume.shape, volume.chunks, chunk_index)]
+
+        def decoded_chunks(executor):
+            # a bounded number of chunks is decoded ahead of the copies
+            pending = deque()
+            for chunk_index in list(chunk_users):
+                pending.append(executor.submit(read_chunk, chunk_index))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk_index, chunk_data in decoded_chunks(executor):
+                chunk_region = get_chunk_region(volume.shape, volume.chunks, chunk_index)
+                for block_idx, region, block_region in chunk_users.pop(chunk_index):
+                    block = blocks[block_idx]
+                    if block[0] is None:
+                        start, end = regions[box_data_set][block_idx]
+                        block[0] = np.empty([e - s for s, e in zip(start, end)], dtype=volume.dtype)
+                    block[0][block_region] = chunk_data[relative_region(region, chunk_region)]
+                    block[1] -= 1
+                    if block[1] == 0:
+                        _save_block(data_set_boxes[block_idx], block[0], dtype_override,
+                                    contrast_range)
+                        block[0] = None
+
+
+def _save_block(box, block, dtype_override, contrast_range=None):
+    block = convert_dtype(block, box.get('dtype') or dtype_override, contrast_range)
+    print('Saving', box['output'])
+    save_tif(box['output'], block)
+
+
+@telemetry.stage('n5_volume_to_2d_tif_series')
+def n5_volume_to_2d_tif_series(n5_path, data_set, output_dir, dtype_override=None, prefix='',
+                               contrast_range=None):
     '''
     Write n5 volume into 2D TIFF slices
     '''
-    store = zarr.N5Store(n5_path+"/"+data_set)
+    store = open_n5_store(n5_path+"/"+data_set)
     volume = da.from_zarr(store)
 
     def save_file(arr, block_info=None):
         slice_num = block_info[0]["chunk-location"][0]
         slice_img = arr[0]
         filename = "%s/%s%d.tif" % (output_dir, prefix, slice_num)
-        if dtype_override and dtype_override != 'same':
-            slice_img = slice_img.astype(dtype_override, casting='safe')
+        slice_img = convert_dtype(slice_img, dtype_override, contrast_range)
         save_tif(filename, slice_img)
         return arr
 
@@ -51,6 +239,57 @@ def n5_volume_to_2d_tif_series(n5_path, data_set, output_dir, dtype_override=Non
     slices.map_blocks(save_file, dtype=slices.dtype).compute() # call function on every block
 
 
+@telemetry.stage('n5_volume_to_tif_slabs')
+def n5_volume_to_tif_slabs(n5_path, data_set, output_dir, dtype_override=None, prefix='',
+                           workers=4, bigtiff_slabs=False, contrast_range=None):
+    '''
+    Write n5 volume into 2D TIFF slices, reading one chunk-high Z slab at a time.
+    The chunks of a slab are decoded and its slices are written in parallel,
+    so memory is bounded to about one slab.
+    If bigtiff_slabs is set, each slab is written to a single multi-page BigTIFF
+    named after its first and last slice instead.
+    '''
+    volume = zarr.open(store=open_n5_store(n5_path+"/"+data_set), mode='r')
+    chunk_z = volume.chunks[0]
+
+    def read_chunk(region):
+        with telemetry.timed('chunks_decoded'):
+            return region, volume[region]
+
+    def save_slice(slice_num, slice_img):
+        filename = "%s/%s%d.tif" % (output_dir, prefix, slice_num)
+        save_tif(filename, slice_img)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for z in range(0, volume.shape[0], chunk_z):
+            slab_start = (z, 0, 0)
+            slab_end = (min(z + chunk_z, volume.shape[0]),) + volume.shape[1:]
+            print('Writing slices', slab_start[0], 'to', slab_end[0] - 1)
+            slab = np.empty([e - s for s, e in zip(slab_start, slab_end)], dtype=volume.dtype)
+            slab_region = tuple([slice(s, e) for s, e in zip(slab_start, slab_end)])
+            regions = [r for _, r, _, _ in chunk_intersections(volume.shape, volume.chunks,
+                                                               slab_start, slab_end)]
+            for region, data in executor.map(read_chunk, regions):
+                slab[relative_region(region, slab_region)] = data
+            slab = convert_dtype(slab, dtype_override, contrast_range)
+
+            if bigtiff_slabs:
+                filename = "%s/%s%d-%d.tif" % (output_dir, prefix, slab_start[0], slab_end[0] - 1)
+                with telemetry.timed('tiff_files_written', 'tiff_write_seconds'):
+                    tifffile.imwrite(filename, slab, bigtiff=True)
+                telemetry.add(tiff_bytes_written=slab.nbytes)
+            else:
+                list(executor.map(save_slice, range(slab_start[0], slab_end[0]), slab))
+            del slab
+
+
+def _parse_factors(value):
+    if value is None:
+        return None
+    factors = [float(c) for c in value.split(',')]
+    return factors * 3 if len(factors) == 1 else factors
+
+
 def main():
     parser = argparse.ArgumentParser(description='Convert a TIFF series to a chunked n5 volume')
 
@@ -60,7 +299,7 @@ def main():
     parser.add_argument('-d', '--data_set', dest='data_set', type=str, default="/s0", \
         help='Path to data set (default "/s0")')
 
-    parser.add_argument('-o', '--output', dest='output_path', type=str, required=True, \
+    parser.add_argument('-o', '--output', dest='output_path', type=str, \
         help='Path to the output TIFF file (if exporting single block) or directory containing TIFF series')
 
     parser.add_argument('--start', dest='start_coord', type=str, default=None, metavar='x1,y1,z1', \
@@ -69,21 +308,93 @@ def main():
     parser.add_argument('--end', dest='end_coord', type=str, default=None, metavar='x2,y2,z2', \
         help='Ending coordinate (x,y,z)')
 
+    parser.add_argument('--boxes', dest='boxes_file', type=str, default=None, \
+        help='JSON or CSV file listing several blocks to export, instead of --start/--end')
+
     parser.add_argument('--dtype', dest='dtype', type=str, default='same', \
         help='Set the output dtype. Use "same" to keep the same dtype as the input. (default=same)')
 
+    parser.add_argument('--streaming', dest='streaming', action='store_true', \
+        help='Export the TIFF series one chunk-high slab at a time, with bounded memory')
+    parser.set_defaults(streaming=False)
+
+    parser.add_argument('--bigtiff_slabs', dest='bigtiff_slabs', action='store_true', \
+        help='If --streaming is set, write one multi-page BigTIFF per slab instead of one TIFF per slice')
+    parser.set_defaults(bigtiff_slabs=False)
+
+    parser.add_argument('--workers', dest='workers', type=int, default=4, \
+        help='If --streaming or --boxes is set, this specifies the number of threads (default 4)')
+
+    parser.add_argument('--downsampling_factors', dest='downsampling_factors', type=str, default=None, \
+        metavar='x,y,z', help='Export the data downsampled by these factors (one value or x,y,z), ' + \
+             'reading the coarsest pyramid level that is fine enough and resampling only the rest. ' + \
+             '--start/--end and --boxes are still given in the coordinates of --data_set.')
+
+    parser.add_argument('--voxel_size', dest='voxel_size', type=str, default=None, metavar='x,y,z', \
+        help='Export the data at this voxel size (one value or x,y,z), in the units of the ' + \
+             'pixelResolution of the n5, like --downsampling_factors')
+
+    parser.add_argument('--auto_contrast', dest='auto_contrast', type=str, default=None, metavar='low,high', \
+        help='Rescale the values between these percentiles of the nonzero voxels to the range of --dtype, ' + \
+             'e.g. 0.5,99.5. The percentiles come from the chunk statistics of the data set.')
+
+    telemetry.add_telemetry_arguments(parser)
+
     args = parser.parse_args()
 
+    telemetry.setup_telemetry('n5_to_tif', args.telemetry, args.profile)
+
     from dask.diagnostics import ProgressBar
     pbar = ProgressBar()
     pbar.register()
 
-    if args.start_coord and args.end_coord:
+    if not args.boxes_file and not args.output_path:
+        parser.error('--output is required unless --boxes is set')
+
+    contrast_range = None
+    if args.auto_contrast:
+        percentiles = [float(p) for p in args.auto_contrast.split(',')]
+        # sparse volumes are mostly zero, so only the nonzero voxels are considered
+        contrast_range = get_n5_percentiles(args.input_path, args.data_set, percentiles,
+                                            ignore_zeros=True)
+        if contrast_range is None:
+            parser.error(f'{args.input_path}{args.data_set} has no chunk statistics, ' + \
+                         'create them with n5_stats.py --build')
+        print(f'Contrast range for percentiles {percentiles}: {contrast_range}')
+
+    downsampling_factors = _parse_factors(args.downsampling_factors)
+    voxel_size = _parse_factors(args.voxel_size)
+    resampled = downsampling_factors is not None or voxel_size is not None
+
+    if args.boxes_file:
+        n5_blocks_to_tifs(args.input_path, args.data_set, read_boxes(args.boxes_file),
+                          dtype_override=args.dtype, workers=args.workers,
+                          contrast_range=contrast_range,
+                          downsampling_factors=downsampling_factors, voxel_size=voxel_size)
+    elif args.start_coord and args.end_coord:
         start = tuple([int(d) for d in args.start_coord.split(',')])
         end = tuple([int(d) for d in args.end_coord.split(',')])
-        n5_block_to_tif(args.input_path, args.data_set, args.output_path, start, end, dtype_override=args.dtype)
+        n5_block_to_tif(args.input_path, args.data_set, args.output_path, start, end, dtype_override=args.dtype,
+                        contrast_range=contrast_range,
+                        downsampling_factors=downsampling_factors, voxel_size=voxel_size)
     else:
-        n5_volume_to_2d_tif_series(args.input_path, args.data_set, args.output_path, dtype_override=args.dtype)
+        data_set = args.data_set
+        if resampled:
+            data_set, _, remaining = select_n5_level(args.input_path, args.data_set,
+                                                     downsampling_factors=downsampling_factors,
+                                                     voxel_size=voxel_size)
+            if any([r != 1 for r in remaining]):
+                parser.error(f'No pyramid level of {args.input_path}{args.data_set} matches the ' + \
+                             f'requested resolution (remaining factors {remaining}), use --start/--end')
+            print(f'Exporting {data_set}')
+        if args.streaming:
+            n5_volume_to_tif_slabs(args.input_path, data_set, args.output_path, dtype_override=args.dtype,
+                                   workers=args.workers, bigtiff_slabs=args.bigtiff_slabs,
+                                   contrast_range=contrast_range)
+        else:
+            n5_volume_to_2d_tif_series(args.input_path, data_set, args.output_path, dtype_override=args.dtype,
+                                       contrast_range=contrast_range)
+
 
 
 if __name__ == "__main__":
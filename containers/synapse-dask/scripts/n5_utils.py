@@ -1,40 +1,1935 @@
 """
 Common utilities for reading n5 formatted data
 """
+import atexit
+import fcntl
+import itertools
+import json
+import math
+import multiprocessing.util
+import os
+import shutil
+import threading
+import numcodecs
+import numpy as np
 import zarr
 import re
+import time
 
+import telemetry
 
-def read_n5_block(path, data_set, start, end):
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+# Sidecar file of a data set with one bit per chunk, see OccupancyIndex
+OCCUPANCY_FILENAME = 'occupancy.bin'
+
+# Suffix of the n5 group holding the per-chunk statistics of a data set,
+# and the fields of its summary array, see ChunkStats
+CHUNK_STATS_SUFFIX = '-chunkstats'
+CHUNK_STATS_FIELDS = ('count', 'nonzero', 'min', 'max', 'sum')
+
+# Number of data set chunks along each axis of a chunk of the statistics arrays,
+# the lock file of the statistics chunks and the longest time the statistics
+# written with autoflush are buffered, see ChunkStats
+STATS_CHUNK_SIZE = 4
+STATS_LOCK_FILENAME = 'stats.lock'
+STATS_FLUSH_SECONDS = 10
+
+# Number of statistics chunks per shard along each axis of the statistics
+# arrays (the chunk grid axes and the field or bin axis) in sharded containers
+STATS_SHARD_CHUNKS = (4, 4, 4, 1)
+
+# Sidecar file of a data set holding the advisory per-chunk write locks, see ChunkLocks
+CHUNK_LOCK_FILENAME = 'chunks.lock'
+
+# Sharded zarr v3 containers, see ShardedStore: the metadata document of every
+# group and array, the lock file of the shards of an array, the default number
+# of chunks per shard along each axis and the index entry of a missing chunk
+ZARR_JSON = 'zarr.json'
+SHARD_LOCK_FILENAME = 'shards.lock'
+DEFAULT_SHARD_CHUNKS = (4, 4, 4)
+MISSING_CHUNK = 2**64 - 1
+
+# Table of the CRC-32C (Castagnoli) checksum of the shard indexes written by
+# zarr v3 implementations with the "crc32c" index codec, see _crc32c
+_CRC32C_TABLE = []
+for _byte in range(256):
+    for _ in range(8):
+        _byte = (_byte >> 1) ^ 0x82F63B78 if _byte & 1 else _byte >> 1
+    _CRC32C_TABLE.append(_byte)
+
+
+class ChunkCache:
+    """
+    Thread safe LRU cache of decoded chunks bounded by the total number
+    of bytes held by the cached arrays.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            chunk = self._chunks.get(key)
+            if chunk is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._chunks.move_to_end(key)
+            return chunk
+
+    def put(self, key, chunk):
+        if chunk.nbytes > self.max_bytes:
+            self.invalidate(key)
+            return
+        with self._lock:
+            previous = self._chunks.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous.nbytes
+            self._chunks[key] = chunk
+            self.current_bytes += chunk.nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._chunks.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            previous = self._chunks.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous.nbytes
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._chunks.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'chunks': len(self._chunks),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+class OccupancyIndex:
+    """
+    One bit per chunk of a data set telling whether the chunk holds any
+    value other than the fill value. The bits are packed in the C order
+    of the chunk grid and kept in a sidecar file next to the chunks.
+    Concurrent writers merge their updates into the file under a lock,
+    and the bits are reloaded whenever the file changed since they were read.
+    A data set without the sidecar has no index and all its chunks
+    are considered occupied.
+    """
+
+    def __init__(self, n5_path, grid):
+        self.path = os.path.join(n5_path, OCCUPANCY_FILENAME)
+        self.grid = tuple(grid)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._version = None
+        self.bits = self._load()
+
+    def exists(self):
+        self.refresh()
+        return self.bits is not None
+
+    def is_occupied(self, chunk_index):
+        self.refresh()
+        return self.bits is None or bool(self.bits[chunk_index])
+
+    def count(self, start=None, end=None):
+        """
+        Returns the number of occupied chunks in the [start, end) range
+        of chunk grid coordinates, or None if there is no index
+        """
+        self.refresh()
+        if self.bits is None:
+            return None
+        region = tuple([slice(s, e) for s, e in
+                        zip(start or (0,) * len(self.grid), end or self.grid)])
+        return int(np.count_nonzero(self.bits[region]))
+
+    def refresh(self):
+        """
+        Reloads the bits if another writer updated the sidecar file,
+        keeping the updates that were not flushed yet
+        """
+        with self._lock:
+            if self._stat() == self._version:
+                return
+            self.bits = self._load()
+            if self.bits is not None:
+                for chunk_index, occupied in self._pending.items():
+                    self.bits[chunk_index] = occupied
+
+    def mark(self, chunk_index, occupied):
+        with self._lock:
+            self._pending[tuple(chunk_index)] = occupied
+            if self.bits is not None:
+                self.bits[chunk_index] = occupied
+
+    def flush(self, create=False):
+        """
+        Writes the pending updates to the sidecar file, only rewriting the
+        bytes that hold the updated bits. The file is only created if
+        create is set, otherwise the updates of a data set without an index
+        are dropped.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if not create and (not pending or not os.path.exists(self.path)):
+                return
+            with open(self.path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if not os.path.exists(self.path):
+                    if not create:
+                        return
+                    tmp_path = f'{self.path}.{os.getpid()}.tmp'
+                    with open(tmp_path, 'wb') as f:
+                        f.write(bytes(-(-int(np.prod(self.grid)) // 8)))
+                    os.replace(tmp_path, self.path)
+                # bits are packed most significant first, as by np.packbits
+                updates = {}
+                for chunk_index, occupied in pending.items():
+                    bit = int(np.ravel_multi_index(chunk_index, self.grid))
+                    updates.setdefault(bit // 8, []).append((0x80 >> (bit % 8), occupied))
+                fd = os.open(self.path, os.O_RDWR)
+                try:
+                    for offset, masks in sorted(updates.items()):
+                        value = os.pread(fd, 1, offset)[0]
+                        for mask, occupied in masks:
+                            value = value | mask if occupied else value & ~mask
+                        os.pwrite(fd, bytes([value]), offset)
+                finally:
+                    os.close(fd)
+                if self.bits is None:
+                    self.bits = self._load()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        self._version = self._stat()
+        try:
+            with open(self.path, 'rb') as f:
+                packed = np.frombuffer(f.read(), dtype=np.uint8)
+        except FileNotFoundError:
+            self._version = None
+            return None
+        size = int(np.prod(self.grid))
+        return np.unpackbits(packed, count=size).astype(bool).reshape(self.grid)
+
+
+class ChunkStats:
+    """
+    Per-chunk statistics of a data set, stored in a group next to it (an n5
+    group, or a sharded zarr v3 group in a sharded container):
+    a "summary" array with the CHUNK_STATS_FIELDS of every chunk and a
+    "histogram" array with fixed-width bins over the value range given
+    by the "range" attribute (values outside the range go to the first or
+    the last bin). Both arrays are indexed by the chunk grid coordinates.
+    Chunks with a count of 0 were never written or only hold the fill value.
+    A data set without the group has no statistics, and a group whose grid
+    does not match the data set (left by a previous data set of the same
+    name, see remove_chunk_stats) is ignored.
+    The statistics of the written chunks are buffered until flush(), and
+    each writer only locks the chunks of the statistics arrays it updates,
+    so that concurrent writers of different regions do not wait for each other.
+    """
+
+    def __init__(self, stats_path, grid):
+        self.path = stats_path
+        self.grid = tuple(grid)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self.summary = None
+        if os.path.isdir(stats_path):
+            group = zarr.open(store=open_n5_store(stats_path), mode='a')
+            if group['summary'].shape[:-1] != self.grid:
+                print(f'Ignoring the chunk statistics {stats_path}: their grid '
+                      f'{group["summary"].shape[:-1]} does not match the data set grid {self.grid}')
+                return
+            self.summary = group['summary']
+            self.histogram = group['histogram']
+            self.bins = int(group.attrs['bins'])
+            self.value_range = tuple(group.attrs['range'])
+
+    def exists(self):
+        return self.summary is not None
+
+    def record(self, chunk_index, chunk_data):
+        """
+        Computes the statistics of a chunk, or clears them if chunk_data is None
+        """
+        if not self.exists():
+            return
+        summary = np.zeros(len(CHUNK_STATS_FIELDS), dtype=np.float64)
+        histogram = np.zeros(self.bins, dtype=np.uint64)
+        if chunk_data is not None:
+            summary[:] = [chunk_data.size, np.count_nonzero(chunk_data),
+                          chunk_data.min(), chunk_data.max(),
+                          chunk_data.sum(dtype=np.float64)]
+            histogram = chunk_histogram(chunk_data, self.bins, self.value_range)
+        with self._lock:
+            self._pending[tuple(chunk_index)] = (summary, histogram)
+        _register_stats_flush()
+
+    def flush(self, max_age=None):
+        """
+        Writes the pending statistics, updating each chunk of the statistics
+        arrays once, under the lock of that chunk shared with other writers.
+        If max_age is set, nothing is written unless the last flush is older
+        than max_age seconds.
+        """
+        with self._lock:
+            if max_age is not None and time.time() - self._last_flush < max_age:
+                return
+            self._last_flush = time.time()
+            pending, self._pending = self._pending, {}
+            if not pending or not self.exists():
+                return
+            stats_chunks = self.summary.chunks[:len(self.grid)]
+            locks = _get_locks(self.path, _chunk_grid(self.summary)[:len(self.grid)],
+                               STATS_LOCK_FILENAME)
+            by_stats_chunk = {}
+            for chunk_index, stats in pending.items():
+                stats_chunk = tuple([i // c for i, c in zip(chunk_index, stats_chunks)])
+                by_stats_chunk.setdefault(stats_chunk, []).append((chunk_index, stats))
+            for stats_chunk, entries in sorted(by_stats_chunk.items()):
+                region = get_chunk_region(self.grid, stats_chunks, stats_chunk)
+                with locks.lock(stats_chunk):
+                    summary = self.summary[region]
+                    histogram = self.histogram[region]
+                    for chunk_index, (chunk_summary, chunk_histogram) in entries:
+                        local = tuple([i - r.start for i, r in zip(chunk_index, region)])
+                        summary[local] = chunk_summary
+                        histogram[local] = chunk_histogram
+                    self.summary[region] = summary
+                    self.histogram[region] = histogram
+
+
+class ChunkLocks:
+    """
+    Advisory per-chunk write locks of a data set, for writers whose blocks
+    are not aligned to the chunk grid and would otherwise race on the
+    read-modify-write of the chunks they share. The lock of a chunk is an
+    fcntl record lock on one byte of a sidecar file, at the C order index
+    of the chunk, so writers in other processes (and on other hosts, if the
+    file system supports POSIX locks) wait for each other. Record locks
+    belong to the process, so the threads of a process also take a thread
+    lock per chunk, and there must be a single instance per lock file (see
+    get_chunk_locks).
+    """
+
+    def __init__(self, n5_path, grid, filename=CHUNK_LOCK_FILENAME):
+        self.path = os.path.join(n5_path, filename)
+        self.grid = tuple(grid)
+        self._fd = None
+        self._thread_locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lock(self, chunk_index):
+        chunk_index = tuple(chunk_index)
+        with self._lock:
+            if self._fd is None:
+                # never closed: closing any descriptor of the file
+                # would release all the locks held by the process
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            thread_lock = self._thread_locks.setdefault(chunk_index, threading.Lock())
+        offset = int(np.ravel_multi_index(chunk_index, self.grid))
+        with thread_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+
+
+# Open arrays and their stores keyed by their n5 path, shared by all
+# reads and writes done in this process
+_n5_arrays = {}
+_n5_stores = {}
+_n5_arrays_lock = threading.Lock()
+
+# Decoded chunks keyed by (n5 path, chunk index). The memory ceiling
+# (in bytes) can be set with the N5_CHUNK_CACHE_BYTES environment variable
+# or with set_chunk_cache_size(); a size of 0 disables the cache.
+_chunk_cache = ChunkCache(int(os.environ.get('N5_CHUNK_CACHE_BYTES',
+                                             1024 * 1024 * 1024)))
+
+# Occupancy indexes and chunk statistics keyed by their n5 path, loaded once per process.
+# The pending statistics are flushed when the process exits.
+_occupancy = {}
+_chunk_stats = {}
+_stats_flush_pid = None
+
+# Chunk locks keyed by their lock file. They are kept when the arrays are
+# closed, since their lock files must stay open while the process runs.
+_chunk_locks = {}
+
+# Set for the current thread while _write_region buffers the chunks written
+# to sharded arrays, see ShardedStore
+_shard_buffering = threading.local()
+
+
+class InstrumentedStore(MutableMapping):
+    """
+    Store wrapper counting the bytes and the time of the reads and writes
+    of the wrapped store in the telemetry (see telemetry.record_io)
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, key):
+        start = time.perf_counter()
+        value = self.store[key]
+        telemetry.record_io('read', len(value), time.perf_counter() - start)
+        return value
+
+    def __setitem__(self, key, value):
+        start = time.perf_counter()
+        self.store[key] = value
+        telemetry.record_io('written', len(value), time.perf_counter() - start)
+
+    def __delitem__(self, key):
+        del self.store[key]
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def listdir(self, path=None):
+        return self.store.listdir(path)
+
+    def rmdir(self, path=None):
+        return self.store.rmdir(path)
+
+    def getsize(self, path=None):
+        return self.store.getsize(path)
+
+    def flush(self, keys=None):
+        if not hasattr(self.store, 'flush'):
+            return 0
+        start = time.perf_counter()
+        nbytes = self.store.flush(keys)
+        if nbytes:
+            telemetry.record_io('written', nbytes, time.perf_counter() - start)
+        return nbytes
+
+
+class ShardedStore(MutableMapping):
+    """
+    zarr store of a zarr v3 container whose arrays use the "sharding_indexed"
+    codec: the chunks of a shard (shard_chunks chunks along each axis) are
+    packed into one file, followed by an index with the offset and the size
+    of every chunk, so that the container holds far fewer files than an n5.
+    The zarr v2 metadata keys used by the scripts are translated to and from
+    the zarr.json documents of the v3 groups and arrays. zarr encodes the
+    chunks in C order, little endian, with the array compressor, which is
+    also their encoding in the shards, and every chunk is read with a ranged
+    read of its shard.
+    Writing chunks rewrites their shard, merged with its current content,
+    under a lock shared with the other writers. The chunks written by
+    _write_region are buffered until flush() is called, so that the chunks of
+    a shard are usually written together.
+    Besides the zarr.json documents and the shards, the directory of an array
+    holds the sidecar files of the scripts, which zarr v3 readers ignore: the
+    lock files (SHARD_LOCK_FILENAME, CHUNK_LOCK_FILENAME) and the occupancy
+    index (OCCUPANCY_FILENAME). The chunk statistics of an array are a sharded
+    group next to it, see ChunkStats.
+    shard_chunks: number of chunks per shard along each axis of the arrays
+                  created through this store (default DEFAULT_SHARD_CHUNKS)
+    """
+
+    def __init__(self, path, shard_chunks=None):
+        self.path = path
+        self.shard_chunks = tuple(shard_chunks or DEFAULT_SHARD_CHUNKS)
+        self._arrays = {}
+        self._indexes = OrderedDict()
+        # (array prefix, shard index) -> {chunk index in the shard: data or None}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        prefix, name = _split_key(key)
+        chunk_index = _parse_chunk_key(name)
+        if chunk_index is not None:
+            return self._read_chunk(prefix, chunk_index)
+        document = self._read_document(prefix)
+        if name == '.zarray' and document and document['node_type'] == 'array':
+            return json.dumps(_v2_array_metadata(document)).encode()
+        if name == '.zgroup' and document and document['node_type'] == 'group':
+            return json.dumps({'zarr_format': 2}).encode()
+        if name == '.zattrs' and document:
+            return json.dumps(document.get('attributes', {})).encode()
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        prefix, name = _split_key(key)
+        chunk_index = _parse_chunk_key(name)
+        if chunk_index is not None:
+            self._write_chunk(prefix, chunk_index, bytes(value))
+            return
+        document = self._read_document(prefix)
+        attributes = document.get('attributes', {}) if document else {}
+        if name == '.zarray':
+            document = _v3_array_metadata(json.loads(value), self.shard_chunks)
+            document['attributes'] = attributes
+        elif name == '.zgroup':
+            if document and document['node_type'] == 'group':
+                return
+            document = {'zarr_format': 3, 'node_type': 'group', 'attributes': attributes}
+        elif name == '.zattrs':
+            document = document or {'zarr_format': 3, 'node_type': 'group'}
+            document['attributes'] = json.loads(value)
+        else:
+            raise KeyError(f'{key} is not supported by sharded containers')
+        self._write_document(prefix, document)
+
+    def __delitem__(self, key):
+        prefix, name = _split_key(key)
+        chunk_index = _parse_chunk_key(name)
+        if chunk_index is not None:
+            if chunk_index not in self._chunk_indexes(prefix, chunk_index):
+                raise KeyError(key)
+            self._write_chunk(prefix, chunk_index, None)
+            return
+        document = self._read_document(prefix)
+        if document is None or name not in ['.zarray', '.zgroup', '.zattrs']:
+            raise KeyError(key)
+        if name == '.zattrs':
+            document['attributes'] = {}
+            self._write_document(prefix, document)
+        else:
+            os.remove(os.path.join(self._dir(prefix), ZARR_JSON))
+            self._forget(prefix)
+
+    def __contains__(self, key):
+        prefix, name = _split_key(key)
+        chunk_index = _parse_chunk_key(name)
+        if chunk_index is not None:
+            return chunk_index in self._chunk_indexes(prefix, chunk_index)
+        document = self._read_document(prefix)
+        return document is not None and (name == '.zattrs' or
+                                         (name, document['node_type']) in [('.zarray', 'array'),
+                                                                           ('.zgroup', 'group')])
+
+    def __iter__(self):
+        for dirpath, dirnames, _ in os.walk(self.path):
+            prefix = os.path.relpath(dirpath, self.path).replace(os.sep, '/')
+            prefix = '' if prefix == '.' else prefix
+            for name in self.listdir(prefix):
+                if name not in dirnames:
+                    yield f'{prefix}/{name}' if prefix else name
+            if 'c' in dirnames and self._array(prefix, required=False):
+                dirnames.remove('c')
+
+    def __len__(self):
+        return sum([1 for _ in self])
+
+    def listdir(self, path=None):
+        prefix = (path or '').strip('/')
+        directory = self._dir(prefix)
+        if not os.path.isdir(directory):
+            return []
+        document = self._read_document(prefix)
+        names = sorted([n for n in os.listdir(directory) if os.path.isdir(os.path.join(directory, n))])
+        if document is None:
+            return names
+        if document['node_type'] == 'group':
+            return ['.zattrs', '.zgroup'] + names
+        array = self._array(prefix)
+        chunk_keys = set()
+        for _, chunk_indexes in self.iter_shards(prefix):
+            chunk_keys.update(['.'.join([str(i) for i in chunk_index]) for chunk_index in chunk_indexes])
+        with self._lock:
+            for (pending_prefix, shard_index), chunks in self._pending.items():
+                if pending_prefix != prefix:
+                    continue
+                for inner, data in chunks.items():
+                    key = '.'.join([str(s * n + i) for s, n, i in
+                                    zip(shard_index, array['shard_chunks'], inner)])
+                    if data is None:
+                        chunk_keys.discard(key)
+                    else:
+                        chunk_keys.add(key)
+        # the chunks come first, so they can be deleted in the listed order
+        return sorted(chunk_keys) + ['.zattrs', '.zarray'] + [n for n in names if n != 'c']
+
+    def rmdir(self, path=None):
+        prefix = (path or '').strip('/')
+        shutil.rmtree(self._dir(prefix), ignore_errors=True)
+        self._forget(prefix)
+
+    def flush(self, keys=None):
+        """
+        Writes the buffered chunks, or only the shards of the given chunk keys,
+        and returns the number of bytes written
+        """
+        if keys is None:
+            with self._lock:
+                shards = list(self._pending)
+        else:
+            shards = set()
+            for key in keys:
+                prefix, name = _split_key(key)
+                shards.add((prefix, self._locate(prefix, _parse_chunk_key(name))[1]))
+        return sum([self._flush_shard(prefix, shard_index) for prefix, shard_index in sorted(shards)])
+
+    def iter_shards(self, prefix=''):
+        """
+        Iterates over the shard files of an array and yields their path
+        and the list of the indexes of the chunks they hold
+        """
+        array = self._array(prefix)
+        shards_dir = os.path.join(self._dir(prefix), 'c')
+        for dirpath, _, filenames in os.walk(shards_dir):
+            for filename in filenames:
+                relpath = os.path.relpath(os.path.join(dirpath, filename), shards_dir)
+                try:
+                    shard_index = tuple([int(p) for p in relpath.split(os.sep)])
+                except ValueError:
+                    continue
+                yield os.path.join(dirpath, filename), list(self._shard_chunks(prefix, array, shard_index))
+
+    def __getstate__(self):
+        # the buffered chunks stay with the store of the process that wrote them
+        return {'path': self.path, 'shard_chunks': self.shard_chunks}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['shard_chunks'])
+
+    def _dir(self, prefix):
+        return os.path.join(self.path, prefix) if prefix else self.path
+
+    def _read_document(self, prefix):
+        try:
+            with open(os.path.join(self._dir(prefix), ZARR_JSON)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_document(self, prefix, document):
+        directory = self._dir(prefix)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, ZARR_JSON)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(document, f, indent=2)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._arrays.pop(prefix, None)
+
+    def _forget(self, prefix):
+        with self._lock:
+            for cache in [self._arrays, self._pending]:
+                for key in list(cache):
+                    key_prefix = key[0] if isinstance(key, tuple) else key
+                    if not prefix or key_prefix == prefix or key_prefix.startswith(prefix + '/'):
+                        del cache[key]
+            self._indexes.clear()
+
+    def _array(self, prefix, required=True):
+        """
+        Returns the shape and the chunk and shard grids of an array, cached
+        until its zarr.json is replaced, e.g. when the array is recreated
+        """
+        try:
+            st = os.stat(os.path.join(self._dir(prefix), ZARR_JSON))
+            version = (st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            version = None
+        with self._lock:
+            cached = self._arrays.get(prefix)
+        array = cached[1] if cached is not None and cached[0] == version else None
+        if array is None:
+            document = self._read_document(prefix) if version else None
+            if document is None or document['node_type'] != 'array':
+                if required:
+                    raise KeyError(prefix)
+                return None
+            shape = tuple(document['shape'])
+            sharding = document['codecs'][0]['configuration']
+            chunks = tuple(sharding['chunk_shape'])
+            shard_shape = tuple(document['chunk_grid']['configuration']['chunk_shape'])
+            shard_chunks = tuple([s // c for s, c in zip(shard_shape, chunks)])
+            array = {
+                'shape': shape,
+                'chunks': chunks,
+                'shard_chunks': shard_chunks,
+                'grid': tuple([-(-d // c) for d, c in zip(shape, chunks)]),
+                'shard_grid': tuple([-(-d // s) for d, s in zip(shape, shard_shape)]),
+                'index_checksum': _has_index_checksum(sharding),
+            }
+            with self._lock:
+                self._arrays[prefix] = (version, array)
+        return array
+
+    def _shard_path(self, prefix, shard_index):
+        return os.path.join(self._dir(prefix), 'c', *[str(i) for i in shard_index])
+
+    def _locate(self, prefix, chunk_index):
+        array = self._array(prefix)
+        shard_index = tuple([i // n for i, n in zip(chunk_index, array['shard_chunks'])])
+        inner = tuple([i % n for i, n in zip(chunk_index, array['shard_chunks'])])
+        return array, shard_index, inner
+
+    def _shard_chunks(self, prefix, array, shard_index):
+        """
+        Iterates over the indexes of the chunks stored in the given shard file
+        """
+        index = self._read_index(prefix, array, shard_index)
+        if index is None:
+            return
+        for inner in zip(*np.nonzero(index[..., 0] != MISSING_CHUNK)):
+            yield tuple([s * n + int(i) for s, n, i in zip(shard_index, array['shard_chunks'], inner)])
+
+    def _chunk_indexes(self, prefix, chunk_index):
+        """
+        Returns the set with chunk_index if the chunk exists, otherwise an empty set
+        """
+        try:
+            array, shard_index, inner = self._locate(prefix, chunk_index)
+        except KeyError:
+            return set()
+        with self._lock:
+            chunks = self._pending.get((prefix, shard_index), {})
+            if inner in chunks:
+                return set() if chunks[inner] is None else set([chunk_index])
+        index = self._read_index(prefix, array, shard_index)
+        return set([chunk_index]) if index is not None and index[inner][0] != MISSING_CHUNK else set()
+
+    def _read_index(self, prefix, array, shard_index, fd=None):
+        """
+        Returns the (offset, nbytes) index of a shard file as an array of shape
+        shard_chunks + (2,), or None if the shard does not exist. The indexes are
+        cached and reloaded when the shard file is replaced.
+        """
+        path = self._shard_path(prefix, shard_index)
+        if fd is None:
+            # the size and the index must come from the same file, which a writer may replace
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                return None
+            try:
+                return self._read_index(prefix, array, shard_index, fd)
+            finally:
+                os.close(fd)
+        st = os.fstat(fd)
+        version = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            cached = self._indexes.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        index_bytes = 16 * int(np.prod(array['shard_chunks']))
+        if array['index_checksum']:
+            index_bytes += 4
+        data = os.pread(fd, index_bytes, st.st_size - index_bytes)
+        if array['index_checksum']:
+            data, checksum = data[:-4], int.from_bytes(data[-4:], 'little')
+            if _crc32c(data) != checksum:
+                raise ValueError(f'Corrupted shard index: {path}')
+        index = np.frombuffer(data, dtype='<u8').reshape(array['shard_chunks'] + (2,))
+        with self._lock:
+            self._indexes[path] = (version, index)
+            if len(self._indexes) > 4096:
+                self._indexes.popitem(last=False)
+        return index
+
+    def _read_chunk(self, prefix, chunk_index):
+        array, shard_index, inner = self._locate(prefix, chunk_index)
+        with self._lock:
+            chunks = self._pending.get((prefix, shard_index), {})
+            if inner in chunks:
+                if chunks[inner] is None:
+                    raise KeyError(chunk_index)
+                return chunks[inner]
+        try:
+            fd = os.open(self._shard_path(prefix, shard_index), os.O_RDONLY)
+        except FileNotFoundError:
+            raise KeyError(chunk_index)
+        try:
+            # the index of the open file, which a writer may replace meanwhile
+            offset, nbytes = self._read_index(prefix, array, shard_index, fd)[inner]
+            if offset == MISSING_CHUNK:
+                raise KeyError(chunk_index)
+            return os.pread(fd, int(nbytes), int(offset))
+        finally:
+            os.close(fd)
+
+    def _write_chunk(self, prefix, chunk_index, data):
+        _, shard_index, inner = self._locate(prefix, chunk_index)
+        with self._lock:
+            self._pending.setdefault((prefix, shard_index), {})[inner] = data
+        if not getattr(_shard_buffering, 'enabled', False):
+            self._flush_shard(prefix, shard_index)
+
+    def _flush_shard(self, prefix, shard_index):
+        with self._lock:
+            chunks = self._pending.pop((prefix, shard_index), None)
+        if not chunks:
+            return 0
+        array = self._array(prefix)
+        path = self._shard_path(prefix, shard_index)
+        locks = _get_locks(self._dir(prefix), array['shard_grid'], SHARD_LOCK_FILENAME)
+        with locks.lock(shard_index):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                fd = None
+            if fd is not None:
+                try:
+                    index = self._read_index(prefix, array, shard_index, fd)
+                    for inner in zip(*np.nonzero(index[..., 0] != MISSING_CHUNK)):
+                        inner = tuple([int(i) for i in inner])
+                        if inner not in chunks:
+                            offset, nbytes = index[inner]
+                            chunks[inner] = os.pread(fd, int(nbytes), int(offset))
+                finally:
+                    os.close(fd)
+            chunks = dict([(inner, data) for inner, data in chunks.items() if data is not None])
+            if not chunks:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                return 0
+            index = np.full(array['shard_chunks'] + (2,), MISSING_CHUNK, dtype='<u8')
+            offset = 0
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                for inner in sorted(chunks):
+                    f.write(chunks[inner])
+                    index[inner] = (offset, len(chunks[inner]))
+                    offset += len(chunks[inner])
+                index = index.tobytes()
+                if array['index_checksum']:
+                    index += _crc32c(index).to_bytes(4, 'little')
+                f.write(index)
+            os.replace(tmp_path, path)
+        return offset + len(index)
+
+
+def _split_key(key):
+    parts = key.strip('/').split('/')
+    return '/'.join(parts[:-1]), parts[-1]
+
+
+def _parse_chunk_key(name):
+    if not re.match(r'^\d+(\.\d+)*$', name):
+        return None
+    return tuple([int(i) for i in name.split('.')])
+
+
+def _v3_codecs(compressor, dtype):
+    """
+    Returns the zarr v3 codecs that encode a chunk like a zarr v2 array with the given compressor
+    """
+    codecs = [{'name': 'bytes', 'configuration': {'endian': 'little'}}]
+    if compressor is None:
+        return codecs
+    config = dict(compressor)
+    codec_id = config.pop('id')
+    if codec_id == 'blosc':
+        shuffle = config.get('shuffle', 1)
+        if shuffle == -1:
+            # numcodecs AUTOSHUFFLE
+            shuffle = 2 if dtype.itemsize == 1 else 1
+        codecs.append({'name': 'blosc', 'configuration': {
+            'cname': config.get('cname', 'lz4'),
+            'clevel': config.get('clevel', 5),
+            'shuffle': ['noshuffle', 'shuffle', 'bitshuffle'][shuffle],
+            'typesize': dtype.itemsize,
+            'blocksize': config.get('blocksize', 0),
+        }})
+    elif codec_id == 'gzip':
+        codecs.append({'name': 'gzip', 'configuration': {'level': config.get('level', 1)}})
+    elif codec_id == 'zstd':
+        codecs.append({'name': 'zstd', 'configuration': {'level': config.get('level', 0),
+                                                         'checksum': config.get('checksum', False)}})
+    else:
+        codecs.append({'name': f'numcodecs.{codec_id}', 'configuration': config})
+    return codecs
+
+
+def _crc32c(data):
+    """
+    Returns the CRC-32C checksum of the given bytes (numcodecs 0.7 has no crc32c codec)
+    """
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = _CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def _has_index_checksum(sharding):
+    """
+    Returns True if the shard index of the given "sharding_indexed" configuration
+    is followed by its CRC-32C checksum, the default of zarr-python 3
+    """
+    codecs = sharding.get('index_codecs', [{'name': 'bytes'}])
+    names = [c['name'] for c in codecs]
+    if names not in [['bytes'], ['bytes', 'crc32c']] or \
+            codecs[0].get('configuration', {}).get('endian', 'little') != 'little':
+        raise ValueError(f'Unsupported shard index codecs: {codecs}')
+    return names[-1] == 'crc32c'
+
+
+def _v2_compressor(codecs):
+    """
+    Returns the numcodecs configuration of the compressor of the given zarr v3 codecs
+    """
+    if any([c.get('configuration', {}).get('endian', 'little') != 'little'
+            for c in codecs if c['name'] == 'bytes']):
+        raise ValueError(f'Unsupported codecs: {codecs}')
+    compressors = [c for c in codecs if c['name'] != 'bytes']
+    if not compressors:
+        return None
+    if len(compressors) > 1:
+        raise ValueError(f'Unsupported codecs: {codecs}')
+    name = compressors[0]['name']
+    config = dict(compressors[0].get('configuration', {}))
+    if name == 'blosc':
+        return {'id': 'blosc', 'cname': config['cname'], 'clevel': config['clevel'],
+                'shuffle': ['noshuffle', 'shuffle', 'bitshuffle'].index(config['shuffle']),
+                'blocksize': config.get('blocksize', 0)}
+    if name == 'zstd' and not config.get('checksum'):
+        config.pop('checksum', None)
+    if name in ['gzip', 'zstd']:
+        return dict(id=name, **config)
+    if name.startswith('numcodecs.'):
+        return dict(id=name[len('numcodecs.'):], **config)
+    raise ValueError(f'Unsupported codec: {name}')
+
+
+def _v3_array_metadata(metadata, shard_chunks):
+    """
+    Converts the metadata of a zarr v2 array to the zarr.json document of a zarr v3
+    array with shards of shard_chunks chunks
+    """
+    dtype = np.dtype(metadata['dtype'])
+    if dtype.byteorder == '>' or metadata.get('order', 'C') != 'C' or metadata.get('filters'):
+        raise ValueError('Sharded arrays must be little endian, in C order and without filters')
+    ndim = len(metadata['shape'])
+    shard_chunks = ((1,) * ndim + tuple(shard_chunks))[-ndim:]
+    fill_value = metadata.get('fill_value')
+    if fill_value is None:
+        fill_value = False if dtype == bool else 0
+    document = {
+        'zarr_format': 3,
+        'node_type': 'array',
+        'shape': list(metadata['shape']),
+        'data_type': dtype.name,
+        'chunk_grid': {'name': 'regular', 'configuration': {
+            'chunk_shape': [c * n for c, n in zip(metadata['chunks'], shard_chunks)]}},
+        'chunk_key_encoding': {'name': 'default', 'configuration': {'separator': '/'}},
+        'fill_value': fill_value,
+        'codecs': [{'name': 'sharding_indexed', 'configuration': {
+            'chunk_shape': list(metadata['chunks']),
+            'codecs': _v3_codecs(metadata.get('compressor'), dtype),
+            'index_codecs': [{'name': 'bytes', 'configuration': {'endian': 'little'}}],
+            'index_location': 'end',
+        }}],
+    }
+    if ndim <= 3:
+        document['dimension_names'] = ['z', 'y', 'x'][3 - ndim:]
+    return document
+
+
+def _v2_array_metadata(document):
+    """
+    Converts the zarr.json document of a sharded zarr v3 array to zarr v2 metadata
+    """
+    sharding = document['codecs'][0]
+    if sharding['name'] != 'sharding_indexed' or \
+            sharding['configuration'].get('index_location', 'end') != 'end':
+        raise ValueError(f'Unsupported zarr v3 array: {document["codecs"]}')
+    _has_index_checksum(sharding['configuration'])
+    return {
+        'zarr_format': 2,
+        'shape': document['shape'],
+        'chunks': sharding['configuration']['chunk_shape'],
+        'dtype': np.dtype(document['data_type']).str,
+        'compressor': _v2_compressor(sharding['configuration']['codecs']),
+        'fill_value': document['fill_value'],
+        'order': 'C',
+        'filters': None,
+    }
+
+
+def is_sharded(path):
+    """
+    Returns True if the given container, group or array directory is
+    part of a sharded zarr v3 container, see ShardedStore
+    """
+    return os.path.exists(os.path.join(path, ZARR_JSON))
+
+
+def get_shard_chunks(path, data_set):
+    """
+    Returns the number of chunks per shard along each axis of the given
+    data set, in array order, or None if it is not sharded
+    """
+    n5_path = get_n5_path(path, data_set)
+    if not is_sharded(n5_path):
+        return None
+    return ShardedStore(n5_path)._array('')['shard_chunks']
+
+
+def open_n5_store(path, shard_chunks=None):
+    """
+    Returns the store of the given directory, wrapped in an InstrumentedStore
+    when the telemetry is enabled: a ShardedStore if shard_chunks is set or if
+    the directory is part of a sharded container, otherwise an N5Store.
+    shard_chunks: number of chunks per shard of the arrays created in the store
+    """
+    if shard_chunks or is_sharded(path):
+        store = ShardedStore(path, shard_chunks)
+    else:
+        store = zarr.N5Store(path)
+    return InstrumentedStore(store) if telemetry.enabled() else store
+
+
+def open_n5_array(path, data_set, mode='r'):
+    """
+    Returns the zarr array for the given n5 data set, reusing the array
+    previously opened by this process if there is one.
+    path: path to the N5 directory
+    data_set: path to the data set inside the n5, e.g. "/s0"
+    mode: 'r' for read only access, 'a' for read/write access
+    """
+    n5_path = get_n5_path(path, data_set)
+    with _n5_arrays_lock:
+        img = _n5_arrays.get(n5_path)
+        if img is None or (mode != 'r' and img.read_only):
+            # the store is kept, with the chunks it buffers, when the array is reopened
+            store = _n5_stores.get(n5_path)
+            if store is None:
+                store = open_n5_store(n5_path)
+                _n5_stores[n5_path] = store
+            img = zarr.open(store=store, mode=mode)
+            _n5_arrays[n5_path] = img
+        return img
+
+
+def flush_n5_store(path, data_set, keys=None):
+    """
+    Writes the chunks buffered by the store of the given data set (see
+    ShardedStore), or only the shards of the given chunk keys
+    """
+    _flush_store(get_n5_path(path, data_set), keys)
+
+
+def _flush_store(n5_path, keys=None):
+    store = _n5_stores.get(n5_path)
+    if store is not None and hasattr(store, 'flush'):
+        store.flush(keys)
+
+
+def close_n5_arrays():
+    """
+    Writes the buffered chunks and statistics and forgets all open arrays
+    and cached chunks, e.g. after the data sets were modified by another process.
+    """
+    flush_chunk_stats()
+    with _n5_arrays_lock:
+        stores = list(_n5_stores.values())
+        _n5_arrays.clear()
+        _n5_stores.clear()
+        _occupancy.clear()
+        _chunk_stats.clear()
+    for store in stores:
+        if hasattr(store, 'flush'):
+            store.flush()
+    _chunk_cache.clear()
+
+
+def set_chunk_cache_size(max_bytes):
+    """
+    Sets the memory ceiling of the decoded chunk cache, evicting
+    the least recently used chunks if needed.
+    """
+    _chunk_cache.resize(max_bytes)
+
+
+def get_chunk_cache_stats():
+    """
+    Returns the hit/miss/eviction counters and the memory usage
+    of the decoded chunk cache.
+    """
+    return _chunk_cache.stats()
+
+
+def get_occupancy_index(path, data_set):
+    """
+    Returns the occupancy index of the given n5 data set. Use exists()
+    to check whether the data set actually has an index.
+    """
+    n5_path = get_n5_path(path, data_set)
+    img = open_n5_array(path, data_set)
+    with _n5_arrays_lock:
+        occupancy = _occupancy.get(n5_path)
+        if occupancy is None:
+            occupancy = OccupancyIndex(n5_path, _chunk_grid(img))
+            _occupancy[n5_path] = occupancy
+        return occupancy
+
+
+def create_occupancy_index(path, data_set):
+    """
+    Starts tracking the occupancy of a newly created (empty) n5 data set.
+    The data set should only be written through this module from then on:
+    readers check the storage for the chunks that the index marks as empty,
+    but the chunks written by other tools are missing from the counts of
+    the index until it is rebuilt.
+    """
+    n5_path = get_n5_path(path, data_set)
+    with _n5_arrays_lock:
+        _n5_arrays.pop(n5_path, None)
+        _occupancy.pop(n5_path, None)
+    occupancy = get_occupancy_index(path, data_set)
+    occupancy.flush(create=True)
+    return occupancy
+
+
+def get_chunk_locks(path, data_set):
+    """
+    Returns the advisory per-chunk write locks of the given n5 data set
+    """
+    img = open_n5_array(path, data_set)
+    return _get_locks(get_n5_path(path, data_set), _chunk_grid(img))
+
+
+def _get_locks(directory, grid, filename=CHUNK_LOCK_FILENAME):
+    lock_path = os.path.join(directory, filename)
+    with _n5_arrays_lock:
+        locks = _chunk_locks.get(lock_path)
+        # the lock file is gone if the data set was deleted and recreated
+        if locks is None or locks.grid != tuple(grid) or \
+                (locks._fd is not None and not os.path.exists(lock_path)):
+            locks = ChunkLocks(directory, grid, filename)
+            _chunk_locks[lock_path] = locks
+        return locks
+
+
+@telemetry.stage('build_occupancy_index')
+def build_occupancy_index(path, data_set, workers=4, delete_empty=False):
+    """
+    Creates or rebuilds the occupancy index of an existing n5 data set by
+    decoding all its chunks. If delete_empty is set, the chunk files that
+    only contain the fill value are removed.
+    """
+    img = open_n5_array(path, data_set, mode='a' if delete_empty else 'r')
+    n5_path = get_n5_path(path, data_set)
+    fill_value = img.fill_value or 0
+    grid = _chunk_grid(img)
+    bits = np.zeros(grid, dtype=bool)
+
+    def check_chunk(chunk_index):
+        key = _chunk_key(img, chunk_index)
+        if key not in img.store:
+            return
+        with telemetry.timed('chunks_decoded'):
+            chunk_data = img[get_chunk_region(img.shape, img.chunks, chunk_index)]
+        if np.any(chunk_data != fill_value):
+            bits[chunk_index] = True
+        elif delete_empty:
+            del img.store[key]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(check_chunk, itertools.product(*[range(g) for g in grid])))
+
+    occupancy = get_occupancy_index(path, data_set)
+    current = occupancy.bits if occupancy.exists() else np.zeros(grid, dtype=bool)
+    for chunk_index in zip(*np.nonzero(bits != current)):
+        occupancy.mark(chunk_index, bits[chunk_index])
+    occupancy.flush(create=True)
+    _chunk_cache.clear()
+    print(f'{n5_path}: {int(bits.sum())} of {bits.size} chunks occupied')
+    return occupancy
+
+
+def is_n5_region_empty(path, data_set, start=None, end=None):
+    """
+    Returns True if the occupancy index shows that no chunk intersecting
+    the x,y,z [start, end) box holds data and none of these chunks is stored,
+    False if some chunk does, and None if the data set has no occupancy index.
+    """
+    img = open_n5_array(path, data_set)
+    occupancy = get_occupancy_index(path, data_set)
+    if not occupancy.exists():
+        return None
+    chunk_start, chunk_end = _chunk_range(img, start, end)
+    if any([s >= e for s, e in zip(chunk_start, chunk_end)]):
+        return True
+    if occupancy.count(chunk_start, chunk_end) > 0:
+        return False
+    # chunks written by other tools are not in the index
+    return not any([_chunk_key(img, chunk_index) in img.store for chunk_index in
+                    itertools.product(*[range(s, e) for s, e in zip(chunk_start, chunk_end)])])
+
+
+def get_chunk_stats(path, data_set):
+    """
+    Returns the per-chunk statistics of the given n5 data set. Use exists()
+    to check whether the data set actually has statistics.
+    """
+    n5_path = get_n5_path(path, data_set)
+    img = open_n5_array(path, data_set)
+    with _n5_arrays_lock:
+        stats = _chunk_stats.get(n5_path)
+        if stats is None:
+            stats = ChunkStats(n5_path + CHUNK_STATS_SUFFIX, _chunk_grid(img))
+            _chunk_stats[n5_path] = stats
+        return stats
+
+
+def create_chunk_stats(path, data_set, bins=256, value_range=None):
+    """
+    Starts collecting the statistics of every chunk written to the given
+    n5 data set. The histograms have the given number of bins spanning
+    value_range, which defaults to the range of the integer data types
+    or to [0, 1) for floating point data. Use get_value_range to derive
+    a narrower range from sample data, so that the bins are not wasted
+    on values that do not occur.
+    """
+    n5_path = get_n5_path(path, data_set)
+    img = open_n5_array(path, data_set)
+    if value_range is None:
+        value_range = _default_value_range(img.dtype)
+    grid = _chunk_grid(img)
+    stats_chunks = tuple([min(g, STATS_CHUNK_SIZE) for g in grid])
+    # in a sharded container, the statistics are sharded zarr v3 arrays as well
+    shard_chunks = STATS_SHARD_CHUNKS if is_sharded(n5_path) else None
+    group = zarr.open(store=open_n5_store(n5_path + CHUNK_STATS_SUFFIX, shard_chunks), mode='w')
+    group.attrs['bins'] = bins
+    group.attrs['range'] = list(value_range)
+    group.attrs['fields'] = list(CHUNK_STATS_FIELDS)
+    group.create_dataset('summary', shape=grid + (len(CHUNK_STATS_FIELDS),),
+                         chunks=stats_chunks + (len(CHUNK_STATS_FIELDS),),
+                         dtype='float64', compressor=numcodecs.GZip())
+    group.create_dataset('histogram', shape=grid + (bins,), chunks=stats_chunks + (bins,),
+                         dtype='uint64', compressor=numcodecs.GZip())
+    with _n5_arrays_lock:
+        _chunk_stats.pop(n5_path, None)
+    return get_chunk_stats(path, data_set)
+
+
+def remove_chunk_stats(path, data_set):
+    """
+    Removes the statistics of the given data set, if any. The statistics are
+    stored next to the data set, so they must be removed whenever the data set
+    is created again, unless create_chunk_stats is called for the new one.
+    """
+    n5_path = get_n5_path(path, data_set)
+    with _n5_arrays_lock:
+        _chunk_stats.pop(n5_path, None)
+    shutil.rmtree(n5_path + CHUNK_STATS_SUFFIX, ignore_errors=True)
+
+
+def get_value_range(samples, dtype):
+    """
+    Returns the histogram value range of the chunk statistics covering the
+    values of the given sample arrays in the given dtype, or the default
+    range of create_chunk_stats if there are no samples. Values outside of
+    the range that are written later are counted in the first or the last bin.
+    """
+    dtype = np.dtype(dtype)
+    samples = [np.asarray(sample) for sample in samples if np.size(sample) > 0]
+    if not samples:
+        return _default_value_range(dtype)
+    low = min([sample.min() for sample in samples])
+    high = max([sample.max() for sample in samples])
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return (int(np.clip(low, info.min, info.max)), int(np.clip(high, info.min, info.max)) + 1)
+    if not np.isfinite([low, high]).all():
+        return _default_value_range(dtype)
+    return (float(low), float(high) if high > low else float(low) + 1)
+
+
+def _default_value_range(dtype):
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return (int(info.min), int(info.max) + 1)
+    return (0, 1)
+
+
+@telemetry.stage('build_chunk_stats')
+def build_chunk_stats(path, data_set, bins=256, value_range=None, workers=4, samples=16):
+    """
+    Creates the per-chunk statistics of an existing n5 data set by decoding all its chunks.
+    The value range of the histograms defaults to the range of the values of up to
+    the given number of randomly sampled chunks, see get_value_range.
+    """
+    img = open_n5_array(path, data_set)
+    if value_range is None:
+        value_range = sample_value_range(path, data_set, samples)
+        print(f'Histogram range of {get_n5_path(path, data_set)}: {value_range}')
+    stats = create_chunk_stats(path, data_set, bins=bins, value_range=value_range)
+    fill_value = img.fill_value or 0
+
+    def record_chunk(chunk_index):
+        if _chunk_key(img, chunk_index) not in img.store:
+            return
+        with telemetry.timed('chunks_decoded'):
+            chunk_data = img[get_chunk_region(img.shape, img.chunks, chunk_index)]
+        if np.any(chunk_data != fill_value):
+            stats.record(chunk_index, chunk_data)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(record_chunk, itertools.product(*[range(g) for g in stats.grid])))
+    stats.flush()
+    return stats
+
+
+def sample_value_range(path, data_set, samples=16):
+    """
+    Returns the value range of up to the given number of randomly selected
+    stored chunks of the n5 data set, see get_value_range
+    """
+    img = open_n5_array(path, data_set)
+    return get_value_range(sample_stored_chunks(img, samples), img.dtype)
+
+
+def sample_stored_chunks(img, samples=8, seed=0):
+    """
+    Returns the decoded data of up to the given number of randomly selected
+    chunks of the array that are stored. Missing or elided chunks only hold the
+    fill value, so they are not representative of the data. The candidates are
+    drawn in rounds, checking at most 64 candidates per requested sample, so a
+    sparse array may return fewer samples and an empty array none.
+    """
+    grid = _chunk_grid(img)
+    rng = np.random.default_rng(seed)
+    checked = set()
+    stored = []
+    for _ in range(16):
+        candidates = set([tuple([int(rng.integers(0, g)) for g in grid])
+                          for _ in range(samples * 4)]) - checked
+        checked.update(candidates)
+        stored += [chunk_index for chunk_index in sorted(candidates)
+                   if _chunk_key(img, chunk_index) in img.store]
+        if len(stored) >= samples or len(checked) == int(np.prod(grid)):
+            break
+    return [img[get_chunk_region(img.shape, img.chunks, chunk_index)]
+            for chunk_index in sorted(stored[:samples])]
+
+
+def get_n5_stats(path, data_set, start=None, end=None):
+    """
+    Returns the statistics of the chunks intersecting the x,y,z [start, end) box
+    (the whole data set by default) from the per-chunk statistics, without reading
+    any voxel: a dictionary with the voxel count, nonzero count, min, max, sum, mean,
+    histogram and histogram bin edges. Returns None if there are no statistics.
+    """
+    img = open_n5_array(path, data_set)
+    stats = get_chunk_stats(path, data_set)
+    if not stats.exists():
+        return None
+    # include the statistics buffered by this process
+    stats.flush()
+    chunk_start, chunk_end = _chunk_range(img, start, end)
+    region = tuple([slice(s, max(s, e)) for s, e in zip(chunk_start, chunk_end)])
+    summary = stats.summary[region].reshape(-1, len(CHUNK_STATS_FIELDS))
+    histogram = stats.histogram[region].reshape(-1, stats.bins).sum(axis=0)
+    written = summary[:, 0] > 0
+
+    # chunks without statistics only hold the fill value
+    chunk_sizes = [np.diff([min(i * c, d) for i in range(r.start, r.stop + 1)])
+                   for r, c, d in zip(region, img.chunks, img.shape)]
+    voxels = int(np.prod([sizes.sum() for sizes in chunk_sizes]))
+    fill_voxels = voxels - int(summary[written, 0].sum())
+    fill_value = img.fill_value or 0
+    minimum = summary[written, 2].min() if written.any() else fill_value
+    maximum = summary[written, 3].max() if written.any() else fill_value
+    if fill_voxels > 0:
+        histogram[_histogram_bin(fill_value, stats.bins, stats.value_range)] += fill_voxels
+        minimum = min(minimum, fill_value)
+        maximum = max(maximum, fill_value)
+    total = summary[written, 4].sum() + fill_voxels * fill_value
+    return {
+        'count': voxels,
+        'nonzero': int(summary[written, 1].sum()) + (fill_voxels if fill_value else 0),
+        'min': float(minimum),
+        'max': float(maximum),
+        'sum': float(total),
+        'mean': float(total / voxels) if voxels else 0.0,
+        'histogram': histogram,
+        'bin_edges': np.linspace(stats.value_range[0], stats.value_range[1], stats.bins + 1),
+    }
+
+
+def get_n5_percentiles(path, data_set, percentiles, start=None, end=None, ignore_zeros=False):
+    """
+    Returns the given percentiles (between 0 and 100) of the voxel values in the
+    x,y,z [start, end) box, estimated from the per-chunk histograms by linear
+    interpolation within the bins. If ignore_zeros is set, zero voxels are not
+    counted, which suits sparse volumes. Returns None if there are no statistics.
+    """
+    stats = get_n5_stats(path, data_set, start, end)
+    if stats is None:
+        return None
+    histogram = stats['histogram'].astype(np.float64)
+    edges = stats['bin_edges']
+    if ignore_zeros:
+        histogram[_histogram_bin(0, len(histogram), (edges[0], edges[-1]))] -= \
+            stats['count'] - stats['nonzero']
+    cumulative = np.cumsum(histogram)
+    total = cumulative[-1]
+    values = []
+    for p in percentiles:
+        if total <= 0:
+            values.append(0.0)
+            continue
+        target = total * p / 100
+        b = min(int(np.searchsorted(cumulative, target)), len(histogram) - 1)
+        before = cumulative[b] - histogram[b]
+        fraction = (target - before) / histogram[b] if histogram[b] > 0 else 0
+        # the observed extrema narrow the first and the last occupied bins
+        low, high = np.clip(edges[b:b + 2], stats['min'], stats['max'])
+        values.append(float(low + fraction * (high - low)))
+    return values
+
+
+def chunk_histogram(data, bins, value_range):
+    """
+    Returns the histogram of the data with fixed-width bins over value_range;
+    values outside of the range are counted in the first or the last bin.
+    The data is processed in pieces to bound the temporary memory.
+    """
+    histogram = np.zeros(bins, dtype=np.uint64)
+    flat = data.reshape(-1)
+    step = 1 << 22
+    for i in range(0, flat.size, step):
+        indexes = _histogram_bin(flat[i:i + step], bins, value_range)
+        histogram += np.bincount(indexes, minlength=bins).astype(np.uint64)
+    return histogram
+
+
+def _histogram_bin(values, bins, value_range):
+    lo, hi = value_range
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.integer) and float(lo).is_integer() and float(hi).is_integer():
+        indexes = (values.astype(np.int64) - int(lo)) * bins // (int(hi) - int(lo))
+    else:
+        indexes = np.floor((values.astype(np.float64) - lo) * bins / (hi - lo)).astype(np.int64)
+    return np.clip(indexes, 0, bins - 1)
+
+
+def read_n5_block(path, data_set, start, end, downsampling_factors=None, voxel_size=None,
+                  downsampling_method=np.mean):
     """
     Reads and returns an image block from the specified n5 location.
+    Decoded chunks are cached, so chunks shared by neighbouring blocks
+    are only decompressed once, and chunks that the occupancy index
+    marks as empty are filled with the fill value without being read.
+    If downsampling factors or a voxel size are given, the block is read from
+    the coarsest pyramid level that is not coarser than requested (see
+    select_n5_level) and only the remaining factors are applied in memory:
+    integer factors with downsampling_method over the windows (trailing voxels
+    that do not fill a window are cropped, as in the pyramid levels), other
+    factors by nearest neighbour sampling. The returned block then covers the
+    [floor(start / factors), ceil(end / factors)) box of the downsampled grid.
     path: path to the N5 directory
     data_set: path to the data set inside the n5, e.g. "/s0"
     start: tuple x,y,z indicating the starting corner of the data block
     end: tuple (x,y,z) indicating the ending corner of the data block
+    downsampling_factors: x,y,z factors (or a single number) relative to data_set
+    voxel_size: x,y,z voxel size in the units of the root "pixelResolution"
     """
+    if downsampling_factors is None and voxel_size is None:
+        return _read_level_block(path, data_set, start, end)
+    level, level_factors, remaining = select_n5_level(path, data_set,
+                                                      downsampling_factors=downsampling_factors,
+                                                      voxel_size=voxel_size)
+    factors = [l * r for l, r in zip(level_factors, remaining)]
+    end = [min(e, d) for e, d in zip(end, get_n5_shape(path, data_set))]
+    out_start = [int(math.floor(s / f)) for s, f in zip(start, factors)]
+    out_end = [int(math.ceil(e / f)) for e, f in zip(end, factors)]
+    print(f'Reading {get_n5_path(path, data_set)} {tuple(start)} {tuple(end)} from {level} ' +
+          f'downsampled by {tuple(remaining)}')
+    if all([float(r).is_integer() for r in remaining]):
+        remaining = [int(r) for r in remaining]
+        block = _read_level_block(path, level,
+                                  [s * r for s, r in zip(out_start, remaining)],
+                                  [e * r for e, r in zip(out_end, remaining)])
+        if all([r == 1 for r in remaining]):
+            return block
+        with telemetry.timed('blocks_downsampled', 'downsample_seconds'):
+            return downsample_block(block, remaining, downsampling_method)
+    # level coordinates of the centers of the output voxels
+    indexes = [np.floor((np.arange(s, e) + 0.5) * r).astype(np.int64)
+               for s, e, r in zip(out_start, out_end, remaining)]
+    level_shape = get_n5_shape(path, level)
+    indexes = [i[i < d] for i, d in zip(indexes, level_shape)]
+    if any([len(i) == 0 for i in indexes]):
+        return np.empty([len(i) for i in indexes], dtype=open_n5_array(path, level).dtype)
+    block = _read_level_block(path, level, [i[0] for i in indexes], [i[-1] + 1 for i in indexes])
+    return block[np.ix_(*[i - i[0] for i in indexes])]
+
+
+def _read_level_block(path, data_set, start, end):
     n5_path = get_n5_path(path, data_set)
     print('Reading', n5_path, start, end)
-    img = zarr.open(store=zarr.N5Store(n5_path), mode='r')
-    img = img[start[2]:end[2], start[1]:end[1], start[0]:end[0]]
+    img = open_n5_array(path, data_set)
     # zarr loads zyx order
-    return img[...].transpose(2, 1, 0)
+    zyx_start = [max(0, s) for s in (start[2], start[1], start[0])]
+    zyx_end = [min(e, d) for e, d in zip((end[2], end[1], end[0]), img.shape)]
+    block = np.empty([max(0, e - s) for s, e in zip(zyx_start, zyx_end)],
+                     dtype=img.dtype)
+    occupancy = get_occupancy_index(path, data_set)
+    for chunk_index, region, block_region, _ in chunk_intersections(
+            img.shape, img.chunks, zyx_start, zyx_end):
+        if not _is_chunk_occupied(img, occupancy, chunk_index):
+            block[block_region] = img.fill_value or 0
+            continue
+        chunk_region = get_chunk_region(img.shape, img.chunks, chunk_index)
+        chunk_data = _read_chunk(img, n5_path, chunk_index)
+        block[block_region] = chunk_data[relative_region(region, chunk_region)]
+    return block.transpose(2, 1, 0)
 
 
-def write_n5_block(path, data_set, start, end, data):
+def write_n5_block(path, data_set, start, end, data, lock=False):
     """
     Writes the given image block to the specified n5 location.
+    Only the chunks touched by the block are written: chunks that are
+    completely covered by the block are encoded and written directly,
+    while partially covered edge chunks are read from storage (never from
+    the chunk cache), updated and written back.
+    Chunks that only contain the fill value are not stored (an existing
+    chunk file is removed). The occupancy index and the chunk statistics
+    are updated if the data set has them; the statistics are buffered for up
+    to STATS_FLUSH_SECONDS, see flush_chunk_stats.
+    If lock is set, every chunk is updated under its advisory lock (see
+    ChunkLocks), so that concurrent writers of blocks
+    that share chunks do not overwrite each other's voxels, and its
+    statistics are written before the lock is released.
     path: path to the N5 directory
     data_set: path to the data set inside the n5, e.g. "/s0"
     start: tuple x,y,z indicating the starting corner of the data block
     end: tuple (x,y,z) indicating the ending corner of the data block
+    data: x,y,z ordered array with the shape end - start
+    lock: lock the chunks while they are updated
+    """
+    print('Writing', get_n5_path(path, data_set), start, end)
+    # zarr writes zyx order - this is only a view of the data
+    block = data.transpose(2, 1, 0)
+    zyx_start = (start[2], start[1], start[0])
+    zyx_end = (end[2], end[1], end[0])
+    block_shape = tuple([e - s for s, e in zip(zyx_start, zyx_end)])
+    if block.shape != block_shape:
+        raise ValueError(f'Block shape {data.shape} does not match '
+                         f'the region {start} - {end}')
+    _write_region(path, data_set, zyx_start, block, lock=lock)
+
+
+class N5ChunkWriter:
+    """
+    Write target for dask.array.store and for slice assignment, in the zarr
+    (z,y,x) axis order, that writes through write_n5_block so empty chunks
+    are elided and the occupancy index and the chunk statistics are kept
+    up to date. Only the paths
+    are pickled, so the writer can be sent to distributed workers.
+    If autoflush is False, the occupancy and statistics updates are only saved
+    when flush() is called. If lock is set, the chunks are updated under
+    their advisory locks, see write_n5_block.
+    """
+
+    def __init__(self, path, data_set, autoflush=True, lock=False):
+        self.path = path
+        self.data_set = data_set
+        self.autoflush = autoflush
+        self.lock = lock
+
+    def __setitem__(self, region, data):
+        img = open_n5_array(self.path, self.data_set, mode='a')
+        start = [r.indices(d)[0] for r, d in zip(region, img.shape)]
+        _write_region(self.path, self.data_set, start, np.asarray(data),
+                      autoflush=self.autoflush, lock=self.lock)
+
+    def flush(self):
+        flush_n5_store(self.path, self.data_set)
+        get_occupancy_index(self.path, self.data_set).flush()
+        get_chunk_stats(self.path, self.data_set).flush()
+
+
+def get_n5_scales(path, data_set):
+    """
+    Returns the pyramid levels of the group containing the given "sN" data set,
+    as a list of (data set, x,y,z downsampling factors relative to s0) tuples.
+    The factors come from the "scales" attribute that n5_multiscale writes at
+    the root of the n5 or, for the levels it does not list, from the
+    "downsamplingFactors" attribute of the level. A data set that is not a
+    pyramid level is returned as the only level, with factors 1.
+    """
+    match = re.match(r'^(.*?)/?s(\d+)/?$', data_set)
+    if match is None:
+        return [(data_set, (1, 1, 1))]
+    group = match.group(1)
+    store = open_n5_store(path)
+    root_scales = zarr.open(store, path='/', mode='r').attrs.get('scales', []) \
+        if not group.strip('/') else []
+    levels = []
+    for idx in itertools.count():
+        level = f'{group}/s{idx}'
+        if not os.path.isdir(get_n5_path(path, level)):
+            break
+        if idx < len(root_scales):
+            factors = root_scales[idx]
+        else:
+            factors = zarr.open(store, path=level, mode='r').attrs.get(
+                'downsamplingFactors', (1, 1, 1) if idx == 0 else None)
+        if factors is not None:
+            levels.append((level, tuple(factors)))
+    return levels or [(data_set, (1, 1, 1))]
+
+
+def select_n5_level(path, data_set, downsampling_factors=None, voxel_size=None):
+    """
+    Selects the level of the pyramid of data_set (see get_n5_scales) to read
+    data_set downsampled by the given x,y,z factors, or at the given x,y,z voxel
+    size in the units of the root "pixelResolution" attribute: the coarsest level
+    whose voxels are not larger than requested along any axis.
+    Returns the level data set, its x,y,z factors relative to data_set and the
+    x,y,z factors left to apply to the level.
+    """
+    levels = get_n5_scales(path, data_set)
+    base = dict(levels).get(data_set) or dict(levels).get('/' + data_set.strip('/'), (1, 1, 1))
+    if voxel_size is not None:
+        resolution = zarr.open(open_n5_store(path), path='/', mode='r').attrs.get('pixelResolution')
+        if not resolution:
+            raise ValueError(f'{path} has no pixelResolution, use downsampling factors instead')
+        dimensions = resolution['dimensions'] if isinstance(resolution, dict) else resolution
+        downsampling_factors = [v / (r * b) for v, r, b in zip(_as_xyz(voxel_size), dimensions, base)]
+    target = [float(f) for f in _as_xyz(downsampling_factors)]
+    best = (data_set, (1, 1, 1))
+    for level, factors in levels:
+        relative = tuple([f / b for f, b in zip(factors, base)])
+        # factors are compared with a tolerance for voxel sizes that are not exact
+        if all([1 <= r <= t * (1 + 1e-6) for r, t in zip(relative, target)]) and \
+                np.prod(relative) > np.prod(best[1]):
+            best = (level, relative)
+    remaining = tuple([_as_integer(t / r) for r, t in zip(best[1], target)])
+    return best[0], tuple([_as_integer(r) for r in best[1]]), remaining
+
+
+def _as_integer(value, tolerance=1e-6):
+    rounded = round(value)
+    return int(rounded) if abs(value - rounded) <= tolerance * max(1, abs(value)) else value
+
+
+def downsample_block(block, downsampling_factors, downsampling_method=np.mean):
+    """
+    Downsample a block by integer factors. The trailing voxels that do not fill
+    a whole downsampling window are cropped and the result has the same dtype
+    as the block.
+    """
+    shape = [s // f for s, f in zip(block.shape, downsampling_factors)]
+    cropped = block[tuple([slice(0, s * f) for s, f in zip(shape, downsampling_factors)])]
+    windows = cropped.reshape([d for s, f in zip(shape, downsampling_factors) for d in (s, f)])
+    reduced = downsampling_method(windows, axis=tuple(range(1, 2 * block.ndim, 2)))
+    return np.asarray(reduced).astype(block.dtype)
+
+
+def get_n5_shape(path, data_set):
+    """
+    Returns the x,y,z shape of the given n5 data set
+    """
+    img = open_n5_array(path, data_set)
+    return tuple(reversed(img.shape))
+
+
+def get_block_boxes(shape, block_size, halo=0, start=None, end=None, order='zyx'):
+    """
+    Partitions the [start, end) region of a volume into blocks and returns
+    a list of (core_box, halo_box) tuples, where each box is a (start, end)
+    pair of x,y,z tuples. The halo box extends the core box by the halo
+    on every side, clamped to the volume borders.
+    shape: x,y,z shape of the volume
+    block_size: x,y,z size of the core blocks (or a single int)
+    halo: x,y,z halo size (or a single int)
+    start: x,y,z starting corner of the region (default is the volume origin)
+    end: x,y,z ending corner of the region (default is the volume shape)
+    order: traversal order, from the outermost to the innermost axis,
+           e.g. 'zyx' (the default) traverses x fastest
+    """
+    block_size = _as_xyz(block_size)
+    halo = _as_xyz(halo)
+    start = _as_xyz(start or 0)
+    end = [min(e, d) for e, d in zip(_as_xyz(end or shape), shape)]
+    if sorted(order) != ['x', 'y', 'z']:
+        raise ValueError(f'Invalid traversal order: {order}')
+    axes = ['xyz'.index(a) for a in order]
+    ranges = [range(start[a], end[a], block_size[a]) for a in axes]
+    boxes = []
+    for origin in itertools.product(*ranges):
+        core_start = [0, 0, 0]
+        for a, o in zip(axes, origin):
+            core_start[a] = o
+        core_end = [min(s + b, e) for s, b, e in zip(core_start, block_size, end)]
+        halo_start = [max(s - h, 0) for s, h in zip(core_start, halo)]
+        halo_end = [min(e + h, d) for e, h, d in zip(core_end, halo, shape)]
+        boxes.append(((tuple(core_start), tuple(core_end)),
+                      (tuple(halo_start), tuple(halo_end))))
+    return boxes
+
+
+def iter_n5_blocks(path, data_set, block_size, halo=0, start=None, end=None,
+                   order='zyx', prefetch=True):
+    """
+    Iterates over an n5 data set in blocks and yields (core_box, halo_box, data)
+    tuples, where data is the x,y,z ordered content of the halo box.
+    See get_block_boxes for the meaning of the block parameters.
+    If prefetch is set, the next block is read on a background thread
+    while the current block is being processed.
+    """
+    boxes = get_block_boxes(get_n5_shape(path, data_set), block_size,
+                            halo=halo, start=start, end=end, order=order)
+
+    def read_block(halo_box):
+        return read_n5_block(path, data_set, halo_box[0], halo_box[1])
+
+    if not prefetch:
+        for core_box, halo_box in boxes:
+            yield core_box, halo_box, read_block(halo_box)
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_block = None
+        for i, (core_box, halo_box) in enumerate(boxes):
+            block = next_block if next_block is not None \
+                else executor.submit(read_block, halo_box)
+            next_block = executor.submit(read_block, boxes[i + 1][1]) \
+                if i + 1 < len(boxes) else None
+            yield core_box, halo_box, block.result()
+
+
+def write_n5_block_core(path, data_set, core_box, halo_box, data, lock=False):
+    """
+    Crops the halo from the given x,y,z ordered block and writes
+    only the core region to the n5 data set.
+    core_box: (start, end) x,y,z corners of the region to write
+    halo_box: (start, end) x,y,z corners of the region covered by data
+    lock: lock the chunks while they are updated, see write_n5_block
+    """
+    core_start, core_end = core_box
+    crop = tuple([slice(cs - hs, ce - hs)
+                  for cs, ce, hs in zip(core_start, core_end, halo_box[0])])
+    write_n5_block(path, data_set, core_start, core_end, data[crop], lock=lock)
+
+
+def _as_xyz(value):
+    if isinstance(value, (int, float)):
+        return (value, value, value)
+    return tuple(value)
+
+
+def _write_region(path, data_set, start, block, autoflush=True, lock=False):
+    """
+    Writes a zyx ordered block at the zyx start position. The chunks of
+    sharded arrays are buffered and their shards are written together.
     """
     n5_path = get_n5_path(path, data_set)
-    print('Writing', n5_path, start, end)
-    img = zarr.open(store=zarr.N5Store(n5_path), mode='a')
-    # zarr writes zyx order
-    img = img[...].transpose(2, 1, 0)
-    img[start[2]:end[2], start[1]:end[1], start[0]:end[0]] = data
+    img = open_n5_array(path, data_set, mode='a')
+    occupancy = get_occupancy_index(path, data_set)
+    stats = get_chunk_stats(path, data_set)
+    locks = get_chunk_locks(path, data_set) if lock else None
+    fill_value = img.fill_value or 0
+    end = [s + b for s, b in zip(start, block.shape)]
+    chunk_keys = []
+    _shard_buffering.enabled = True
+    try:
+        _write_chunks(img, n5_path, start, end, block, fill_value, occupancy, stats, locks, chunk_keys)
+    finally:
+        _shard_buffering.enabled = False
+    if autoflush:
+        flush_n5_store(path, data_set, chunk_keys)
+        occupancy.flush()
+        # the statistics are written every few seconds and when the process
+        # exits, see flush_chunk_stats
+        stats.flush(max_age=STATS_FLUSH_SECONDS)
+
+
+def _write_chunks(img, n5_path, start, end, block, fill_value, occupancy, stats, locks, chunk_keys):
+    for chunk_index, region, block_region, full in chunk_intersections(
+            img.shape, img.chunks, start, end):
+        chunk_region = get_chunk_region(img.shape, img.chunks, chunk_index)
+        with locks.lock(chunk_index) if locks else nullcontext():
+            if full:
+                chunk_data = block[block_region]
+            else:
+                # always decoded from storage: another process may have
+                # updated the chunk since it was cached
+                chunk_data = _read_chunk(img, n5_path, chunk_index, cached=False).copy()
+                chunk_data[relative_region(region, chunk_region)] = block[block_region]
+            if np.any(chunk_data != fill_value):
+                with telemetry.timed('chunks_encoded'):
+                    img[chunk_region] = chunk_data
+                occupancy.mark(chunk_index, True)
+                stats.record(chunk_index, chunk_data)
+            else:
+                try:
+                    del img.store[_chunk_key(img, chunk_index)]
+                except KeyError:
+                    pass
+                occupancy.mark(chunk_index, False)
+                stats.record(chunk_index, None)
+                telemetry.add(chunks_elided=1)
+            chunk_keys.append(_chunk_key(img, chunk_index))
+            # the cache is filled by reads only: most written chunks are never read back
+            _chunk_cache.invalidate((n5_path, chunk_index))
+            if locks:
+                # saved before another writer can update the chunk
+                _flush_store(n5_path, chunk_keys[-1:])
+                occupancy.flush()
+                stats.flush()
+
+
+def flush_chunk_stats():
+    """
+    Writes the pending statistics of all the data sets written by this process
+    """
+    with _n5_arrays_lock:
+        stats = list(_chunk_stats.values())
+    for s in stats:
+        s.flush()
+
+
+def _register_stats_flush():
+    global _stats_flush_pid
+    if _stats_flush_pid != os.getpid():
+        _stats_flush_pid = os.getpid()
+        atexit.register(flush_chunk_stats)
+        # multiprocessing workers exit without running the atexit handlers
+        multiprocessing.util.Finalize(None, flush_chunk_stats, exitpriority=10)
+
+
+def _chunk_grid(img):
+    return tuple([-(-s // c) for s, c in zip(img.shape, img.chunks)])
+
+
+def _chunk_range(img, start=None, end=None):
+    """
+    Returns the zyx range of chunk grid coordinates covering an x,y,z box
+    """
+    start = tuple(reversed(start)) if start else (0,) * img.ndim
+    end = tuple(reversed(end)) if end else img.shape
+    chunk_start = [max(0, s) // c for s, c in zip(start, img.chunks)]
+    chunk_end = [-(-min(e, d) // c) for e, d, c in zip(end, img.shape, img.chunks)]
+    return chunk_start, chunk_end
+
+
+def _is_chunk_occupied(img, occupancy, chunk_index):
+    """
+    Returns True unless the occupancy index marks the chunk as empty and the
+    chunk is not stored either, e.g. because it was written by another tool
+    """
+    return occupancy.is_occupied(chunk_index) or _chunk_key(img, chunk_index) in img.store
+
+
+def _chunk_key(img, chunk_index):
+    prefix = img.path + '/' if img.path else ''
+    return prefix + '.'.join([str(i) for i in chunk_index])
+
+
+def _read_chunk(img, n5_path, chunk_index, cached=True):
+    """
+    Returns the decoded chunk from the cache or reads it from the array.
+    If cached is False, the chunk is always read and is not cached.
+    The returned array is shared with the cache and must not be modified.
+    """
+    key = (n5_path, chunk_index)
+    chunk_data = _chunk_cache.get(key) if cached else None
+    if chunk_data is None:
+        with telemetry.timed('chunks_decoded'):
+            chunk_data = img[get_chunk_region(img.shape, img.chunks, chunk_index)]
+        if cached:
+            _chunk_cache.put(key, chunk_data)
+    return chunk_data
+
+
+def chunk_intersections(shape, chunks, start, end):
+    """
+    Iterates over all chunks of an array with the given shape and chunk size
+    that intersect the [start, end) box. All arguments use the array axis order.
+    For every chunk it yields a tuple containing:
+        chunk_index: the chunk grid coordinates
+        region: tuple of slices of the intersection in array coordinates
+        block_region: tuple of slices of the intersection relative to start
+        full: True if the box covers the entire chunk
+    The box may extend beyond the array: only its part inside the array is
+    iterated over, and block_region stays relative to the given start.
+    """
+    origin = start
+    start = [max(0, s) for s in start]
+    end = [min(e, d) for e, d in zip(end, shape)]
+    if any([s >= e for s, e in zip(start, end)]):
+        return
+    chunk_ranges = [range(s // c, (e - 1) // c + 1)
+                    for s, e, c in zip(start, end, chunks)]
+    for chunk_index in itertools.product(*chunk_ranges):
+        chunk_region = get_chunk_region(shape, chunks, chunk_index)
+        region = tuple([slice(max(s, cr.start), min(e, cr.stop))
+                        for s, e, cr in zip(start, end, chunk_region)])
+        block_region = tuple([slice(r.start - o, r.stop - o)
+                              for r, o in zip(region, origin)])
+        full = region == chunk_region
+        yield chunk_index, region, block_region, full
+
+
+def get_chunk_region(shape, chunks, chunk_index):
+    """
+    Returns the region covered by the chunk with the given grid coordinates,
+    clipped to the array shape.
+    """
+    return tuple([slice(i * c, min((i + 1) * c, d))
+                  for i, c, d in zip(chunk_index, chunks, shape)])
+
+
+def relative_region(region, origin_region):
+    """
+    Returns the given region relative to the origin of another region
+    """
+    return tuple([slice(r.start - o.start, r.stop - o.start)
+                  for r, o in zip(region, origin_region)])
 
 
 def get_n5_path(path, data_set):
@@ -0,0 +1,349 @@
+"""
+Performance telemetry shared by the synapse-dask scripts.
+
+A script calls setup_telemetry() after parsing its arguments. It records, for
+each stage, the wall and CPU time, the peak RSS and the counters below, and
+appends them as JSON lines to the file set with --telemetry or with the
+SYNAPSE_DASK_TELEMETRY environment variable. Worker processes inherit the
+variable and append their own counters to the same file.
+
+With --profile (or SYNAPSE_DASK_PROFILE) a sampling profiler records the
+stacks of all the threads of the script and writes them at exit in the
+collapsed format read by flamegraph.pl and speedscope.
+
+When neither is set, the functions of this module do nothing.
+"""
+import atexit
+import json
+import multiprocessing.util
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+
+TELEMETRY_ENV = 'SYNAPSE_DASK_TELEMETRY'
+PROFILE_ENV = 'SYNAPSE_DASK_PROFILE'
+PROFILE_INTERVAL_ENV = 'SYNAPSE_DASK_PROFILE_INTERVAL'
+# Name of the script, passed to the worker processes
+SCRIPT_ENV = 'SYNAPSE_DASK_SCRIPT'
+
+# Counters recorded by the scripts:
+#   bytes_read, bytes_written       encoded n5 chunk bytes moved to or from storage
+#   read_seconds, write_seconds     time spent in storage reads and writes
+#   chunks_decoded, chunks_encoded  n5 chunks decompressed or compressed
+#   chunks_elided                   n5 chunks not written because they are empty
+#   codec_seconds                   time spent compressing and decompressing chunks
+#   tiff_frames_read, tiff_bytes_read, tiff_read_seconds
+#   tiff_files_written, tiff_bytes_written, tiff_write_seconds
+# Worker processes write their counters at most every WORKER_FLUSH_SECONDS
+WORKER_FLUSH_SECONDS = 10
+
+_lock = threading.Lock()
+_counters = Counter()
+_flushed = Counter()
+_io_time = threading.local()
+
+_path = None
+_script = None
+_main_pid = None
+_start_time = None
+_last_flush = 0
+_exit_registered_pid = None
+_summary_registered = False
+
+
+def add_telemetry_arguments(parser):
+    """
+    Adds the --telemetry and --profile options to an argparse parser
+    """
+    parser.add_argument('--telemetry', dest='telemetry', type=str,
+                        help='Append performance telemetry as JSON lines to this file ' +
+                        f'(default is ${TELEMETRY_ENV})')
+
+    parser.add_argument('--profile', dest='profile', type=str,
+                        help='Sample the stacks of the running threads and write them in ' +
+                        f'collapsed (flame graph) format to this file (default is ${PROFILE_ENV})')
+
+
+def setup_telemetry(script, telemetry_path=None, profile_path=None):
+    """
+    Starts recording the telemetry of this script if a telemetry path is given
+    or set in the environment, and starts the sampling profiler if a profile path
+    is given or set in the environment. A summary record is written at exit.
+    """
+    global _path, _script, _main_pid, _start_time, _summary_registered
+    telemetry_path = telemetry_path or os.environ.get(TELEMETRY_ENV)
+    profile_path = profile_path or os.environ.get(PROFILE_ENV)
+    if telemetry_path:
+        _path = os.path.abspath(telemetry_path)
+        _script = script
+        _main_pid = os.getpid()
+        _start_time = time.time()
+        # inherited by the worker processes started from now on
+        os.environ[TELEMETRY_ENV] = _path
+        os.environ[SCRIPT_ENV] = script
+        os.makedirs(os.path.dirname(_path), exist_ok=True)
+        with _lock:
+            _counters.clear()
+        write_record('start', argv=sys.argv[1:])
+        if not _summary_registered:
+            _summary_registered = True
+            atexit.register(_write_summary)
+    if profile_path:
+        interval = float(os.environ.get(PROFILE_INTERVAL_ENV, '0.01'))
+        start_profiler(profile_path, interval)
+
+
+def enabled():
+    """
+    Returns True if telemetry is recorded by this process
+    """
+    return _path is not None
+
+
+def add(**counts):
+    """
+    Increments the given counters, e.g. add(chunks_encoded=1, bytes_written=n)
+    """
+    if _path is None:
+        return
+    with _lock:
+        _counters.update(counts)
+    if os.getpid() != _main_pid:
+        _flush_worker()
+
+
+def record_io(direction, nbytes, seconds):
+    """
+    Counts a storage read or write of nbytes that took the given time.
+    direction: 'read' or 'written'
+    """
+    if _path is None:
+        return
+    _io_time.seconds = getattr(_io_time, 'seconds', 0.0) + seconds
+    if direction == 'read':
+        add(bytes_read=nbytes, read_seconds=seconds)
+    else:
+        add(bytes_written=nbytes, write_seconds=seconds)
+
+
+@contextmanager
+def timed(counter, seconds_counter='codec_seconds'):
+    """
+    Context manager adding 1 to counter and the elapsed time to seconds_counter.
+    The storage I/O counted with record_io by the same thread meanwhile
+    is excluded, so wrapping a zarr chunk access measures its codec time.
+    """
+    if _path is None:
+        yield
+        return
+    io_start = getattr(_io_time, 'seconds', 0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        io_elapsed = getattr(_io_time, 'seconds', 0.0) - io_start
+        add(**{counter: 1, seconds_counter: max(0.0, elapsed - io_elapsed)})
+
+
+@contextmanager
+def stage(name, **fields):
+    """
+    Context manager (or function decorator) writing a 'stage' record with the wall
+    and CPU time, the peak RSS and the counters incremented by this process during
+    the stage. Concurrent stages of the same process share the counters.
+    """
+    if _path is None:
+        yield
+        return
+    counters_start = snapshot()
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    status = 'failed'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        wall_seconds = time.perf_counter() - start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        counters = snapshot()
+        counters.subtract(counters_start)
+        write_record('stage', stage=name, status=status,
+                     wall_seconds=wall_seconds,
+                     user_seconds=usage.ru_utime - usage_start.ru_utime,
+                     system_seconds=usage.ru_stime - usage_start.ru_stime,
+                     peak_rss_bytes=peak_rss(),
+                     counters=dict(+counters),
+                     **fields)
+
+
+def snapshot():
+    """
+    Returns a copy of the counters of this process
+    """
+    with _lock:
+        return Counter(_counters)
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """
+    Returns the peak resident set size in bytes of this process,
+    or of its terminated children with resource.RUSAGE_CHILDREN
+    """
+    maxrss = resource.getrusage(who).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def write_record(event, **fields):
+    """
+    Appends a JSON record to the telemetry file. Each record is written with
+    a single append, so several processes can share the file.
+    """
+    if _path is None:
+        return
+    record = {
+        'time': time.time(),
+        'event': event,
+        'script': _script,
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+    }
+    record.update(fields)
+    line = json.dumps(record, default=_to_json) + '\n'
+    fd = os.open(_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def _to_json(value):
+    # numpy scalars and other number-like values
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def _write_summary():
+    if os.getpid() != _main_pid:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    write_record('summary',
+                 wall_seconds=time.time() - _start_time,
+                 user_seconds=usage.ru_utime,
+                 system_seconds=usage.ru_stime,
+                 peak_rss_bytes=peak_rss(),
+                 children_peak_rss_bytes=peak_rss(resource.RUSAGE_CHILDREN),
+                 counters=dict(+snapshot()))
+
+
+def flush_counters():
+    """
+    Writes a 'counters' record with the counters incremented by this worker
+    process since its previous record. Called periodically and at exit.
+    """
+    global _last_flush
+    if _path is None or os.getpid() == _main_pid:
+        return
+    with _lock:
+        counters = Counter(_counters)
+        counters.subtract(_flushed)
+        _flushed.update(+counters)
+        _last_flush = time.time()
+    counters = +counters
+    if counters:
+        write_record('counters', counters=dict(counters),
+                     peak_rss_bytes=peak_rss())
+
+
+def _flush_worker():
+    global _exit_registered_pid
+    if _exit_registered_pid != os.getpid():
+        _exit_registered_pid = os.getpid()
+        atexit.register(flush_counters)
+        # multiprocessing workers exit without running the atexit handlers
+        multiprocessing.util.Finalize(None, flush_counters, exitpriority=10)
+    if time.time() - _last_flush > WORKER_FLUSH_SECONDS:
+        flush_counters()
+
+
+def _after_fork():
+    global _lock, _last_flush
+    # the parent's counters are not the child's
+    _lock = threading.Lock()
+    _counters.clear()
+    _flushed.clear()
+    _last_flush = time.time()
+
+
+def _configure_worker():
+    global _path, _script, _last_flush
+    # processes started by a script record their counters in the script's file
+    if os.environ.get(TELEMETRY_ENV):
+        _path = os.environ[TELEMETRY_ENV]
+        _script = os.environ.get(SCRIPT_ENV)
+        _last_flush = time.time()
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Daemon thread sampling the stacks of all the other threads of the process
+    every interval seconds. stop() writes the number of samples of each stack,
+    one "thread;outer;...;inner count" line per stack.
+    """
+
+    def __init__(self, path, interval=0.01):
+        super().__init__(name='sampling-profiler', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            names = dict([(t.ident, t.name) for t in threading.enumerate()])
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self.join()
+        with open(self.path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f'{stack} {count}\n')
+        write_record('profile', path=os.path.abspath(self.path),
+                     interval=self.interval,
+                     samples=sum(self.samples.values()))
+
+
+def start_profiler(path, interval=0.01):
+    """
+    Starts sampling the thread stacks of this process; the profile is written
+    to path when the returned profiler is stopped or at exit
+    """
+    profiler = SamplingProfiler(path, interval)
+    profiler.start()
+    atexit.register(profiler.stop)
+    print(f'Sampling thread stacks every {interval}s to {path}')
+    return profiler
+
+
+os.register_at_fork(after_in_child=_after_fork)
+_configure_worker()
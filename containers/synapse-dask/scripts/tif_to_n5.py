@@ -1,39 +1,97 @@
 #!/usr/bin/env python
 
 import argparse
+import contextlib
+import functools
 import glob
+import json
 import numbers
-import numcodecs as codecs
 import numpy as np
 import pims
 import os
+import telemetry
+import tempfile
+import tifffile
+import warnings
 import zarr
 
 import dask.array as da
+from concurrent.futures import ThreadPoolExecutor
 from dask_image.imread import _map_read_frame
-from dask.delayed import delayed
 
+from create_n5 import get_compressor, parse_shard_chunks, parse_value_range, select_codec
+from dask_cluster import add_cluster_arguments, configure_dask, flush_chunk_stats
+from n5_utils import (N5ChunkWriter, chunk_intersections, create_chunk_stats,
+                      create_occupancy_index, get_n5_path, get_value_range,
+                      open_n5_store, remove_chunk_stats)
 
+
+PROGRESS_FILENAME = 'tif_to_n5_progress.json'
+
+
+@telemetry.stage('tif_to_n5')
 def tif_series_to_n5_volume(input_path, output_path, data_set, compressor,
                             subvolume=None,
                             chunk_size=(512, 512, 512),
                             dtype='same',
                             img_fname_pattern='*.tif',
-                            overwrite=True):
+                            overwrite=True,
+                            pipelined=False,
+                            resume=False,
+                            workers=1,
+                            engine='dask',
+                            chunk_stats=True,
+                            stats_bins=256,
+                            stats_range=None,
+                            shard_chunks=None):
     '''
     Convert TIFF slices into an n5 volume with given chunk size. 
     This method processes only one Z chunk at a time, to avoid overwhelming worker memory. 
+    The completed Z ranges are recorded in a progress file inside the data set,
+    one per subvolume and chunk size, so that with resume=True an interrupted
+    conversion skips them and does not recreate the array.
+    If pipelined is set, the TIFFs of the next Z range are read while the current
+    range is compressed and written by the given number of threads. This keeps
+    about two Z ranges in memory.
+    The 'dask' engine reads the TIFFs into a dask array and rechunks it to the n5
+    chunk size. The 'direct' engine reads the TIFFs of each Z range straight into
+    a slab buffer with a thread pool and compresses the n5 chunks from that buffer,
+    bypassing the dask graph.
+    Unless chunk_stats is False, the min, max, sum, nonzero count and histogram of
+    every chunk are recorded as the chunks are written (see n5_utils.ChunkStats).
+    The histograms have stats_bins bins over stats_range, which defaults to the
+    range of the values of a few frames spread through the stack.
+    If shard_chunks is set, the output is a sharded zarr v3 container with
+    shard_chunks (z,y,x) chunks per shard file instead of an n5 (see
+    n5_utils.ShardedStore), and the dask engine writes blocks spanning the
+    shards along y and x.
     '''
-    images = read_tiff_stack(input_path + '/' + img_fname_pattern)
-    volume = images.rechunk(chunk_size)
-
-    if dtype == 'same':
-        dtype = volume.dtype
+    if engine == 'direct':
+        frames = get_tiff_frames(input_path + '/' + img_fname_pattern)
+        frame_shape, frame_dtype = get_tiff_frame_info(frames[0])
+        volume = None
+        volume_shape = (len(frames),) + frame_shape
+        if dtype == 'same':
+            dtype = frame_dtype
     else:
-        volume = volume.astype(dtype)
+        images = read_tiff_stack(input_path + '/' + img_fname_pattern)
+        if shard_chunks:
+            # one task per shard of each slice range, so a shard is written at once
+            volume = images.rechunk([chunk_size[0]] + [c * n for c, n in zip(chunk_size[1:], shard_chunks[1:])])
+        else:
+            volume = images.rechunk(chunk_size)
+        volume_shape = volume.shape
 
-    store = zarr.N5Store(output_path)
-    num_slices = volume.shape[0]
+        if dtype == 'same':
+            dtype = volume.dtype
+        else:
+            volume = volume.astype(dtype)
+
+    if shard_chunks:
+        # shards hold little endian chunks, unlike the big endian n5 chunks
+        dtype = np.dtype(dtype).newbyteorder('<')
+    store = open_n5_store(output_path, shard_chunks)
+    num_slices = volume_shape[0]
     chunk_z = chunk_size[2]
 
     def in_subvol(c, cz):
@@ -49,25 +107,55 @@ def tif_series_to_n5_volume(input_path, output_path, data_set, compressor,
     if subvolume is not None:
         print(f"  subvolume: {subvolume}")
     print(f"  compressor: {compressor}")
-    print(f"  shape:      {volume.shape}")
+    print(f"  shape:      {volume_shape}")
     print(f"  chunking:   {chunk_size}")
     print(f"  dtype:      {dtype}")
+    if shard_chunks:
+        print(f"  shards:     {shard_chunks} chunks")
     print(f"  to path:    {output_path}{data_set}")
 
-    # Create the array container
-    zarr.create(
-        shape=volume.shape,
-        chunks=chunk_size,
-        dtype=dtype,
-        compressor=compressor,
-        store=store,
-        path=data_set,
-        overwrite=overwrite
-    )
+    progress_path = _get_progress_path(output_path, data_set, subvolume, chunk_size)
+    progress = {
+        'shape': list(volume_shape),
+        'chunks': list(chunk_size),
+        'dtype': str(np.dtype(dtype)),
+        'compressor': compressor.get_config() if compressor else None,
+        'subvolume': list(subvolume) if subvolume else None,
+        'completed': [],
+    }
+    if shard_chunks:
+        progress['shard_chunks'] = list(shard_chunks)
+    saved_progress = _read_progress(progress_path) if resume else None
+    if saved_progress and all([saved_progress[k] == v for k, v in progress.items() if k != 'completed']):
+        progress['completed'] = saved_progress['completed']
+        print(f"Resuming after {len(progress['completed'])} completed slice ranges")
+    else:
+        if saved_progress:
+            print('Saved progress does not match the current parameters - starting over')
+        # Create the array container
+        zarr.create(
+            shape=volume_shape,
+            chunks=chunk_size,
+            dtype=dtype,
+            compressor=compressor,
+            store=store,
+            path=data_set,
+            overwrite=overwrite
+        )
+        create_occupancy_index(output_path, data_set)
+        if chunk_stats:
+            if stats_range is None:
+                stats_range = sample_tiff_value_range(input_path + '/' + img_fname_pattern, dtype,
+                                                      workers=workers)
+            print(f"Chunk statistics histograms: {stats_bins} bins over {stats_range}")
+            create_chunk_stats(output_path, data_set, bins=stats_bins, value_range=stats_range)
+        else:
+            remove_chunk_stats(output_path, data_set)
+        _write_progress(progress_path, progress)
 
-    # Proceed slab-by-slab through Z so that memory is not overwhelmed
-    for r in ranges:
-        print("Saving slice range", r)
+    ranges = [r for r in ranges if list(r) not in progress['completed']]
+
+    def get_regions(r):
         z_slice = slice(r[0], r[1])
 
         if subvolume is None:
@@ -77,19 +165,198 @@ def tif_series_to_n5_volume(input_path, output_path, data_set, compressor,
             x_slice = slice(subvolume[0], subvolume[3])
             y_slice = slice(subvolume[1], subvolume[4])
 
-        regions = (z_slice, y_slice, x_slice)
-        slices = volume[regions]
-        z = delayed(zarr.Array)(store, path=data_set)
-        slices.store(z, regions=regions, lock=False, compute=True)
+        return (z_slice, y_slice, x_slice)
+
+    def complete(r):
+        progress['completed'].append(list(r))
+        _write_progress(progress_path, progress)
+
+    if engine == 'direct':
+        def read_slab(r):
+            return read_tiff_slab(frames, get_regions(r), workers)
 
-    print('Saved n5 volume', str(volume.shape), 'to', output_path)
+        _store_slabs(read_slab, zarr.open(store=store, path=data_set, mode='r'),
+                     N5ChunkWriter(output_path, data_set, autoflush=False),
+                     ranges, get_regions, complete, workers, prefetch=pipelined)
+    elif pipelined:
+        def read_slab(r):
+            return volume[get_regions(r)].compute()
+
+        _store_slabs(read_slab, zarr.open(store=store, path=data_set, mode='r'),
+                     N5ChunkWriter(output_path, data_set, autoflush=False),
+                     ranges, get_regions, complete, workers, prefetch=True)
+    else:
+        # Proceed slab-by-slab through Z so that memory is not overwhelmed
+        for r in ranges:
+            print("Saving slice range", r)
+            regions = get_regions(r)
+            slices = volume[regions]
+            with telemetry.stage('slice_range', z=list(r)):
+                # empty chunks are not written, see N5ChunkWriter
+                slices.store(N5ChunkWriter(output_path, data_set), regions=regions,
+                             lock=False, compute=True)
+                # the statistics buffered by the threads and the workers
+                flush_chunk_stats()
+            complete(r)
+
+    # the conversion is complete, nothing is left to resume
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(progress_path)
+    print('Saved n5 volume', str(volume_shape), 'to', output_path)
+
+
+def _store_slabs(read_slab, n5_array, target, ranges, get_regions, complete, workers, prefetch=True):
+    '''
+    Write the slab of each range chunk by chunk to the target using the given number
+    of threads; n5_array provides the shape and chunking of the target.
+    If prefetch is set, the slab of the next range is read while the slab
+    of the current range is written.
+    '''
+    def write_chunk(region, data):
+        target[region] = data
+
+    with ThreadPoolExecutor(max_workers=1) as reader, \
+            ThreadPoolExecutor(max_workers=workers) as writer:
+        next_slab = reader.submit(read_slab, ranges[0]) if ranges and prefetch else None
+        for i, r in enumerate(ranges):
+            slab = next_slab.result() if prefetch else read_slab(r)
+            next_slab = reader.submit(read_slab, ranges[i + 1]) \
+                if prefetch and i + 1 < len(ranges) else None
+            print("Saving slice range", r)
+            regions = get_regions(r)
+            start = [s.start or 0 for s in regions]
+            end = [s.stop or d for s, d in zip(regions, n5_array.shape)]
+            # with prefetch, the counters include the reads of the next range
+            with telemetry.stage('slice_range', z=list(r)):
+                writes = [writer.submit(write_chunk, region, slab[block_region])
+                          for _, region, block_region, _ in chunk_intersections(
+                              n5_array.shape, n5_array.chunks, start, end)]
+                for w in writes:
+                    w.result()
+                del slab
+                target.flush()
+            complete(r)
+
+
+def _get_progress_path(output_path, data_set, subvolume, chunk_size):
+    '''
+    Returns the progress file of a conversion, keyed by its subvolume and chunk size,
+    so that the conversions of different subvolumes of a data set do not share it
+    '''
+    key = 'chunks-' + 'x'.join([str(c) for c in chunk_size])
+    if subvolume is not None:
+        key += '-subvol-' + '_'.join([str(c) for c in subvolume])
+    name, ext = os.path.splitext(PROGRESS_FILENAME)
+    return os.path.join(get_n5_path(output_path, data_set), f'{name}-{key}{ext}')
+
+
+def _read_progress(progress_path):
+    if not os.path.exists(progress_path):
+        return None
+    with open(progress_path) as f:
+        return json.load(f)
+
+
+def _write_progress(progress_path, progress):
+    # a unique temporary file, in case another conversion writes the same progress file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(progress_path),
+                                    prefix=os.path.basename(progress_path) + '.', suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, progress_path)
+
+
+def get_tiff_frames(fname):
+    '''
+    Returns a list of (filename, page) tuples for all the 2D frames of the TIFF
+    files matching the given glob, in Z order
+    '''
+    filenames = sorted(glob.glob(str(fname)), key=_file_index)
+    if len(filenames) == 1:
+        with tifffile.TiffFile(filenames[0]) as tif:
+            return [(filenames[0], page) for page in range(len(tif.pages))]
+    return [(filename, 0) for filename in filenames]
+
+
+def get_tiff_frame_info(frame):
+    '''
+    Returns the shape and dtype of the given (filename, page) frame
+    '''
+    with tifffile.TiffFile(frame[0]) as tif:
+        page = tif.pages[frame[1]]
+        return tuple(page.shape), page.dtype
+
+
+def read_tiff_slab(frames, regions, workers):
+    '''
+    Read the frames in the given (z, y, x) regions into a new slab buffer
+    using the given number of threads
+    '''
+    z_slice, y_slice, x_slice = regions
+    frame_shape, frame_dtype = get_tiff_frame_info(frames[z_slice.start])
+    yx_shape = [len(range(*s.indices(d))) for s, d in zip((y_slice, x_slice), frame_shape)]
+    full_frame = list(yx_shape) == list(frame_shape)
+    slab = np.empty([z_slice.stop - z_slice.start] + yx_shape, dtype=frame_dtype)
+
+    def read_frame(i):
+        filename, page = frames[z_slice.start + i]
+        with telemetry.timed('tiff_frames_read', 'tiff_read_seconds'):
+            if full_frame:
+                # decode straight into the slab
+                tifffile.imread(filename, key=page, out=slab[i])
+            else:
+                slab[i] = tifffile.imread(filename, key=page)[y_slice, x_slice]
+        telemetry.add(tiff_bytes_read=slab[i].nbytes)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(read_frame, range(slab.shape[0])))
+    return slab
+
+
+def sample_tiff_chunks(fname, chunk_size, samples=8, max_depth=64, workers=1, seed=0):
+    '''
+    Returns randomly selected chunk-sized blocks from the middle of the TIFF stack.
+    The depth of the blocks is limited to max_depth frames.
+    '''
+    frames = get_tiff_frames(fname)
+    depth = min(chunk_size[0], max_depth, len(frames))
+    z_start = (len(frames) - depth) // 2
+    slab = read_tiff_slab(frames, (slice(z_start, z_start + depth), slice(None), slice(None)), workers)
+    rng = np.random.default_rng(seed)
+    blocks = []
+    for _ in range(samples):
+        origin = [rng.integers(0, max(1, d - c + 1)) for d, c in zip(slab.shape[1:], chunk_size[1:])]
+        blocks.append(slab[:, origin[0]:origin[0] + chunk_size[1], origin[1]:origin[1] + chunk_size[2]])
+    return blocks
+
+
+def sample_tiff_value_range(fname, dtype, samples=8, workers=1):
+    '''
+    Returns the histogram value range of the chunk statistics from the values
+    of a few frames spread through the TIFF stack, see n5_utils.get_value_range
+    '''
+    frames = get_tiff_frames(fname)
+    indexes = sorted(set(np.linspace(0, len(frames) - 1, min(samples, len(frames))).astype(int)))
+    return get_value_range([read_tiff_slab(frames, (slice(i, i + 1), slice(None), slice(None)), workers)
+                            for i in indexes], dtype)
 
 
-def read_tiff_stack(fname, nframes=1, *, arraytype="numpy"):
+def _file_index(filename):
+    _dirpath, name = os.path.split(filename)
+    stem, _ext = os.path.splitext(name)
+    try:
+        return int(stem)
+    except ValueError:
+        return filename
+
+
+def read_tiff_stack(fname, nframes=1, *, arraytype="numpy", memmap=True):
     """
     Read image data into a Dask Array.
     Provides a simple, fast mechanism to ingest image data into a
     Dask Array.
+    Uncompressed TIFFs with contiguous image data are not decoded:
+    their chunks are memory-mapped views of the files.
     Parameters
     ----------
     fname : str or pathlib.Path
@@ -98,6 +365,9 @@ def read_tiff_stack(fname, nframes=1, *, arraytype="numpy"):
         Number of the frames to include in each chunk (default: 1).
     arraytype : str, optional
         Array type for dask chunks. Available options: "numpy", "cupy".
+    memmap : bool, optional
+        Memory-map uncompressed, contiguous TIFFs (default: True).
+        Only used with the "numpy" array type.
     Returns
     -------
     array : dask.array.Array
@@ -136,15 +406,7 @@ def read_tiff_stack(fname, nframes=1, *, arraytype="numpy"):
             RuntimeWarning
         )
 
-    def file_index(filename):
-        _dirpath, name = os.path.split(filename)
-        stem, _ext = os.path.splitext(name)
-        try:
-            return int(stem)
-        except ValueError:
-            return filename
-
-    filenames = sorted(glob.glob(sfname), key=file_index)
+    filenames = sorted(glob.glob(sfname), key=_file_index)
 
     # place source filenames into dask array
     if len(filenames) > 1:
@@ -154,9 +416,16 @@ def read_tiff_stack(fname, nframes=1, *, arraytype="numpy"):
         ar = da.from_array(filenames * shape[0], chunks=(nframes,))
         multiple_files = False
 
+    if memmap and arraytype == "numpy" and _is_memmappable(filenames[0]):
+        read_frames = _map_memmap_frames
+    else:
+        read_frames = _map_read_frame
+    if telemetry.enabled():
+        read_frames = functools.partial(_map_timed_frames, read_frames=read_frames)
+
     # read in data using encoded filenames
     a = ar.map_blocks(
-        _map_read_frame,
+        read_frames,
         chunks=da.core.normalize_chunks(
             (nframes,) + shape[1:], shape),
         multiple_files=multiple_files,
@@ -168,6 +437,51 @@ def read_tiff_stack(fname, nframes=1, *, arraytype="numpy"):
     return a
 
 
+def _is_memmappable(filename):
+    """
+    Check if the image data of the TIFF file is uncompressed and contiguous
+    """
+    with tifffile.TiffFile(filename) as tif:
+        return tif.series[0].dataoffset is not None
+
+
+def _memmap_frames(filename, frames=slice(None)):
+    """
+    Return a memory-mapped view of the given frames of the TIFF file,
+    or decode them if the file cannot be memory-mapped
+    """
+    try:
+        return tifffile.memmap(filename, mode='r')[frames]
+    except ValueError:
+        return tifffile.imread(filename)[frames]
+
+
+def _map_memmap_frames(x, multiple_files, block_info=None, **kwargs):
+    """
+    Counterpart of dask_image's _map_read_frame returning memory-mapped views
+    """
+    if multiple_files:
+        frames = [_memmap_frames(fn) for fn in x]
+        if len(frames) == 1:
+            # no copy when there is one frame per chunk
+            return frames[0][np.newaxis]
+        return np.stack(frames)
+    else:
+        i, j = block_info[None]['array-location'][0]
+        return _memmap_frames(x[0], slice(i, j))
+
+
+def _map_timed_frames(x, multiple_files, block_info=None, read_frames=None, **kwargs):
+    """
+    Calls read_frames counting the frames, their bytes and the read time in the telemetry.
+    Memory-mapped frames are only read when they are used.
+    """
+    with telemetry.timed('tiff_frames_read', 'tiff_read_seconds'):
+        frames = read_frames(x, multiple_files, block_info=block_info, **kwargs)
+    telemetry.add(tiff_bytes_read=frames.nbytes)
+    return frames
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Convert a TIFF series to a chunked n5 volume')
@@ -192,14 +506,24 @@ def main():
                         help='Set the output dtype. Default is the same dtype as the template.')
 
     parser.add_argument('--compression', dest='compression', type=str, default='bz2',
-                        help='Set the compression. Valid values any codec id supported by numcodecs including: raw, lz4, gzip, bz2, blosc. Default is bz2.')
+                        help='Set the compression. Valid values any codec id supported by numcodecs including: raw, lz4, gzip, bz2, xz, blosc, ' +
+                        'optionally followed by settings, e.g. gzip:6 or blosc:zstd:5. Use "auto" to select the fastest N5 codec ' +
+                        '(raw, gzip, bz2, xz or blosc) ' +
+                        'reaching --target_ratio on chunks sampled from the TIFFs. Default is bz2.')
+
+    parser.add_argument('--target_ratio', dest='target_ratio', type=float, default=2.0,
+                        help='Compression ratio required from the codec selected by --compression auto. Default is 2.')
 
     parser.add_argument('--distributed', dest='distributed', action='store_true',
-                        help='Run with distributed scheduler (default)')
+                        help='Run with distributed scheduler (default). Not supported with --engine direct, ' +
+                        'which writes the chunks from threads in this process')
     parser.set_defaults(distributed=False)
 
-    parser.add_argument('--workers', dest='workers', type=int, default=20,
-                        help='If --distributed is set, this specifies the number of workers (default 20)')
+    parser.add_argument('--workers', dest='workers', type=int,
+                        help='If --distributed is set, this specifies the number of workers. ' +
+                        'With --pipelined or --engine direct, this is also the number of threads ' +
+                        'reading frames and writing chunks. By default it is chosen from the CPU ' +
+                        'and memory limits of the container.')
 
     parser.add_argument('--subvol', dest='subvolume', type=str,
                         help='Subvolume to be converted')
@@ -208,8 +532,45 @@ def main():
                         help='Run a web-based dashboard on port 8787')
     parser.set_defaults(dashboard=False)
 
+    parser.add_argument('--pipelined', dest='pipelined', action='store_true',
+                        help='Read the next slice range while the current one is compressed and written')
+    parser.set_defaults(pipelined=False)
+
+    parser.add_argument('--engine', dest='engine', type=str, default='dask', choices=['dask', 'direct'],
+                        help='Conversion engine: "dask" rechunks a dask array of the TIFF frames, ' +
+                        '"direct" reads each slice range into a buffer and writes the chunks from it ' +
+                        'with --workers threads (default dask)')
+
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='Skip the slice ranges completed by a previous, interrupted conversion')
+    parser.set_defaults(resume=False)
+
+    parser.add_argument('--no_chunk_stats', dest='chunk_stats', action='store_false',
+                        help='Do not record the per-chunk statistics (min, max, histogram) while writing')
+    parser.set_defaults(chunk_stats=True)
+
+    parser.add_argument('--stats_bins', dest='stats_bins', type=int, default=256,
+                        help='Number of bins of the per-chunk histograms (default 256)')
+
+    parser.add_argument('--stats_range', dest='stats_range', type=str, metavar='min,max',
+                        help='Value range of the per-chunk histograms. By default it is the range ' +
+                        'of the values of a few frames spread through the stack.')
+
+    parser.add_argument('--shard_chunks', dest='shard_chunks', type=str,
+                        help='Write a sharded zarr v3 container instead of an n5, with this comma-delimited ' +
+                        'number of chunks per shard file along z,y,x, e.g. 4,4,4. Default is no sharding.')
+
+    add_cluster_arguments(parser)
+
+    telemetry.add_telemetry_arguments(parser)
+
     args = parser.parse_args()
 
+    telemetry.setup_telemetry('tif_to_n5', args.telemetry, args.profile)
+
+    if args.engine == 'direct' and args.distributed:
+        parser.error('--distributed is not supported with --engine direct')
+
     if args.subvolume is not None:
         subvolume_tuple = [int(d) for d in args.subvolume.split(',')]
         start = subvolume_tuple[:3]
@@ -219,33 +580,52 @@ def main():
     else:
         subvolume = None
 
-    if args.compression == 'raw':
-        compressor = None
-    else:
-        compressor = codecs.get_codec(dict(id=args.compression))
-
-    if args.distributed:
-        dashboard_address = None
-        if args.dashboard:
-            dashboard_address = ":8787"
-            print(f"Starting dashboard on {dashboard_address}")
-
-        from dask.distributed import Client
-        client = Client(processes=True, n_workers=args.workers,
-                        threads_per_worker=1, dashboard_address=dashboard_address)
-
+    chunk_size = [int(c) for c in args.chunk_size.split(',')]
+    if args.dtype == 'same':
+        frames = get_tiff_frames(args.input_path + '/' + args.input_name_pattern)
+        itemsize = get_tiff_frame_info(frames[0])[1].itemsize
     else:
+        itemsize = np.dtype(args.dtype).itemsize
+
+    distributed = args.distributed
+    dashboard_address = None
+    if distributed and args.dashboard:
+        dashboard_address = ":8787"
+        print(f"Starting dashboard on {dashboard_address}")
+
+    layout, client = configure_dask(int(np.prod(chunk_size)) * itemsize,
+                                    distributed=distributed,
+                                    workers=args.workers,
+                                    threads_per_worker=args.threads_per_worker,
+                                    memory_limit=args.memory_limit,
+                                    dashboard_address=dashboard_address)
+    if not distributed:
         from dask.diagnostics import ProgressBar
         pbar = ProgressBar()
         pbar.register()
 
+    if args.compression == 'auto':
+        with telemetry.stage('select_codec'):
+            chunk_samples = sample_tiff_chunks(args.input_path + '/' + args.input_name_pattern,
+                                               chunk_size, workers=layout['threads'])
+            compressor = get_compressor(select_codec(chunk_samples, args.target_ratio))
+    else:
+        compressor = get_compressor(args.compression)
+
     tif_series_to_n5_volume(args.input_path, args.output_path, args.data_set,
                             compressor,
                             subvolume=subvolume,
-                            chunk_size=[int(c)
-                                        for c in args.chunk_size.split(',')],
+                            chunk_size=chunk_size,
                             dtype=args.dtype,
-                            img_fname_pattern=args.input_name_pattern)
+                            img_fname_pattern=args.input_name_pattern,
+                            pipelined=args.pipelined,
+                            resume=args.resume,
+                            workers=layout['threads'],
+                            engine=args.engine,
+                            chunk_stats=args.chunk_stats,
+                            stats_bins=args.stats_bins,
+                            stats_range=parse_value_range(args.stats_range),
+                            shard_chunks=parse_shard_chunks(args.shard_chunks))
 
 
 if __name__ == "__main__":
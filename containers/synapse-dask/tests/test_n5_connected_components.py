@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import zarr
+from scipy import ndimage
+
+from n5_connected_components import connected_components, get_structure, union_find
+
+
+def _write_volume(n5_path, shape=(19, 23, 29), chunks=(8, 8, 8), seed=0):
+    '''
+    Writes a (z,y,x) volume of blobs and scattered single voxels, so that components
+    cross the block boundaries along faces, edges and corners
+    '''
+    rng = np.random.default_rng(seed)
+    blobs = ndimage.gaussian_filter(rng.random(shape), 1.5)
+    volume = (blobs > np.percentile(blobs, 75)) | (rng.random(shape) < 0.05)
+    data = volume.astype(np.uint8) * rng.integers(1, 255, shape).astype(np.uint8)
+    zarr.create(shape=shape, chunks=chunks, dtype='uint8', store=zarr.N5Store(n5_path),
+                path='s0')[...] = data
+    return data
+
+
+def _assert_same_components(labels, expected):
+    assert ((labels > 0) == (expected > 0)).all()
+    pairs = np.unique(np.stack([labels[labels > 0], expected[expected > 0]]), axis=1)
+    # one to one mapping between the labels
+    assert pairs.shape[1] == len(np.unique(pairs[0])) == len(np.unique(pairs[1]))
+
+
+@pytest.mark.parametrize('shape', ['6', '18', '26'])
+@pytest.mark.parametrize('block_size', [(8, 8, 8), (16, 8, 8), (10, 12, 8)])
+def test_blockwise_labels_match_whole_volume_labels(tmp_path, shape, block_size):
+    n5_path = str(tmp_path / 'in.n5')
+    data = _write_volume(n5_path)
+    expected, nexpected = ndimage.label(data > 0, structure=get_structure(shape))
+
+    nlabels = connected_components(n5_path, '/s0', n5_path, '/labels', block_size=block_size,
+                                   shape=shape, workers=2)
+
+    labels = zarr.open(store=zarr.N5Store(n5_path), mode='r')['labels'][...]
+    assert nlabels == nexpected
+    assert labels.max() == nlabels
+    _assert_same_components(labels, expected)
+
+
+@pytest.mark.parametrize('shape', ['6', '26'])
+def test_small_components_are_removed(tmp_path, shape):
+    n5_path = str(tmp_path / 'in.n5')
+    data = _write_volume(n5_path, seed=1)
+    expected, _ = ndimage.label(data > 0, structure=get_structure(shape))
+    counts = np.bincount(expected.ravel())
+    expected[counts[expected] < 10] = 0
+
+    nlabels = connected_components(n5_path, '/s0', n5_path, '/labels', block_size=(8, 8, 8),
+                                   shape=shape, min_size=10, workers=2)
+
+    labels = zarr.open(store=zarr.N5Store(n5_path), mode='r')['labels'][...]
+    assert nlabels == len(np.unique(expected)) - 1
+    _assert_same_components(labels, expected)
+
+
+def test_union_find_merges_chains():
+    pairs = np.array([[5, 4], [4, 2], [7, 6], [6, 5], [1, 3]])
+    roots = union_find(8, pairs)
+    assert list(roots) == [0, 1, 2, 1, 2, 2, 2, 2, 8]
@@ -0,0 +1,153 @@
+import json
+import os
+
+import numcodecs
+import numpy as np
+import pytest
+import zarr
+
+import n5_utils
+from n5_utils import (MISSING_CHUNK, close_n5_arrays, open_n5_store, read_n5_block,
+                      write_n5_block)
+
+SHAPE = (37, 45, 53)
+CHUNKS = (8, 8, 8)
+SHARD_CHUNKS = (2, 3, 2)
+COMPRESSORS = [numcodecs.GZip(3), numcodecs.Zstd(2), numcodecs.Blosc('zstd', 3, shuffle=1), None]
+
+
+@pytest.fixture(autouse=True)
+def _reset_caches():
+    yield
+    close_n5_arrays()
+    n5_utils._chunk_cache.clear()
+
+
+def _write_container(path, compressor, seed=0):
+    '''
+    Creates a sharded (z,y,x) uint16 array and fills it with overlapping partial
+    block writes, followed by a block of zeros that empties whole chunks and shards.
+    Returns the expected (z,y,x) content
+    '''
+    zarr.create(shape=SHAPE, chunks=CHUNKS, dtype='<u2', compressor=compressor,
+                store=open_n5_store(path, shard_chunks=SHARD_CHUNKS), path='s0')
+    close_n5_arrays()
+    rng = np.random.default_rng(seed)
+    expected = np.zeros(SHAPE[::-1], dtype=np.uint16)  # x,y,z
+    for _ in range(25):
+        start = rng.integers(0, np.array(SHAPE[::-1]) - 3, 3)
+        end = np.minimum(start + rng.integers(1, 20, 3), SHAPE[::-1])
+        data = rng.integers(1, 1000, tuple(end - start)).astype(np.uint16)
+        expected[start[0]:end[0], start[1]:end[1], start[2]:end[2]] = data
+        write_n5_block(path, '/s0', start, end, data)
+    write_n5_block(path, '/s0', (0, 0, 0), (33, 45, 37), np.zeros((33, 45, 37), np.uint16))
+    expected[:33] = 0
+    close_n5_arrays()
+    return expected.transpose(2, 1, 0)
+
+
+def _read_shards(array_path):
+    '''
+    Decodes the shards of a zarr v3 array by following the sharding_indexed
+    specification, independently of the ShardedStore
+    '''
+    with open(os.path.join(array_path, 'zarr.json')) as f:
+        document = json.load(f)
+    sharding = document['codecs'][0]['configuration']
+    assert document['codecs'][0]['name'] == 'sharding_indexed'
+    assert sharding.get('index_location', 'end') == 'end'
+    chunks = tuple(sharding['chunk_shape'])
+    shard_shape = tuple(document['chunk_grid']['configuration']['chunk_shape'])
+    shard_chunks = tuple([s // c for s, c in zip(shard_shape, chunks)])
+    index_bytes = 16 * int(np.prod(shard_chunks)) + \
+        4 * (sharding['index_codecs'][-1]['name'] == 'crc32c')
+    compressors = [c for c in sharding['codecs'] if c['name'] != 'bytes']
+    shape = tuple(document['shape'])
+    padded = tuple([-(-d // s) * s for d, s in zip(shape, shard_shape)])
+    data = np.full(padded, document['fill_value'], dtype=np.dtype(document['data_type']))
+    for root, _, files in os.walk(os.path.join(array_path, 'c')):
+        for name in files:
+            shard_index = [int(i) for i in os.path.relpath(os.path.join(root, name),
+                                                           os.path.join(array_path, 'c')).split(os.sep)]
+            with open(os.path.join(root, name), 'rb') as f:
+                shard = f.read()
+            index = np.frombuffer(shard[len(shard) - index_bytes:][:16 * int(np.prod(shard_chunks))],
+                                  dtype='<u8').reshape(shard_chunks + (2,))
+            for inner in np.ndindex(*shard_chunks):
+                offset, nbytes = [int(v) for v in index[inner]]
+                if offset == MISSING_CHUNK:
+                    continue
+                chunk = shard[offset:offset + nbytes]
+                for compressor in compressors:
+                    # the gzip and zstd decoders do not depend on the compression settings
+                    chunk = numcodecs.get_codec({'id': compressor['name']}).decode(chunk)
+                origin = [(s * n + i) * c for s, n, i, c in zip(shard_index, shard_chunks, inner, chunks)]
+                data[tuple([slice(o, o + c) for o, c in zip(origin, chunks)])] = \
+                    np.frombuffer(chunk, dtype=data.dtype).reshape(chunks)
+    return data[tuple([slice(0, d) for d in shape])]
+
+
+@pytest.mark.parametrize('compressor', COMPRESSORS, ids=['gzip', 'zstd', 'blosc', 'raw'])
+def test_partial_shard_writes_round_trip(tmp_path, compressor):
+    path = str(tmp_path / 'out.zarr')
+    expected = _write_container(path, compressor)
+
+    assert (read_n5_block(path, '/s0', (0, 0, 0), SHAPE[::-1]) == expected.transpose(2, 1, 0)).all()
+    # the zeroed shards are removed
+    assert not os.path.exists(os.path.join(path, 's0', 'c', '0', '0', '0'))
+
+
+@pytest.mark.parametrize('compressor', [numcodecs.GZip(3), numcodecs.Zstd(2), None],
+                         ids=['gzip', 'zstd', 'raw'])
+def test_shards_follow_the_sharding_specification(tmp_path, compressor):
+    path = str(tmp_path / 'out.zarr')
+    expected = _write_container(path, compressor)
+
+    assert (_read_shards(os.path.join(path, 's0')) == expected).all()
+
+
+@pytest.mark.parametrize('compressor', COMPRESSORS, ids=['gzip', 'zstd', 'blosc', 'raw'])
+def test_shards_are_readable_by_tensorstore(tmp_path, compressor):
+    ts = pytest.importorskip('tensorstore')
+    path = str(tmp_path / 'out.zarr')
+    expected = _write_container(path, compressor)
+
+    array = ts.open({'driver': 'zarr3', 'kvstore': {'driver': 'file', 'path': path + '/s0'}}).result()
+    assert (array.read().result() == expected).all()
+
+
+def test_checksummed_shard_indexes(tmp_path):
+    ts = pytest.importorskip('tensorstore')
+    path = str(tmp_path / 'in.zarr')
+    expected = np.random.default_rng(0).integers(0, 1000, SHAPE).astype(np.uint16)
+    expected[:16] = 0
+    # tensorstore follows the zarr-python 3 default of a crc32c checksum after the shard index
+    spec = {'driver': 'zarr3', 'kvstore': {'driver': 'file', 'path': path + '/s0'},
+            'metadata': {'shape': SHAPE, 'data_type': 'uint16',
+                         'chunk_grid': {'name': 'regular',
+                                        'configuration': {'chunk_shape': (16, 24, 16)}},
+                         'codecs': [{'name': 'sharding_indexed', 'configuration': {
+                             'chunk_shape': CHUNKS,
+                             'codecs': [{'name': 'bytes', 'configuration': {'endian': 'little'}},
+                                        {'name': 'gzip', 'configuration': {'level': 3}}],
+                             'index_codecs': [{'name': 'bytes', 'configuration': {'endian': 'little'}},
+                                              {'name': 'crc32c'}]}}]},
+            'create': True}
+    ts.open(spec).result().write(expected).result()
+    with open(os.path.join(path, 'zarr.json'), 'w') as f:
+        json.dump({'zarr_format': 3, 'node_type': 'group', 'attributes': {}}, f)
+
+    assert (read_n5_block(path, '/s0', (0, 0, 0), SHAPE[::-1]) == expected.transpose(2, 1, 0)).all()
+    write_n5_block(path, '/s0', (3, 5, 20), (13, 15, 30), np.full((10, 10, 10), 7, np.uint16))
+    expected[20:30, 5:15, 3:13] = 7
+    close_n5_arrays()
+    n5_utils._chunk_cache.clear()
+
+    assert (read_n5_block(path, '/s0', (0, 0, 0), SHAPE[::-1]) == expected.transpose(2, 1, 0)).all()
+    assert (_read_shards(os.path.join(path, 's0')) == expected).all()
+    del spec['create'], spec['metadata']
+    assert (ts.open(spec).result().read().result() == expected).all()
+
+
+def test_crc32c():
+    assert n5_utils._crc32c(b'123456789') == 0xE3069283